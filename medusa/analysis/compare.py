@@ -0,0 +1,387 @@
+
+from __future__ import absolute_import
+
+import numpy as np
+import pandas as pd
+
+from scipy import stats
+
+# functions for statistical comparison of ensemble simulation results
+
+CORRECTION_METHODS = ['fdr_bh', 'bonferroni', 'holm', None]
+
+def align_conditions(results, fva_bound='maximum'):
+    """
+    Aligns ensemble simulation results from several conditions into a
+    single array.
+
+    Parameters
+    ----------
+    results : dict of str:pandas.DataFrame
+        Results for each condition, as returned by optimize_ensemble (members
+        as index and reactions as columns) or ensemble_fva.
+    fva_bound : str, optional
+        For results from ensemble_fva, which bound of the flux ranges to
+        compare, either 'maximum' (default) or 'minimum'.
+
+    Returns
+    -------
+    values : numpy.ndarray
+        conditions x members x reactions array, restricted to the members and
+        reactions present in every condition.
+    conditions : list of str
+        The conditions, in the order of the first axis of values.
+    members : list of str
+        The member ids, in the order of the second axis of values.
+    reactions : list of str
+        The reaction ids, in the order of the third axis of values.
+    """
+    conditions = list(results.keys())
+    frames = [_member_frame(results[condition], fva_bound)
+              for condition in conditions]
+    members = list(frames[0].index)
+    reactions = list(frames[0].columns)
+    # filter in place of Index.intersection, which only keeps the order of
+    # the first frame from pandas 0.24
+    for frame in frames[1:]:
+        members = [member for member in members if member in frame.index]
+        reactions = [reaction for reaction in reactions
+                     if reaction in frame.columns]
+    values = np.stack([frame.loc[members, reactions].values.astype(float)
+                       for frame in frames])
+    return values, conditions, members, reactions
+
+
+def _member_frame(frame, fva_bound):
+    # ensemble_fva returns two rows per member, labeled by the bound and
+    # with the member id in 'model_source'
+    if 'model_source' not in frame.columns:
+        return frame
+    if fva_bound not in ('maximum', 'minimum'):
+        raise ValueError("fva_bound must be 'maximum' or 'minimum'")
+    rows = frame.index.astype(str).str.startswith(fva_bound + '_')
+    selected = frame.loc[rows]
+    selected.index = selected['model_source']
+    return selected.drop('model_source', axis=1)
+
+
+def _nan_mean_std(values):
+    # number of non-missing values, their mean and standard deviation
+    # (ddof=1) along the first axis, without warnings for empty positions
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(valid, values, 0).sum(axis=0) / n
+        deviations = np.where(valid, values - mean, 0)
+        std = np.sqrt((deviations ** 2).sum(axis=0) / (n - 1))
+    return n, mean, np.where(n > 1, std, np.nan)
+
+
+def paired_ttest(x, y):
+    """
+    Paired t-test between x and y along the first (member) axis.
+
+    Pairs with a missing value (e.g. a member without a solution in one of
+    the conditions) are left out of each test.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        Arrays of the same shape with ensemble members along the first axis.
+        Every other position is tested independently.
+
+    Returns
+    -------
+    statistic : numpy.ndarray
+        The t statistic of each test. NaN where all differences are equal.
+    pvalue : numpy.ndarray
+        The two-sided p-value of each test.
+    """
+    differences = np.asarray(x, dtype=float) - np.asarray(y, dtype=float)
+    n, mean, std = _nan_mean_std(differences)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistic = mean / (std / np.sqrt(n))
+        statistic = np.where(np.isfinite(statistic), statistic, np.nan)
+    pvalue = 2 * stats.t.sf(np.abs(statistic), np.maximum(n - 1, 1))
+    return statistic, pvalue
+
+
+def wilcoxon_signed_rank(x, y):
+    """
+    Wilcoxon signed-rank test between x and y along the first (member) axis.
+
+    Zero differences are discarded and tied differences receive their
+    average rank, as in scipy.stats.wilcoxon. Pairs with a missing value are
+    left out of each test, as with nan_policy='omit'. p-values use the normal
+    approximation with tie correction, which is accurate for the ensemble
+    sizes medusa works with (more than ~25 members).
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        Arrays of the same shape with ensemble members along the first axis.
+        Every other position is tested independently.
+
+    Returns
+    -------
+    statistic : numpy.ndarray
+        The smaller of the sums of ranks of positive and negative
+        differences, as reported by scipy.stats.wilcoxon.
+    pvalue : numpy.ndarray
+        The two-sided p-value of each test. NaN where all differences are
+        zero or missing.
+    rank_biserial : numpy.ndarray
+        The matched-pairs rank-biserial correlation, an effect size between
+        -1 (all differences negative) and 1 (all differences positive).
+    """
+    differences = np.asarray(x, dtype=float) - np.asarray(y, dtype=float)
+    shape = differences.shape[1:]
+    differences = differences.reshape(differences.shape[0], -1)
+    ranks, tie_sizes = _average_ranks(np.abs(differences))
+    # zero differences tie for the lowest ranks; discard them and shift the
+    # remaining ranks down. Missing differences rank above all others, so
+    # they don't change the ranks of the rest and are simply discarded.
+    zero = differences == 0
+    nonzero = ~zero & ~np.isnan(differences)
+    num_zeros = zero.sum(axis=0)
+    ranks = np.where(nonzero, ranks - num_zeros, 0)
+    n = nonzero.sum(axis=0).astype(float)
+
+    positive = np.where(differences > 0, ranks, 0).sum(axis=0)
+    negative = np.where(differences < 0, ranks, 0).sum(axis=0)
+    tie_correction = np.where(nonzero, tie_sizes ** 2 - 1, 0).sum(axis=0)
+    mean = n * (n + 1) / 4
+    variance = n * (n + 1) * (2 * n + 1) / 24 - tie_correction / 48
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (positive - mean) / np.sqrt(variance)
+        rank_biserial = (positive - negative) / (positive + negative)
+    pvalue = 2 * stats.norm.sf(np.abs(z))
+    statistic = np.minimum(positive, negative)
+    return (statistic.reshape(shape), pvalue.reshape(shape),
+            rank_biserial.reshape(shape))
+
+
+def _average_ranks(values):
+    # ranks (starting at 1, ties averaged) of values along the first axis,
+    # and the size of the tie group of each value. NaN values are ranked
+    # last, each in a group of its own. Ranking is done on the
+    # transpose so that each sorted column is contiguous in memory.
+    values = np.ascontiguousarray(values.T)
+    n = values.shape[1]
+    order = np.argsort(values, axis=1)
+    ordered = np.take_along_axis(values, order, axis=1)
+    index = np.broadcast_to(np.arange(n), ordered.shape)
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ends = np.ones(ordered.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, index, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, index, n)[:, ::-1],
+                                 axis=1)[:, ::-1]
+    ranks = np.empty(values.shape)
+    tie_sizes = np.empty(values.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2. + 1, axis=1)
+    np.put_along_axis(tie_sizes, order, (last - first + 1).astype(float),
+                      axis=1)
+    return ranks.T, tie_sizes.T
+
+
+def bootstrap_ci(differences, num_bootstrap=1000, confidence=0.95,
+                 random_state=None, block_size=4096):
+    """
+    Percentile bootstrap confidence interval of the mean along the first
+    (member) axis.
+
+    The same resamples of members are used for every other position, and
+    resampled means are computed as a matrix product in blocks of
+    block_size positions to bound memory use. Missing values are left out
+    of the mean of each resample.
+
+    Parameters
+    ----------
+    differences : numpy.ndarray
+        Array with ensemble members along the first axis, e.g. paired
+        differences between two conditions.
+    num_bootstrap : int, optional
+        Number of bootstrap resamples. Default 1000.
+    confidence : float, optional
+        Confidence level of the interval. Default 0.95.
+    random_state : int or numpy.random.RandomState, optional
+        Seed or random state used to draw resamples.
+    block_size : int, optional
+        Number of positions for which resampled means are held in memory at
+        once. Default 4096.
+
+    Returns
+    -------
+    lower, upper : numpy.ndarray
+        The bounds of the interval at each position. NaN where every value
+        is missing.
+    """
+    differences = np.asarray(differences, dtype=float)
+    shape = differences.shape[1:]
+    differences = differences.reshape(differences.shape[0], -1)
+    n = differences.shape[0]
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    # each row holds how often each member is drawn in one resample
+    weights = random_state.multinomial(n, np.full(n, 1. / n),
+                                       size=num_bootstrap) / float(n)
+    percentiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+    valid = ~np.isnan(differences)
+    lower = np.full(differences.shape[1], np.nan)
+    upper = np.full(differences.shape[1], np.nan)
+    for start in range(0, differences.shape[1], block_size):
+        block = slice(start, start + block_size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = weights.dot(np.where(valid[:, block],
+                                         differences[:, block], 0)) / \
+                weights.dot(valid[:, block])
+        # resamples that only drew missing values have no mean
+        tested = valid[:, block].any(axis=0)
+        if tested.any():
+            block_lower, block_upper = np.nanpercentile(
+                means[:, tested], percentiles, axis=0)
+            lower[block][tested] = block_lower
+            upper[block][tested] = block_upper
+    return lower.reshape(shape), upper.reshape(shape)
+
+
+def adjust_pvalues(pvalues, method='fdr_bh'):
+    """
+    Corrects p-values for multiple testing.
+
+    Parameters
+    ----------
+    pvalues : numpy.ndarray
+        p-values of all tests, of any shape. NaN p-values are ignored and
+        remain NaN.
+    method : str, optional
+        'fdr_bh' (Benjamini-Hochberg false discovery rate, default),
+        'bonferroni' or 'holm'.
+
+    Returns
+    -------
+    numpy.ndarray
+        Adjusted p-values with the same shape as pvalues.
+    """
+    if method not in CORRECTION_METHODS or method is None:
+        raise ValueError("method must be one of 'fdr_bh', 'bonferroni' or "
+                         "'holm'")
+    pvalues = np.asarray(pvalues, dtype=float)
+    adjusted = np.full(pvalues.shape, np.nan)
+    tested = ~np.isnan(pvalues)
+    p = pvalues[tested]
+    m = len(p)
+    if m == 0:
+        return adjusted
+    if method == 'bonferroni':
+        result = p * m
+    else:
+        order = np.argsort(p, kind='mergesort')
+        ordered = p[order]
+        if method == 'fdr_bh':
+            result = ordered * m / np.arange(1, m + 1)
+            result = np.minimum.accumulate(result[::-1])[::-1]
+        else:
+            result = ordered * (m - np.arange(m))
+            result = np.maximum.accumulate(result)
+        unordered = np.empty(m)
+        unordered[order] = result
+        result = unordered
+    adjusted[tested] = np.minimum(result, 1)
+    return adjusted
+
+
+def compare_conditions(results, reference=None, test='wilcoxon',
+                       correction='fdr_bh', num_bootstrap=1000,
+                       confidence=0.95, random_state=None,
+                       fva_bound='maximum'):
+    """
+    Compares every condition to a reference condition for every reaction.
+
+    Each ensemble member is simulated in every condition, so each comparison
+    is a paired test on the per-member differences. All reactions and
+    conditions are tested at once. Members with a missing value in either
+    condition (e.g. no solution) are left out of that comparison.
+
+    Parameters
+    ----------
+    results : dict of str:pandas.DataFrame
+        Results for each condition, as returned by optimize_ensemble or
+        ensemble_fva. Only members and reactions present in every condition
+        are compared.
+    reference : str, optional
+        The condition the others are compared to. Defaults to the first
+        condition in results.
+    test : str, optional
+        'wilcoxon' (Wilcoxon signed-rank test, default) or 'ttest' (paired
+        t-test).
+    correction : str, optional
+        Method used to correct p-values for the number of tests performed
+        (all reactions in all conditions): 'fdr_bh' (default), 'bonferroni',
+        'holm' or None.
+    num_bootstrap : int, optional
+        Number of bootstrap resamples for the confidence interval of the mean
+        difference. If 0, no intervals are computed. Default 1000.
+    confidence : float, optional
+        Confidence level of the intervals. Default 0.95.
+    random_state : int or numpy.random.RandomState, optional
+        Seed or random state used for bootstrapping.
+    fva_bound : str, optional
+        For results from ensemble_fva, which bound of the flux ranges to
+        compare, either 'maximum' (default) or 'minimum'.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A dataframe indexed by (condition, reaction) with the mean
+        difference (condition minus reference), Cohen's d for paired samples
+        ('effect_size'), the rank-biserial correlation (Wilcoxon only), the
+        test statistic, p-value, adjusted p-value and confidence interval of
+        the mean difference.
+    """
+    if test not in ('wilcoxon', 'ttest'):
+        raise ValueError("test must be 'wilcoxon' or 'ttest'")
+    if correction not in CORRECTION_METHODS:
+        raise ValueError("correction must be one of 'fdr_bh', 'bonferroni', "
+                         "'holm' or None")
+    values, conditions, members, reactions = align_conditions(
+        results, fva_bound=fva_bound)
+    if reference is None:
+        reference = conditions[0]
+    reference_index = conditions.index(reference)
+    compared = [i for i in range(len(conditions)) if i != reference_index]
+
+    # members x conditions x reactions
+    x = values[compared].transpose(1, 0, 2)
+    y = values[reference_index][:, None, :]
+    differences = x - y
+
+    comparison = {}
+    _, comparison['mean_difference'], std = _nan_mean_std(differences)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effect_size = comparison['mean_difference'] / std
+    comparison['effect_size'] = np.where(np.isfinite(effect_size),
+                                         effect_size, np.nan)
+    if test == 'wilcoxon':
+        statistic, pvalue, rank_biserial = wilcoxon_signed_rank(
+            x, np.broadcast_to(y, x.shape))
+        comparison['rank_biserial'] = rank_biserial
+    else:
+        statistic, pvalue = paired_ttest(x, np.broadcast_to(y, x.shape))
+    comparison['statistic'] = statistic
+    comparison['pvalue'] = pvalue
+    if correction is not None:
+        comparison['adjusted_pvalue'] = adjust_pvalues(pvalue, correction)
+    if num_bootstrap:
+        comparison['ci_lower'], comparison['ci_upper'] = bootstrap_ci(
+            differences, num_bootstrap=num_bootstrap, confidence=confidence,
+            random_state=random_state)
+
+    index = pd.MultiIndex.from_product(
+        [[conditions[i] for i in compared], reactions],
+        names=['condition', 'reaction'])
+    return pd.DataFrame({key: value.ravel() for key, value
+                         in comparison.items()},
+                        index=index, columns=list(comparison.keys()))
@@ -0,0 +1,188 @@
+
+from __future__ import absolute_import
+
+import multiprocessing
+
+import numpy as np
+
+# functions for computing distances between ensemble members
+
+METRICS = ['jaccard', 'hamming']
+
+def pairwise_distances(binary_matrix, metric='jaccard', block_size=512,
+                       out=None, dtype=np.float64, num_processes=None):
+    """
+    Computes the distance between every pair of rows of a binary matrix.
+
+    Rows are bit-packed, and distances are computed for blocks of rows at a
+    time: each pair of blocks is unpacked and the number of shared ones is
+    obtained with a single matrix product. Only blocks on or above the
+    diagonal are computed, and mirrored below it.
+
+    Parameters
+    ----------
+    binary_matrix : numpy.ndarray
+        Boolean members x features matrix.
+    metric : str, optional
+        'jaccard' (default), one minus the number of shared ones over the
+        number of positions with a one in either row, or 'hamming', the
+        fraction of positions that differ.
+    block_size : int, optional
+        Number of rows compared at a time. Default 512.
+    out : str, optional
+        If provided, distances are written to a numpy.memmap at this path
+        instead of being held in memory, so matrices for very large
+        ensembles can be computed.
+    dtype : numpy dtype, optional
+        Type of the distances. Default numpy.float64.
+    num_processes : int, optional
+        An integer corresponding to the number of processes (i.e. cores) over
+        which blocks of rows are distributed. If None, one core is used.
+
+    Returns
+    -------
+    numpy.ndarray or numpy.memmap
+        Symmetric rows x rows matrix of distances.
+    """
+    if metric not in METRICS:
+        raise ValueError("metric must be 'jaccard' or 'hamming'")
+    binary_matrix = np.asarray(binary_matrix, dtype=bool)
+    num_rows, num_columns = binary_matrix.shape
+    packed = np.packbits(binary_matrix, axis=1)
+    counts = binary_matrix.sum(axis=1)
+
+    if out is not None:
+        distances = np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                              shape=(num_rows, num_rows))
+    else:
+        distances = np.empty((num_rows, num_rows), dtype=dtype)
+
+    starts = list(range(0, num_rows, block_size))
+    if num_processes is None:
+        num_processes = 1
+    # Can't have fewer blocks than processes
+    num_processes = min(num_processes, len(starts))
+    if num_processes > 1:
+        # workers write straight to the memmap if there is one; otherwise
+        # blocks are returned and written here
+        pool = multiprocessing.Pool(
+            num_processes,
+            initializer=_init_worker,
+            initargs=(packed, counts, num_columns, metric, block_size,
+                      out, dtype)
+        )
+        try:
+            for start, rows in pool.imap_unordered(_distance_worker, starts):
+                if rows is not None:
+                    _write_block(distances, start, rows)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for start in starts:
+            rows = _distance_block(packed, counts, num_columns, metric,
+                                   start, block_size, dtype)
+            _write_block(distances, start, rows)
+
+    if out is not None:
+        distances.flush()
+    return distances
+
+
+def distances_between(x, y, metric='jaccard', dtype=np.float64):
+    """
+    Computes the distance between every row of x and every row of y.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        Boolean matrices with the same number of columns.
+    metric : str, optional
+        'jaccard' (default) or 'hamming'. See pairwise_distances.
+    dtype : numpy dtype, optional
+        Type of the distances. Default numpy.float64.
+
+    Returns
+    -------
+    numpy.ndarray
+        rows of x x rows of y matrix of distances.
+    """
+    if metric not in METRICS:
+        raise ValueError("metric must be 'jaccard' or 'hamming'")
+    x = np.asarray(x, dtype=np.float32)
+    y = np.asarray(y, dtype=np.float32)
+    return _distances(x, y, x.sum(axis=1), y.sum(axis=1), x.shape[1],
+                      metric).astype(dtype, copy=False)
+
+
+def _distances(x, y, x_counts, y_counts, num_columns, metric):
+    shared = x.dot(y.T)
+    either = x_counts[:, None] + y_counts[None, :]
+    differ = either - 2 * shared
+    if metric == 'hamming':
+        return differ / float(max(num_columns, 1))
+    union = either - shared
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, differ / union, 0.)
+
+
+def _distance_block(packed, counts, num_columns, metric, start, block_size,
+                    dtype):
+    # distances from the rows in [start, start + block_size) to every row
+    # from start onwards
+    stop = min(start + block_size, packed.shape[0])
+    # unpackbits only takes count from numpy 1.17, so drop the padding bits
+    # by slicing instead
+    block = np.unpackbits(packed[start:stop],
+                          axis=1)[:, :num_columns].astype(np.float32)
+    rows = np.empty((stop - start, packed.shape[0] - start), dtype=dtype)
+    for other_start in range(start, packed.shape[0], block_size):
+        other_stop = min(other_start + block_size, packed.shape[0])
+        other = np.unpackbits(packed[other_start:other_stop],
+                              axis=1)[:, :num_columns].astype(np.float32)
+        rows[:, other_start - start:other_stop - start] = _distances(
+            block, other, counts[start:stop], counts[other_start:other_stop],
+            num_columns, metric)
+    return rows
+
+
+def _write_block(distances, start, rows):
+    stop = start + rows.shape[0]
+    distances[start:stop, start:] = rows
+    distances[start:, start:stop] = rows.T
+
+
+def _distance_worker(start):
+    global _packed
+    global _counts
+    global _num_columns
+    global _metric
+    global _block_size
+    global _out
+    global _dtype
+    rows = _distance_block(_packed, _counts, _num_columns, _metric, start,
+                           _block_size, _dtype)
+    if _out is None:
+        return start, rows
+    distances = np.load(_out, mmap_mode='r+')
+    _write_block(distances, start, rows)
+    distances.flush()
+    return start, None
+
+
+def _init_worker(packed, counts, num_columns, metric, block_size, out,
+                 dtype):
+    global _packed
+    global _counts
+    global _num_columns
+    global _metric
+    global _block_size
+    global _out
+    global _dtype
+    _packed = packed
+    _counts = counts
+    _num_columns = num_columns
+    _metric = metric
+    _block_size = block_size
+    _out = out
+    _dtype = dtype
@@ -0,0 +1,296 @@
+
+from __future__ import absolute_import
+
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from medusa.analysis.compare import _average_ranks
+
+# functions for predicting growth phenotypes with an ensemble and assessing
+# the predictions against observed phenotypes
+
+def predict_growth(ensemble, conditions, threshold=1e-6,
+                   specific_models=None, num_processes=None,
+                   return_values=False):
+    """
+    Predicts whether every member grows in every condition.
+
+    The state of each member is set once, after which the conditions are
+    simulated one after the other, changing only the medium bounds that
+    differ from the previous condition. The solver is therefore warm-started
+    from the previous solution for every condition but the first.
+
+    Parameters
+    ----------
+    ensemble : medusa.core.Ensemble
+        The ensemble to simulate. The objective of base_model (e.g. biomass)
+        is optimized in every condition.
+    conditions : dict or pandas.DataFrame
+        The medium of each condition, either as a dictionary mapping each
+        condition to a medium in the format of cobra.Model.medium
+        ({exchange reaction id: uptake bound}), or as a conditions x
+        exchange reactions dataframe of uptake bounds where missing values
+        are not in the medium. As with cobra.Model.medium, exchange
+        reactions that are not in a condition's medium are closed.
+        Exchange reactions that are absent from a member stay closed.
+    threshold : float, optional
+        The objective value above which a member grows. Default 1e-6.
+    specific_models : list of str, optional
+        Ids of the members to simulate. If None, all members are simulated.
+    num_processes : int, optional
+        An integer corresponding to the number of processes (i.e. cores)
+        over which members are distributed. If None, one core is used.
+    return_values : boolean, optional
+        Whether to return the optimal objective values instead of whether
+        they exceed threshold. Default False.
+
+    Returns
+    -------
+    pandas.DataFrame
+        members x conditions, with True where the member grows (or the
+        objective values if return_values is True; infeasible simulations
+        are NaN).
+    """
+    model = ensemble.base_model
+    if isinstance(conditions, pd.DataFrame):
+        conditions = dict((condition, row.dropna().to_dict())
+                          for condition, row in conditions.iterrows())
+    condition_ids = list(conditions)
+    # every exchange reaction, and any other reaction a medium refers to
+    reaction_ids = [rxn.id for rxn in model.exchanges]
+    for medium in conditions.values():
+        reaction_ids.extend(medium)
+    reaction_ids = list(dict.fromkeys(reaction_ids))
+    media = np.array([[conditions[condition].get(rxn_id, 0.)
+                       for rxn_id in reaction_ids]
+                      for condition in condition_ids],
+                     dtype=float).reshape(len(condition_ids),
+                                          len(reaction_ids))
+
+    if specific_models:
+        member_ids = [getattr(member, 'id', member)
+                      for member in specific_models]
+    else:
+        member_ids = [member.id for member in ensemble.members]
+    # whether each medium reaction is present in each simulated member
+    presence = ensemble.feature_matrix(kind='presence')
+    present = np.ones((len(member_ids), len(reaction_ids)), dtype=bool)
+    for column, rxn_id in enumerate(reaction_ids):
+        if rxn_id in presence.columns:
+            present[:, column] = presence.loc[member_ids, rxn_id].values
+    present = dict(zip(member_ids, present))
+
+    if num_processes is None:
+        num_processes = 1
+    # Can't have fewer ensemble members than processes
+    num_processes = min(num_processes, len(member_ids))
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(
+            num_processes,
+            initializer=_init_worker,
+            initargs=(ensemble, reaction_ids, media, present)
+        )
+        try:
+            results = dict(pool.imap_unordered(
+                _predict_worker, member_ids,
+                chunksize=max(len(member_ids) // (4 * num_processes), 1)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        with ensemble.state_guard():
+            results = dict(_predict_member(ensemble, reaction_ids, media,
+                                           present[member_id], member_id)
+                           for member_id in member_ids)
+
+    values = pd.DataFrame(np.array([results[member_id]
+                                    for member_id in member_ids]).reshape(
+                                        len(member_ids), len(condition_ids)),
+                          index=member_ids, columns=condition_ids)
+    if return_values:
+        return values
+    return values > threshold
+
+
+def _predict_member(ensemble, reaction_ids, media, present, member_id):
+    ensemble.set_state(member_id)
+    model = ensemble.base_model
+    reactions = [model.reactions.get_by_id(rxn_id) for rxn_id in reaction_ids]
+    media = np.where(present, media, 0.)
+    values = np.empty(len(media))
+    current = None
+    for row, medium in enumerate(media):
+        if current is None:
+            changed = range(len(reactions))
+        else:
+            changed = np.flatnonzero(medium != current)
+        for column in changed:
+            _set_uptake(reactions[column], medium[column])
+        current = medium
+        values[row] = model.slim_optimize(error_value=np.nan)
+    return member_id, values
+
+
+def _set_uptake(reaction, bound):
+    # as for cobra.Model.medium, the bound in the direction of uptake
+    if reaction.reactants:
+        reaction.lower_bound = -bound
+    elif reaction.products:
+        reaction.upper_bound = bound
+
+
+def _predict_worker(member_id):
+    global _ensemble
+    global _reaction_ids
+    global _media
+    global _present
+    return _predict_member(_ensemble, _reaction_ids, _media,
+                           _present[member_id], member_id)
+
+
+def _init_worker(ensemble, reaction_ids, media, present):
+    global _ensemble
+    global _reaction_ids
+    global _media
+    global _present
+    _ensemble = ensemble
+    _reaction_ids = reaction_ids
+    _media = media
+    _present = present
+
+
+def roc_auc(scores, observed):
+    """
+    Computes the area under the ROC curve of every row of scores.
+
+    The area is the probability that a randomly chosen positive condition
+    scores higher than a randomly chosen negative one (ties count half),
+    computed for all rows at once from the ranks of the scores. For binary
+    predictions it equals the mean of the sensitivity and specificity.
+
+    Parameters
+    ----------
+    scores : numpy.ndarray
+        rows x conditions matrix of predictions, e.g. members x conditions
+        growth predictions.
+    observed : numpy.ndarray
+        Boolean array with the observed phenotype of every condition.
+
+    Returns
+    -------
+    numpy.ndarray
+        The area under the curve of every row; NaN if there are no positive
+        or no negative conditions.
+    """
+    scores = np.atleast_2d(np.asarray(scores, dtype=float))
+    observed = np.asarray(observed, dtype=bool)
+    num_positive = observed.sum()
+    num_negative = len(observed) - num_positive
+    if not num_positive or not num_negative:
+        return np.full(len(scores), np.nan)
+    ranks, _ = _average_ranks(scores.T)
+    rank_sum = ranks[observed].sum(axis=0)
+    return ((rank_sum - num_positive * (num_positive + 1) / 2.) /
+            (num_positive * num_negative))
+
+
+def member_performance(growth, observed):
+    """
+    Compares the growth predictions of every member with observations.
+
+    Parameters
+    ----------
+    growth : pandas.DataFrame
+        Boolean members x conditions growth predictions, e.g. from
+        predict_growth.
+    observed : pandas.Series
+        Boolean observed growth, indexed by condition. Only conditions in
+        both growth and observed (and not missing) are compared.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by member, with the number of true and false positives and
+        negatives, the sensitivity (true positive rate), specificity (true
+        negative rate), precision, accuracy and area under the ROC curve of
+        each member's predictions.
+    """
+    predicted, observed = _align(growth, observed)
+    positive = observed[None, :]
+    counts = {'true_positives': (predicted & positive).sum(axis=1),
+              'false_positives': (predicted & ~positive).sum(axis=1),
+              'true_negatives': (~predicted & ~positive).sum(axis=1),
+              'false_negatives': (~predicted & positive).sum(axis=1)}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tp = counts['true_positives'].astype(float)
+        fp = counts['false_positives'].astype(float)
+        tn = counts['true_negatives'].astype(float)
+        fn = counts['false_negatives'].astype(float)
+        performance = pd.DataFrame(counts, index=growth.index,
+                                   columns=['true_positives',
+                                            'false_positives',
+                                            'true_negatives',
+                                            'false_negatives'])
+        performance['sensitivity'] = tp / (tp + fn)
+        performance['specificity'] = tn / (tn + fp)
+        performance['precision'] = tp / (tp + fp)
+        performance['accuracy'] = (tp + tn) / len(observed)
+    performance['auc'] = roc_auc(predicted, observed)
+    return performance
+
+
+def ensemble_roc(growth, observed):
+    """
+    Computes the ROC curve of the ensemble vote.
+
+    The vote for each condition is the fraction of members predicting
+    growth, and the curve is traced by predicting growth wherever the vote
+    is at least each distinct vote value in turn.
+
+    Parameters
+    ----------
+    growth : pandas.DataFrame
+        Boolean members x conditions growth predictions, e.g. from
+        predict_growth.
+    observed : pandas.Series
+        Boolean observed growth, indexed by condition.
+
+    Returns
+    -------
+    curve : pandas.DataFrame
+        The 'threshold' (fraction of members), 'false_positive_rate' and
+        'true_positive_rate' of each point of the curve, starting from the
+        point where no condition is predicted to grow.
+    auc : float
+        The area under the curve.
+    """
+    predicted, observed = _align(growth, observed)
+    votes = predicted.mean(axis=0)
+    order = np.argsort(-votes, kind='mergesort')
+    vote = votes[order]
+    observed_sorted = observed[order]
+    # the last condition of every group of tied votes
+    last = np.append(np.flatnonzero(np.diff(vote)), len(vote) - 1)
+    true_positives = np.cumsum(observed_sorted)[last]
+    false_positives = np.cumsum(~observed_sorted)[last]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = np.append(0, true_positives / float(observed.sum()))
+        fpr = np.append(0, false_positives / float((~observed).sum()))
+    curve = pd.DataFrame({'threshold': np.append(np.inf, vote[last]),
+                          'false_positive_rate': fpr,
+                          'true_positive_rate': tpr},
+                         columns=['threshold', 'false_positive_rate',
+                                  'true_positive_rate'])
+    return curve, roc_auc(votes, observed)[0]
+
+
+def _align(growth, observed):
+    # boolean predictions and observations for the conditions in both
+    observed = observed.dropna()
+    conditions = [condition for condition in growth.columns
+                  if condition in observed.index]
+    return (growth[conditions].values.astype(bool),
+            observed[conditions].values.astype(bool))
@@ -0,0 +1,198 @@
+
+from __future__ import absolute_import
+
+import numpy as np
+import pandas as pd
+
+from medusa.analysis.distance import distances_between
+
+# functions for choosing a few members that represent an ensemble
+
+METHODS = ['kmedoids', 'farthest_point', 'stratified']
+
+def select_representatives(vectors, k, method='kmedoids', metric='jaccard',
+                           max_iter=100, block_size=512):
+    """
+    Chooses at most k rows of a binary matrix that represent all of its rows.
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        Boolean members x features matrix.
+    k : int
+        The largest number of representatives to choose. Fewer are chosen if
+        there are fewer than k distinct rows.
+    method : str, optional
+        'kmedoids' (default) to partition the rows into k clusters that
+        minimize the distance of each row to the medoid of its cluster,
+        starting from the 'farthest_point' selection. 'farthest_point' to
+        greedily add the row farthest from all representatives chosen so
+        far, starting from the row closest to the consensus (majority) row,
+        which covers outliers. 'stratified' to split the rows into k equally
+        sized strata by their number of ones (e.g. model size) and choose
+        the medoid of each.
+    metric : str, optional
+        'jaccard' (default) or 'hamming'. See
+        medusa.analysis.distance.pairwise_distances.
+    max_iter : int, optional
+        Largest number of assignment and update rounds for 'kmedoids'.
+        Default 100.
+    block_size : int, optional
+        Number of rows compared at a time when computing medoids. Default
+        512.
+
+    Returns
+    -------
+    selected : numpy.ndarray
+        Positions of the chosen rows.
+    assignment : numpy.ndarray
+        For every row, the position in selected of the representative it is
+        assigned to.
+    distance : numpy.ndarray
+        For every row, the distance to its representative.
+    """
+    if method not in METHODS:
+        raise ValueError("method must be 'kmedoids', 'farthest_point' or "
+                         "'stratified'")
+    vectors = np.asarray(vectors, dtype=bool)
+    if k < 1 or not len(vectors):
+        raise ValueError("k and the number of rows must be at least 1")
+    k = min(k, len(vectors))
+
+    if method == 'stratified':
+        return _stratified(vectors, k, metric, block_size)
+    selected, assignment, distance = _farthest_point(vectors, k, metric)
+    if method == 'kmedoids':
+        selected, assignment, distance = _kmedoids(vectors, selected, metric,
+                                                   max_iter, block_size)
+    return selected, assignment, distance
+
+
+def summarize_coverage(vectors, selected, assignment, distance, labels=None):
+    """
+    Describes how well chosen representatives cover all rows.
+
+    Each representative is weighted by the fraction of rows assigned to it,
+    so results obtained for the representatives can be extrapolated to all
+    rows as a weighted average. The frequency errors state how far such an
+    extrapolation is from the truth for the features themselves.
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        Boolean members x features matrix.
+    selected, assignment, distance : numpy.ndarray
+        The output of select_representatives.
+    labels : list, optional
+        Label of every row, e.g. member ids. Defaults to row positions.
+
+    Returns
+    -------
+    representatives : pandas.DataFrame
+        Indexed by the labels of the representatives, with the number of
+        rows assigned to each ('cluster_size'), the fraction of rows assigned
+        to each ('weight'), and the mean and largest distance from the
+        assigned rows to the representative ('mean_distance',
+        'max_distance').
+    coverage : pandas.Series
+        'mean_distance' and 'max_distance' from every row to its
+        representative, and 'mean_frequency_error' and
+        'max_frequency_error', the mean and largest absolute difference
+        between the fraction of rows with each feature and the weighted
+        fraction of representatives with it.
+    """
+    vectors = np.asarray(vectors, dtype=bool)
+    if labels is None:
+        labels = np.arange(len(vectors))
+    labels = np.asarray(labels)
+    num_selected = len(selected)
+    sizes = np.bincount(assignment, minlength=num_selected)
+    weights = sizes / float(len(vectors))
+    total_distance = np.bincount(assignment, weights=distance,
+                                 minlength=num_selected)
+    max_distance = np.zeros(num_selected)
+    np.maximum.at(max_distance, assignment, distance)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_distance = np.where(sizes > 0, total_distance / sizes, 0.)
+    representatives = pd.DataFrame({'cluster_size': sizes,
+                                     'weight': weights,
+                                     'mean_distance': mean_distance,
+                                     'max_distance': max_distance},
+                                    index=labels[selected],
+                                    columns=['cluster_size', 'weight',
+                                             'mean_distance', 'max_distance'])
+
+    frequency = vectors.mean(axis=0)
+    estimate = weights.dot(vectors[selected])
+    error = np.abs(frequency - estimate) if vectors.shape[1] else np.zeros(1)
+    coverage = pd.Series([distance.mean(), distance.max(), error.mean(),
+                          error.max()],
+                         index=['mean_distance', 'max_distance',
+                                'mean_frequency_error',
+                                'max_frequency_error'])
+    return representatives, coverage
+
+
+def _farthest_point(vectors, k, metric):
+    consensus = vectors.mean(axis=0) >= 0.5
+    first = int(np.argmin(distances_between(consensus[None, :], vectors,
+                                            metric)[0]))
+    selected = [first]
+    distance = distances_between(vectors[[first]], vectors, metric)[0]
+    assignment = np.zeros(len(vectors), dtype=np.int64)
+    while len(selected) < k:
+        farthest = int(np.argmax(distance))
+        if distance[farthest] <= 0:
+            # every row is identical to a representative
+            break
+        new_distance = distances_between(vectors[[farthest]], vectors,
+                                         metric)[0]
+        closer = new_distance < distance
+        assignment[closer] = len(selected)
+        distance[closer] = new_distance[closer]
+        selected.append(farthest)
+    return np.array(selected), assignment, distance
+
+
+def _kmedoids(vectors, selected, metric, max_iter, block_size):
+    distances = distances_between(vectors[selected], vectors, metric)
+    assignment = distances.argmin(axis=0)
+    for _ in range(max_iter):
+        medoids = selected.copy()
+        for cluster in range(len(selected)):
+            members = np.flatnonzero(assignment == cluster)
+            if len(members):
+                medoids[cluster] = _medoid(vectors, members, metric,
+                                           block_size)
+        if (medoids == selected).all():
+            break
+        selected = medoids
+        distances = distances_between(vectors[selected], vectors, metric)
+        assignment = distances.argmin(axis=0)
+    distance = distances[assignment, np.arange(len(vectors))]
+    return selected, assignment, distance
+
+
+def _stratified(vectors, k, metric, block_size):
+    order = np.argsort(vectors.sum(axis=1), kind='mergesort')
+    strata = np.array_split(order, k)
+    selected = np.array([_medoid(vectors, stratum, metric, block_size)
+                         for stratum in strata])
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    distance = np.empty(len(vectors))
+    for i, stratum in enumerate(strata):
+        assignment[stratum] = i
+        distance[stratum] = distances_between(vectors[[selected[i]]],
+                                              vectors[stratum], metric)[0]
+    return selected, assignment, distance
+
+
+def _medoid(vectors, rows, metric, block_size):
+    # the row with the smallest total distance to the others, computed a
+    # block at a time so large clusters fit in memory
+    totals = np.empty(len(rows))
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        totals[start:start + len(block)] = distances_between(
+            vectors[block], vectors[rows], metric).sum(axis=1)
+    return rows[int(np.argmin(totals))]
@@ -1 +1,2 @@
 from medusa.core.ensemble import Ensemble
+from medusa.core.builder import EnsembleBuilder
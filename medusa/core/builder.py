@@ -0,0 +1,362 @@
+
+from __future__ import absolute_import
+
+import multiprocessing
+
+import numpy as np
+
+from cobra.io import (load_json_model, load_matlab_model, load_yaml_model,
+                      read_sbml_model)
+from cobra.util.solver import linear_reaction_coefficients
+from os.path import splitext
+
+from medusa.core.ensemble import (Ensemble, REACTION_ATTRIBUTES,
+                                  MISSING_ATTRIBUTE_DEFAULT, GPR_ATTRIBUTE,
+                                  OBJECTIVE_ATTRIBUTE, COEFFICIENT_PREFIX)
+from medusa.core.feature import Feature
+from medusa.core.storage import StateMatrix
+
+MODEL_READERS = {'.json':load_json_model,
+                 '.xml':read_sbml_model,
+                 '.sbml':read_sbml_model,
+                 '.mat':load_matlab_model,
+                 '.yml':load_yaml_model,
+                 '.yaml':load_yaml_model}
+
+class EnsembleBuilder(object):
+    """
+    Incrementally construct an ensemble from models added one at a time.
+
+    Each model is folded into the base model and the bounds, gene-reaction
+    rule, stoichiometry and objective coefficient of its reactions are
+    recorded as it is added, after which the model itself is no longer
+    needed. This allows ensembles to be built from more models than fit in
+    memory at once. Reaction attributes that vary across members become
+    features.
+
+    Parameters
+    ----------
+    identifier : string, optional
+        The identifier of the ensemble that will be built. Defaults to the id
+        of the first model added.
+    name : string, optional
+        Human-readable name for the ensemble that will be built.
+
+    Examples
+    --------
+    >>> builder = EnsembleBuilder('my_ensemble')
+    >>> builder.add_files(['model_0.json', 'model_1.json'], num_processes=2)
+    >>> builder.add_model(another_model)
+    >>> ensemble = builder.build()
+    """
+
+    def __init__(self, identifier=None, name=None):
+        self.identifier = identifier
+        self.name = name
+        self.base_model = None
+        self._reaction_index = {}
+        self._member_ids = []
+        self._member_id_set = set()
+        self._member_names = []
+        # for each member, the columns of its reactions (in increasing
+        # order) and their bounds, gene-reaction rule codes, stoichiometry
+        # codes and objective coefficients
+        self._member_reactions = []
+        # gene-reaction rules and reaction stoichiometries are stored once,
+        # and referred to by their position in these lists
+        self._rules = []
+        self._rule_codes = {}
+        self._stoichiometries = []
+        self._stoichiometry_codes = {}
+
+    def __len__(self):
+        return len(self._member_ids)
+
+    def add_model(self, model, copy=True):
+        """Add a model as a member of the ensemble.
+
+        Parameters
+        ----------
+        model : cobra.Model
+            The model to add. model.id becomes the member id.
+        copy : boolean, optional
+            Whether the reactions of model are copied before being added to
+            the base model. Set to False if model is discarded afterwards, so
+            that it does not need to be copied. Default True.
+        """
+        if model.id in self._member_id_set:
+            raise AssertionError("Ensemble members cannot have duplicate model ids.")
+
+        if self.base_model is None:
+            self.base_model = model.copy() if copy else model
+            self._reaction_index = {rxn.id:i for i, rxn
+                                    in enumerate(self.base_model.reactions)}
+        else:
+            new_reactions = [rxn for rxn in model.reactions
+                             if rxn.id not in self._reaction_index]
+            if new_reactions:
+                if copy:
+                    new_reactions = [rxn.copy() for rxn in new_reactions]
+                self.base_model.add_reactions(new_reactions)
+                for rxn in new_reactions:
+                    self._reaction_index[rxn.id] = len(self._reaction_index)
+
+        columns = np.fromiter((self._reaction_index[rxn.id]
+                               for rxn in model.reactions),
+                              dtype=np.int32, count=len(model.reactions))
+        bounds = np.array([rxn.bounds for rxn in model.reactions],
+                          dtype=float).reshape(len(model.reactions), 2)
+        rules = np.fromiter((self._rule_code(rxn.gene_reaction_rule)
+                             for rxn in model.reactions),
+                            dtype=np.int32, count=len(model.reactions))
+        stoichiometries = np.fromiter((self._stoichiometry_code(rxn)
+                                       for rxn in model.reactions),
+                                      dtype=np.int32,
+                                      count=len(model.reactions))
+        objective = dict((rxn.id, coefficient) for rxn, coefficient
+                         in linear_reaction_coefficients(model).items())
+        objective = np.array([objective.get(rxn.id, 0.)
+                              for rxn in model.reactions], dtype=float)
+        order = np.argsort(columns, kind='mergesort')
+        self._member_ids.append(model.id)
+        self._member_id_set.add(model.id)
+        self._member_names.append(model.name)
+        self._member_reactions.append((columns[order], bounds[order],
+                                       rules[order], stoichiometries[order],
+                                       objective[order]))
+
+    def _rule_code(self, rule):
+        if rule not in self._rule_codes:
+            self._rule_codes[rule] = len(self._rules)
+            self._rules.append(rule)
+        return self._rule_codes[rule]
+
+    def _stoichiometry_code(self, reaction):
+        stoichiometry = tuple(sorted((met.id, coefficient) for met, coefficient
+                                     in reaction.metabolites.items()))
+        if stoichiometry not in self._stoichiometry_codes:
+            self._stoichiometry_codes[stoichiometry] = \
+                len(self._stoichiometries)
+            self._stoichiometries.append(stoichiometry)
+            # a new stoichiometry of an existing reaction may involve
+            # metabolites that are not in the base model yet
+            missing = [met.copy() for met in reaction.metabolites
+                       if met.id not in self.base_model.metabolites]
+            if missing:
+                self.base_model.add_metabolites(missing)
+        return self._stoichiometry_codes[stoichiometry]
+
+    def add_file(self, path):
+        """Load a model from a file and add it as a member of the ensemble.
+
+        The format is determined from the file extension: .json, .xml or
+        .sbml, .mat, and .yml or .yaml are supported.
+
+        Parameters
+        ----------
+        path : str
+            Location of the model file.
+        """
+        self.add_model(_load_model(path), copy=False)
+
+    def add_files(self, paths, num_processes=None):
+        """Load models from files and add them as members of the ensemble.
+
+        Members are added in the order of paths.
+
+        Parameters
+        ----------
+        paths : list of str
+            Locations of the model files. See add_file for the supported
+            formats.
+        num_processes : int, optional
+            An integer corresponding to the number of processes (i.e. cores)
+            used to parse files. Parsed models are folded into the ensemble
+            as they arrive, so only a few are held in memory at a time. If
+            None, one core is used.
+        """
+        paths = list(paths)
+        if num_processes is None:
+            num_processes = 1
+        # Can't have fewer files than processes
+        num_processes = min(num_processes, len(paths))
+
+        if num_processes > 1:
+            pool = multiprocessing.Pool(num_processes)
+            try:
+                for model in pool.imap(_load_model, paths):
+                    self.add_model(model, copy=False)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for path in paths:
+                self.add_file(path)
+
+    def build(self):
+        """Construct the ensemble from the models added so far.
+
+        The builder's base model becomes the base_model of the ensemble
+        without being copied, so no more models should be added afterwards.
+
+        Returns
+        -------
+        medusa.core.ensemble.Ensemble
+            An ensemble with one member per added model and a feature for
+            each reaction attribute that varies across members.
+        """
+        if self.base_model is None:
+            raise ValueError("Add at least one model before building the "
+                             "ensemble")
+
+        identifier = self.identifier
+        if identifier is None:
+            identifier = self.base_model.id
+        ensemble = Ensemble(identifier=identifier, name=self.name)
+        self._populate(ensemble)
+        return ensemble
+
+    def _populate(self, ensemble, block_size=1024):
+        # members x reactions matrices of each recorded attribute are built
+        # for block_size reactions at a time, so memory does not grow with
+        # the number of members times the number of reactions. Missing
+        # reactions take MISSING_ATTRIBUTE_DEFAULT for bounds, and -1 or NaN
+        # (replaced by the base model's value) for other attributes. Bound
+        # features of reactions that are either on or off in every member
+        # are stored as bits, all other features as floats.
+        base_model = self.base_model
+        base_objective = dict((rxn.id, coefficient) for rxn, coefficient
+                              in linear_reaction_coefficients(
+                                  base_model).items())
+        reactions = sorted(base_model.reactions,
+                           key=lambda rxn: self._reaction_index[rxn.id])
+        features = []
+        dense = []
+        presence = []
+        on = {}
+        groups = []
+        def add_feature(reaction, attribute, values, categories=None):
+            feature = Feature(identifier=reaction.id + '_' + attribute,
+                              name=reaction.name,
+                              ensemble=ensemble,
+                              base_component=reaction,
+                              component_attribute=attribute)
+            if categories is not None:
+                feature._categories = categories
+            features.append(feature)
+            if values is not None:
+                dense.append(values)
+            return len(features) - 1
+
+        for start in range(0, len(reactions), block_size):
+            stop = min(start + block_size, len(reactions))
+            shape = (len(self), stop - start)
+            bounds = {attribute: np.full(shape,
+                                         MISSING_ATTRIBUTE_DEFAULT[attribute],
+                                         dtype=float)
+                      for attribute in REACTION_ATTRIBUTES}
+            rules = np.full(shape, -1, dtype=np.int32)
+            stoichiometries = np.full(shape, -1, dtype=np.int32)
+            objective = np.full(shape, np.nan)
+            for row, (columns, member_bounds, member_rules,
+                      member_stoichiometries, member_objective) in enumerate(
+                          self._member_reactions):
+                block = slice(*np.searchsorted(columns, [start, stop]))
+                block_columns = columns[block] - start
+                for i, attribute in enumerate(REACTION_ATTRIBUTES):
+                    bounds[attribute][row, block_columns] = \
+                        member_bounds[block, i]
+                rules[row, block_columns] = member_rules[block]
+                stoichiometries[row, block_columns] = \
+                    member_stoichiometries[block]
+                objective[row, block_columns] = member_objective[block]
+
+            for column, reaction in enumerate(reactions[start:stop]):
+                self._add_reaction_features(
+                    reaction, add_feature, base_objective,
+                    [bounds[attribute][:, column]
+                     for attribute in REACTION_ATTRIBUTES],
+                    rules[:, column], stoichiometries[:, column],
+                    objective[:, column], presence, on, groups)
+
+        on_values = np.zeros(len(features))
+        for position, value in on.items():
+            on_values[position] = value
+        states = StateMatrix.from_presence(
+            np.column_stack(presence) if presence else
+            np.zeros((len(self), 0), dtype=bool),
+            on_values, groups,
+            dense=np.column_stack(dense) if dense else
+            np.empty((len(self), 0)))
+        ensemble.base_model = base_model
+        ensemble._populate_from_state_matrix(features, self._member_ids,
+                                             states,
+                                             member_names=self._member_names)
+
+    def _add_reaction_features(self, reaction, add_feature, base_objective,
+                               bounds, rules, stoichiometries, objective,
+                               presence, on, groups):
+        # add the features of one reaction, given the members' values of
+        # each of its attributes
+        varying = [(attribute, values) for attribute, values
+                   in zip(REACTION_ATTRIBUTES, bounds)
+                   if (values != values[0]).any()]
+        if varying:
+            values = np.column_stack([values for _, values in varying])
+            # bounds that are either all zero or all the same "on" values
+            # are stored as one bit per member
+            present = (values != 0).any(axis=1)
+            on_values = values[np.argmax(present)]
+            packed = not np.isnan(on_values).any() and \
+                (values[present] == on_values).all()
+            positions = [add_feature(reaction, attribute,
+                                     None if packed else attribute_values)
+                         for attribute, attribute_values in varying]
+            if packed:
+                presence.append(present)
+                on.update(zip(positions, on_values))
+                groups.append(positions)
+
+        # gene-reaction rules are categories of the feature
+        base_code = self._rule_code(reaction.gene_reaction_rule)
+        used = np.unique(np.append(rules[rules >= 0], base_code))
+        if len(used) > 1:
+            codes = np.where(rules >= 0, rules, base_code)
+            add_feature(reaction, GPR_ATTRIBUTE,
+                        np.searchsorted(used, codes).astype(float),
+                        categories=[self._rules[code] for code in used])
+
+        base_value = base_objective.get(reaction.id, 0.)
+        used = np.unique(objective[~np.isnan(objective)])
+        if len(used) > 1:
+            add_feature(reaction, OBJECTIVE_ATTRIBUTE,
+                        np.where(np.isnan(objective), base_value, objective))
+        elif len(used) and used[0] != base_value:
+            # the reaction was added to the base model from a member
+            # without it in the objective
+            reaction.objective_coefficient = used[0]
+
+        # stoichiometries are features per metabolite coefficient
+        base_code = self._stoichiometry_code(reaction)
+        used = np.unique(np.append(stoichiometries[stoichiometries >= 0],
+                                   base_code))
+        if len(used) > 1:
+            codes = np.searchsorted(used, np.where(stoichiometries >= 0,
+                                                   stoichiometries,
+                                                   base_code))
+            used = [dict(self._stoichiometries[code]) for code in used]
+            metabolites = sorted(set(met for stoichiometry in used
+                                     for met in stoichiometry))
+            for met in metabolites:
+                coefficients = np.array([stoichiometry.get(met, 0.)
+                                         for stoichiometry in used])
+                if (coefficients != coefficients[0]).any():
+                    add_feature(reaction, COEFFICIENT_PREFIX + met,
+                                coefficients[codes])
+
+
+def _load_model(path):
+    extension = splitext(path)[1].lower()
+    if extension not in MODEL_READERS:
+        raise ValueError("Unsupported model file extension: " + extension)
+    return MODEL_READERS[extension](path)
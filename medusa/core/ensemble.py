@@ -9,15 +9,29 @@ from cobra.core import Reaction
 
 from medusa.core.member import Member
 from medusa.core.feature import Feature
+from medusa.core.storage import StateMatrix
+from medusa.analysis.distance import pairwise_distances
+from medusa.analysis.representatives import (select_representatives,
+                                             summarize_coverage)
 
+from contextlib import contextmanager
 from pickle import dump
 
 import cobra
 import random
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 REACTION_ATTRIBUTES = ['lower_bound', 'upper_bound']
 MISSING_ATTRIBUTE_DEFAULT = {'lower_bound':0,'upper_bound':0}
+# other attributes of reactions that can be features. Metabolite coefficients
+# are described by COEFFICIENT_PREFIX followed by the metabolite id.
+GPR_ATTRIBUTE = 'gene_reaction_rule'
+OBJECTIVE_ATTRIBUTE = 'objective_coefficient'
+COEFFICIENT_PREFIX = 'coefficient:'
+# attributes whose states are stored as codes into a list of categories
+CATEGORICAL_ATTRIBUTES = [GPR_ATTRIBUTE]
 
 class Ensemble(Object):
     """
@@ -57,13 +71,14 @@ class Ensemble(Object):
             if len([model.id for model in list_of_models]) > \
                             len(set([model.id for model in list_of_models])):
                 raise AssertionError("Ensemble members cannot have duplicate model ids.")
-            self.features = DictList()
             self._populate_features_base(list_of_models)
 
-            self.members = DictList()
-            self._populate_members(list_of_models)
-
         else:
+            self.features = DictList()
+            self.members = DictList()
+            self._state_matrix = StateMatrix(np.empty((0, 0)))
+            self._column_features = []
+            self._row_members = []
             if len(list_of_models) == 0:
                 self.base_model = Model(id_or_model=identifier+'_base_model',\
                                         name=name)
@@ -72,75 +87,877 @@ class Ensemble(Object):
                     raise AttributeError("list_of_models may only contain cobra.core.Model objects")
                 self.base_model = list_of_models[0]
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # ensembles pickled with their states in a float array
+        if isinstance(getattr(self, '_state_matrix', None), np.ndarray):
+            self._state_matrix = StateMatrix(
+                self._state_matrix,
+                groups=_reaction_groups(self._stored_features()))
+
     def _populate_features_base(self,list_of_models):
-        # Determine all reactions across all models and construct the base model
-        all_reactions = set()
-        base_model = list_of_models[0].copy()
-        all_reactions = all_reactions | set([rxn.id for rxn in base_model.reactions])
-        for model in list_of_models:
-            new_reactions = set([rxn.id for rxn in model.reactions]) - \
-                                all_reactions
-            reactions_to_add = [model.reactions.get_by_id(rxn) for rxn in new_reactions]
-            base_model.add_reactions(reactions_to_add)
-            all_reactions = all_reactions | set([rxn.id for rxn in model.reactions])
-
-        all_reactions = list(all_reactions)
-
-        # Determine reactions that vary in any model and construct a feature for
-        # each unique parameter value for that reaction in the ensemble
-        variable_reactions = []
-        for reaction in all_reactions:
-            rxn_vals = {}
-            for model in list_of_models:
-                rxn_vals[model.id] = {}
-                if reaction in [x.id for x in model.reactions]:
-                    rxn = model.reactions.get_by_id(reaction)
-                    for reaction_attribute in REACTION_ATTRIBUTES:
-                        rxn_vals[model.id][reaction_attribute] = \
-                            getattr(rxn,reaction_attribute)
-                else: # for reactions not present in this model, select the default
-                    for reaction_attribute in REACTION_ATTRIBUTES:
-                        rxn_vals[model.id][reaction_attribute] = \
-                            MISSING_ATTRIBUTE_DEFAULT[reaction_attribute]
-
-            rxn_vals = pd.DataFrame(rxn_vals).T
-            for reaction_attribute in REACTION_ATTRIBUTES:
-                if len(rxn_vals[reaction_attribute].unique()) > 1:
-                    rxn_from_base = base_model.reactions.get_by_id(reaction)
-                    feature_id = rxn_from_base.id + '_' + reaction_attribute
-                    states = rxn_vals[reaction_attribute].to_dict()
-                    #states = {model.id:rxn_vals[model.id][reaction_attribute] for model in list_of_models}
-                    feature = Feature(ensemble=self,\
-                                        identifier=feature_id,\
-                                        name=rxn_from_base.name,\
-                                        base_component=rxn_from_base,\
-                                        component_attribute=reaction_attribute,\
-                                        states=states)
-                    self.features += [feature]
-                    variable_reactions.append(reaction)
-
-        self.base_model = base_model
-
-    def _populate_members(self,list_of_models):
+        # Fold each model into the base model and state matrix, constructing
+        # a feature for each reaction attribute that varies in any model
+        from medusa.core.builder import EnsembleBuilder
+        builder = EnsembleBuilder()
         for model in list_of_models:
-            model_states = dict()
+            builder.add_model(model)
+        builder._populate(self)
+
+    def _populate_from_state_matrix(self, features, member_ids, states,
+                                    member_names=None):
+        """Set the features and members from a matrix of feature states.
+
+        The matrix becomes the ensemble's state storage; Feature.states and
+        Member.states are views of its columns and rows. The bound features
+        of reactions that are either on or off in every member are stored as
+        bits (see medusa.core.storage.StateMatrix).
+
+        Parameters
+        ----------
+        features : list of medusa.core.feature.Feature
+            Features with a base_component and component_attribute set. The
+            states of each feature are overwritten.
+        member_ids : list of str
+            Identifiers of the members, one per row of states.
+        states : numpy.ndarray or medusa.core.storage.StateMatrix
+            members x features matrix with the value of each feature in each
+            member.
+        member_names : list of str, optional
+            Names of the members, one per row of states.
+        """
+        if member_names is None:
+            member_names = member_ids
+        if isinstance(states, StateMatrix):
+            self._state_matrix = states
+        else:
+            self._state_matrix = StateMatrix(
+                np.asarray(states, dtype=float).reshape(len(member_ids),
+                                                        len(features)),
+                groups=_reaction_groups(features))
+        for column, feature in enumerate(features):
+            feature.ensemble = self
+            feature._column = column
+            feature._states = None
+        self.features = DictList(features)
+        self._column_features = list(features)
+
+        members = []
+        for row, (member_id, member_name) in enumerate(zip(member_ids,
+                                                           member_names)):
+            member = Member(ensemble=self, identifier=member_id,
+                            name=member_name)
+            member._row = row
+            members.append(member)
+        self.members = DictList(members)
+        self._row_members = list(members)
+
+    def _populate_from_presence_matrix(self, reactions, member_ids, presence,
+                                       member_names=None):
+        """Set the features and members from reaction presence/absence.
+
+        Reactions present in a member take their bounds from base_model,
+        while absent reactions take MISSING_ATTRIBUTE_DEFAULT. Only reactions
+        whose presence varies across members become features.
+
+        Parameters
+        ----------
+        reactions : list of cobra.core.reaction.Reaction
+            Reactions in base_model, one per column of presence.
+        member_ids : list of str
+            Identifiers of the members, one per row of presence.
+        presence : numpy.ndarray
+            Boolean members x reactions matrix, True where the reaction is
+            present in the member.
+        member_names : list of str, optional
+            Names of the members, one per row of presence.
+        """
+        features = []
+        present_values = []
+        groups = []
+        varies = presence.any(axis=0) & ~presence.all(axis=0)
+        for column in np.flatnonzero(varies):
+            reaction = reactions[column]
+            groups.append([])
+            for attribute in REACTION_ATTRIBUTES:
+                groups[-1].append(len(features))
+                features.append(Feature(identifier=reaction.id + '_' +
+                                            attribute,
+                                        name=reaction.name,
+                                        ensemble=self,
+                                        base_component=reaction,
+                                        component_attribute=attribute))
+                present_values.append(getattr(reaction, attribute))
+
+        if all(value == 0 for value in MISSING_ATTRIBUTE_DEFAULT.values()):
+            # absent reactions are off, so the presence matrix is stored as
+            # bits directly
+            states = StateMatrix.from_presence(presence[:, varies],
+                                               present_values, groups)
+        else:
+            missing_values = [MISSING_ATTRIBUTE_DEFAULT[attribute]
+                              for attribute in REACTION_ATTRIBUTES]
+            states = np.where(np.repeat(presence[:, varies],
+                                        len(REACTION_ATTRIBUTES), axis=1),
+                              np.array(present_values, dtype=float),
+                              np.tile(missing_values, len(groups)))
+        self._populate_from_state_matrix(features, member_ids, states,
+                                         member_names=member_names)
+
+    def set_reaction_state(self, reaction, active, members=None,
+                           bounds=None):
+        """Turn a reaction on or off in many members at once.
+
+        The states of the reaction's lower and upper bound features are set
+        in a single operation, so Feature.states and Member.states both
+        reflect the change. If the reaction is not yet a feature, features
+        are created for its bounds.
+
+        Parameters
+        ----------
+        reaction : str or cobra.core.reaction.Reaction
+            The reaction (or its id) in base_model to modify.
+        active : boolean
+            Whether the reaction should be on (True) or off (False, i.e.
+            both bounds equal to zero) in the selected members.
+        members : array-like, optional
+            The members to modify, either as a boolean mask aligned with
+            ensemble.members (a pandas.Series is aligned on member ids) or as
+            a list of Member objects or ids. If None, all members are
+            modified.
+        bounds : tuple of float, optional
+            (lower_bound, upper_bound) to use when turning the reaction on.
+            Defaults to the most common bounds of the reaction among members
+            in which it is already on, or its bounds in base_model if it is
+            on in no member.
+        """
+        reaction = self.base_model.reactions.get_by_id(
+            getattr(reaction, 'id', reaction))
+        mask = self._member_mask(members)
+        self._sync_states()
+        rows = np.fromiter((member._row for member in self.members),
+                           dtype=np.intp, count=len(self.members))[mask]
+        features = self._reaction_features(reaction)
+
+        if not active:
+            bounds = (0, 0)
+        elif bounds is None:
+            bounds = self._active_bounds(reaction, features)
+
+        columns = []
+        values = []
+        for attribute, value in zip(REACTION_ATTRIBUTES, bounds):
+            feature = features.get(attribute)
+            if feature is None:
+                if value == getattr(reaction, attribute) or not len(rows):
+                    continue
+                feature = self._add_feature(reaction, attribute)
+            columns.append(feature._column)
+            values.append(value)
+        # both bounds are set together, so a reaction stored as bits stays
+        # stored as bits when it is turned on or off
+        if columns:
+            self._state_matrix.set(rows, columns, values)
+
+    def filter_members(self, mask):
+        """Keep only the members selected by a boolean mask.
+
+        Parameters
+        ----------
+        mask : array-like
+            Boolean mask aligned with ensemble.members (a pandas.Series is
+            aligned on member ids), or a list of the Member objects or ids to
+            keep. Members that are removed no longer have states.
+        """
+        mask = self._member_mask(mask)
+        self.members = DictList(member for member, keep
+                                in zip(self.members, mask) if keep)
+        self._compact_states()
+
+    def remove_invariant_features(self):
+        """Remove features that have the same state in every member.
+
+        The shared state of each removed feature is applied to its
+        base_component in base_model, so the base model continues to represent every member.
+
+        Returns
+        -------
+        list of medusa.core.feature.Feature
+            The features that were removed.
+        """
+        states = self._aligned_state_matrix()
+        if not len(self.members):
+            return []
+        # compare against the first member; NaN states are never invariant
+        invariant = (states == states[:1]).all(axis=0)
+        removed = [feature for feature, is_invariant
+                   in zip(self.features, invariant) if is_invariant]
+        for feature, value in zip(removed, states[0, invariant]):
+            _apply_state(feature, _decode_state(feature, value))
+        if removed:
+            self.remove_features(removed)
+        return removed
+
+    def remove_features(self, features):
+        """Remove features from the ensemble.
+
+        The base_component of each feature is left unchanged in base_model.
+        Removed features keep their states, which are no longer part of any
+        member's states.
+
+        Parameters
+        ----------
+        features : list of medusa.core.feature.Feature or str
+            The features (or feature ids) to remove.
+        """
+        features = [self.features.get_by_id(feature)
+                    if isinstance(feature, str) else feature
+                    for feature in features]
+        if not features:
+            return
+        # member states are views of self.features, so removing the features
+        # also removes them from every member
+        self.features -= features
+        self._compact_states()
+
+    def _member_mask(self, members):
+        """Convert a member selection into a boolean mask over self.members.
+        """
+        if members is None:
+            return np.ones(len(self.members), dtype=bool)
+        if isinstance(members, pd.Series):
+            members = members.reindex([member.id for member
+                                       in self.members]).fillna(False)
+            return members.values.astype(bool)
+        members = np.asarray(members)
+        if members.dtype == bool:
+            if members.shape != (len(self.members),):
+                raise ValueError("Boolean member masks must have one value "
+                                 "per member in the ensemble")
+            return members
+        mask = np.zeros(len(self.members), dtype=bool)
+        for member in members:
+            mask[self.members.index(getattr(member, 'id', member))] = True
+        return mask
+
+    def _reaction_features(self, reaction):
+        # the bound features of reaction, by attribute
+        features = {}
+        for attribute in REACTION_ATTRIBUTES:
+            feature_id = reaction.id + '_' + attribute
+            if feature_id in self.features:
+                feature = self.features.get_by_id(feature_id)
+                if feature.base_component is reaction:
+                    features[attribute] = feature
+        return features
+
+    def _active_bounds(self, reaction, features):
+        # the most common bounds of reaction among members it is active in
+        bounds = []
+        for attribute in REACTION_ATTRIBUTES:
+            if attribute in features:
+                rows = np.fromiter((member._row for member in self.members),
+                                   dtype=np.intp, count=len(self.members))
+                bounds.append(self._state_matrix.get(
+                    rows, [features[attribute]._column])[:, 0])
+            else:
+                bounds.append(np.full(len(self.members),
+                                      getattr(reaction, attribute),
+                                      dtype=float))
+        bounds = np.column_stack(bounds)
+        active = bounds[(bounds != 0).any(axis=1)]
+        if len(active):
+            values, counts = np.unique(active, axis=0, return_counts=True)
+            return tuple(values[counts.argmax()].tolist())
+        bounds = tuple(getattr(reaction, attribute)
+                       for attribute in REACTION_ATTRIBUTES)
+        if all(bound == 0 for bound in bounds):
+            raise ValueError(reaction.id + " is not active in any member or "
+                             "in base_model; provide the bounds to use.")
+        return bounds
+
+    def _add_feature(self, reaction, attribute):
+        # add a feature for an attribute of reaction that is currently
+        # invariant, with every member in the base_model state
+        self._sync_states()
+        feature = Feature(identifier=reaction.id + '_' + attribute,
+                          name=reaction.name,
+                          ensemble=self,
+                          base_component=reaction,
+                          component_attribute=attribute)
+        stored_features = self._stored_features()
+        feature._column = self._state_matrix.append_column(
+            np.full(self._state_matrix.shape[0], getattr(reaction, attribute),
+                    dtype=float))
+        feature._states = None
+        self.features += [feature]
+        self._column_features = stored_features + [feature]
+        return feature
+
+    def _get_state(self, feature, member):
+        """Get the state of feature (object or id) in member (object or id).
+        """
+        if isinstance(feature, str):
+            feature = self.features.get_by_id(feature)
+        if isinstance(member, str):
+            member = self.members.get_by_id(member)
+        if feature._column is not None and member._row is not None:
+            return _decode_state(
+                feature, self._state_matrix.value(member._row,
+                                                  feature._column))
+        # fall back on the states the feature or member was created with
+        if feature._states is not None and member.id in feature._states:
+            return feature._states[member.id]
+        if member._states is not None and feature in member._states:
+            return member._states[feature]
+        raise KeyError(feature.id + ' has no state for ' + member.id)
+
+    def _set_state(self, feature, member, state):
+        """Set the state of feature (object or id) in member (object or id).
+        """
+        if isinstance(feature, str):
+            feature = self.features.get_by_id(feature)
+        if isinstance(member, str):
+            member = self.members.get_by_id(member)
+        if feature._column is not None and member._row is not None:
+            self._state_matrix.set([member._row], [feature._column],
+                                   _encode_state(feature, state))
+        elif feature._column is None:
+            if feature._states is None:
+                feature._states = {}
+            feature._states[member.id] = state
+        else:
+            if member._states is None:
+                member._states = {}
+            member._states[feature] = state
+
+    def _sync_states(self):
+        """Store the states of all features and members in _state_matrix.
+
+        Features or members added to the ensemble directly (e.g. with
+        ensemble.features += [feature]) keep their own states until they
+        are moved into the state matrix here.
+        """
+        state_matrix = getattr(self, '_state_matrix', None)
+        if state_matrix is None:
+            state_matrix = StateMatrix(np.empty((0, 0)))
+        new_features = [feature for feature in self.features
+                        if feature._column is None]
+        new_members = [member for member in self.members
+                       if member._row is None]
+        if not new_features and not new_members:
+            self._state_matrix = state_matrix
+            return
+
+        stored_members = self._stored_members()
+        stored_features = self._stored_features()
+        num_rows, num_columns = state_matrix.shape
+        expanded = np.full((num_rows + len(new_members),
+                            num_columns + len(new_features)), np.nan)
+        expanded[:num_rows, :num_columns] = state_matrix.get()
+        new_rows = {member.id:row for row, member
+                    in enumerate(new_members, num_rows)}
+        new_columns = {feature.id:column for column, feature
+                       in enumerate(new_features, num_columns)}
+        # new members and features are read through the states they were
+        # created with, before they are assigned a row or column
+        for member in new_members:
             for feature in self.features:
+                column = new_columns.get(feature.id, feature._column)
+                expanded[new_rows[member.id], column] = _encode_state(
+                    feature, self._get_state(feature, member))
+        for feature in new_features:
+            for member in self.members:
+                if member._row is not None:
+                    expanded[member._row, new_columns[feature.id]] = \
+                        _encode_state(feature,
+                                      self._get_state(feature, member))
+        for member in new_members:
+            member._row = new_rows[member.id]
+            member._states = None
+        for feature in new_features:
+            feature._column = new_columns[feature.id]
+            feature._states = None
+        self._row_members = stored_members + new_members
+        self._column_features = stored_features + new_features
+        self._state_matrix = StateMatrix(
+            expanded, groups=_reaction_groups(self._column_features))
+
+    def _stored_members(self):
+        # members with a row in _state_matrix, in row order
+        return list(getattr(self, '_row_members', None) or
+                    sorted((member for member in self.members
+                            if member._row is not None),
+                           key=lambda member: member._row))
 
-                model_states[feature] = feature.get_model_state(model.id)
-            member = Member(ensemble=self,\
-                            identifier=model.id,\
-                            name=model.name,\
-                            states=model_states)
+    def _stored_features(self):
+        # features with a column in _state_matrix, in column order
+        return list(getattr(self, '_column_features', None) or
+                    sorted((feature for feature in self.features
+                            if feature._column is not None),
+                           key=lambda feature: feature._column))
 
-            self.members += [member]
+    def _compact_states(self):
+        """Drop the states of features and members no longer in the ensemble.
+
+        _state_matrix is rebuilt in the order of self.members and
+        self.features, and bound features stored as floats are packed into
+        bits where possible. Features that were removed keep their states as
+        a dictionary; members that were removed no longer have states.
+        """
+        self._sync_states()
+        current_features = set(id(feature) for feature in self.features)
+        current_members = set(id(member) for member in self.members)
+        removed_features = [feature for feature in self._stored_features()
+                            if id(feature) not in current_features]
+        removed_members = [member for member in self._stored_members()
+                           if id(member) not in current_members]
+        if removed_features:
+            rows = np.fromiter((member._row for member in self.members),
+                               dtype=np.intp, count=len(self.members))
+            columns = [feature._column for feature in removed_features]
+            member_ids = [member.id for member in self.members]
+            removed_states = self._state_matrix.get(rows, columns)
+            for feature, states in zip(removed_features, removed_states.T):
+                feature._states = dict(zip(member_ids,
+                                           _decode_states(feature, states)))
+                feature._column = None
+        for member in removed_members:
+            member._row = None
+            member._states = None
 
+        self._state_matrix = self._state_matrix.take(
+            [member._row for member in self.members],
+            [feature._column for feature in self.features])
+        self._state_matrix.pack(_reaction_groups(self.features))
+        for row, member in enumerate(self.members):
+            member._row = row
+        for column, feature in enumerate(self.features):
+            feature._column = column
+        self._row_members = list(self.members)
+        self._column_features = list(self.features)
+
+    def _aligned_state_matrix_for(self, members, features):
+        rows = np.fromiter((member._row for member in members),
+                           dtype=np.intp, count=len(members))
+        columns = np.fromiter((feature._column for feature in features),
+                              dtype=np.intp, count=len(features))
+        return self._state_matrix.get(rows, columns)
+
+    def _aligned_state_matrix(self):
+        """Return the members x features state matrix in the order of
+        self.members and self.features.
+        """
+        self._sync_states()
+        return self._aligned_state_matrix_for(self.members, self.features)
+
+    def feature_matrix(self, kind='presence', dtype=None, output='frame'):
+        """Return the state of every variable reaction in every member.
+
+        The matrix is built directly from the ensemble's state storage, with
+        the lower and upper bound features of each reaction combined.
+
+        Parameters
+        ----------
+        kind : str, optional
+            'presence' (default) for whether each reaction is active in each
+            member, i.e. does not have both bounds equal to zero. 'bounds' for
+            the lower and upper bound of each reaction in each member.
+        dtype : numpy dtype, optional
+            Type of the returned values. Defaults to bool for 'presence' and
+            float for 'bounds'.
+        output : str, optional
+            'frame' (default) for a pandas.DataFrame indexed by member id,
+            'array' for a numpy.ndarray or 'sparse' for a
+            scipy.sparse.csr_matrix. Rows follow the order of
+            ensemble.members and columns the order in which reactions first
+            appear in ensemble.features.
+
+        Returns
+        -------
+        pandas.DataFrame, numpy.ndarray or scipy.sparse.csr_matrix
+            members x reactions for 'presence'; members x (reaction,
+            bound) for 'bounds', with the lower bound of each reaction
+            followed by its upper bound. Features that do not describe a
+            reaction bound are not included.
+        """
+        if kind not in ('presence', 'bounds'):
+            raise ValueError("kind must be 'presence' or 'bounds'")
+        if output not in ('frame', 'array', 'sparse'):
+            raise ValueError("output must be 'frame', 'array' or 'sparse'")
+
+        reactions = []
+        for feature in self.features:
+            if (isinstance(feature.base_component, Reaction) and
+                    feature.component_attribute in REACTION_ATTRIBUTES):
+                reactions.append(feature.base_component.id)
+        # unique reaction ids in order of first appearance
+        reactions = list(dict.fromkeys(reactions))
+        bounds = self._reaction_bounds(reactions, nonzero=kind == 'presence')
+
+        if kind == 'presence':
+            matrix = bounds['lower_bound'] | bounds['upper_bound']
+            labels = reactions
+        else:
+            matrix = np.empty((len(self.members), 2 * len(reactions)))
+            matrix[:, 0::2] = bounds['lower_bound']
+            matrix[:, 1::2] = bounds['upper_bound']
+            labels = pd.MultiIndex.from_product([reactions,
+                                                 REACTION_ATTRIBUTES])
+        if dtype is not None:
+            matrix = matrix.astype(dtype)
+
+        if output == 'sparse':
+            return sparse.csr_matrix(matrix)
+        elif output == 'array':
+            return matrix
+        return pd.DataFrame(matrix,
+                            index=[member.id for member in self.members],
+                            columns=labels)
+
+    def member_distances(self, metric='jaccard', on='features', fluxes=None,
+                         flux_threshold=1e-6, block_size=512, out=None,
+                         dtype=np.float64, num_processes=None):
+        """Return the distance between every pair of members.
+
+        Each member is described by a binary vector, either the presence of
+        every variable reaction or whether every reaction carries flux.
+        Vectors are bit-packed and compared in blocks; see
+        medusa.analysis.distance.pairwise_distances. The result can be used
+        for clustering or principal coordinate analysis of the ensemble.
+
+        Parameters
+        ----------
+        metric : str, optional
+            'jaccard' (default) or 'hamming'.
+        on : str, optional
+            'features' (default) to compare the reactions that are active in
+            each member (see feature_matrix), or 'fluxes' to compare the
+            reactions that carry flux in each member.
+        fluxes : pandas.DataFrame, optional
+            members x reactions fluxes used when on='fluxes', e.g. the output
+            of medusa.flux_analysis.flux_balance.optimize_ensemble. If None,
+            FBA is performed on every member to obtain them.
+        flux_threshold : float, optional
+            Smallest absolute flux considered nonzero. Default 1e-6.
+        block_size : int, optional
+            Number of members compared at a time. Default 512.
+        out : str, optional
+            If provided, distances are written to a numpy.memmap in .npy
+            format at this path instead of being held in memory, which is
+            useful for ensembles with tens of thousands of members.
+        dtype : numpy dtype, optional
+            Type of the distances. Default numpy.float64.
+        num_processes : int, optional
+            An integer corresponding to the number of processes (i.e. cores)
+            to use, both for the distance computation and for FBA if fluxes
+            are not provided. If None, one core is used.
+
+        Returns
+        -------
+        numpy.ndarray or numpy.memmap
+            Symmetric members x members matrix of distances, with rows and
+            columns in the order of ensemble.members.
+        """
+        if on == 'features':
+            vectors = self.feature_matrix(kind='presence', output='array')
+        elif on == 'fluxes':
+            if fluxes is None:
+                from medusa.flux_analysis.flux_balance import optimize_ensemble
+                fluxes = optimize_ensemble(self, num_processes=num_processes)
+            member_ids = [member.id for member in self.members]
+            missing = set(member_ids) - set(fluxes.index)
+            if missing:
+                raise ValueError("fluxes are missing for members: " +
+                                 ", ".join(sorted(missing)))
+            vectors = (fluxes.loc[member_ids].abs() > flux_threshold).values
+        else:
+            raise ValueError("on must be 'features' or 'fluxes'")
+
+        return pairwise_distances(vectors, metric=metric,
+                                  block_size=block_size, out=out, dtype=dtype,
+                                  num_processes=num_processes)
+
+    def select_representatives(self, k, method='kmedoids', metric='jaccard',
+                               max_iter=100):
+        """Choose a few members that preserve the diversity of the ensemble.
+
+        Members are compared by the reactions that are active in them (see
+        feature_matrix), and every member is assigned to its closest
+        representative. Expensive analyses can then be run on the
+        representatives only, e.g. with specific_models=
+        list(representatives.index), and extrapolated to the whole ensemble
+        by weighting each representative's result with its 'weight'.
+
+        Parameters
+        ----------
+        k : int
+            The largest number of representatives. Fewer are chosen if fewer
+            than k members differ.
+        method : str, optional
+            'kmedoids' (default), 'farthest_point' or 'stratified'. See
+            medusa.analysis.representatives.select_representatives.
+        metric : str, optional
+            'jaccard' (default) or 'hamming'.
+        max_iter : int, optional
+            Largest number of iterations for 'kmedoids'. Default 100.
+
+        Returns
+        -------
+        representatives : pandas.DataFrame
+            Indexed by the ids of the chosen members, with the number and
+            fraction of members they represent and the mean and largest
+            distance to those members.
+        coverage : pandas.Series
+            Mean and largest distance from any member to its representative,
+            and the mean and largest error in reaction presence frequencies
+            estimated from the weighted representatives.
+        """
+        vectors = self.feature_matrix(kind='presence', output='array')
+        selected, assignment, distance = select_representatives(
+            vectors, k, method=method, metric=metric, max_iter=max_iter)
+        return summarize_coverage(vectors, selected, assignment, distance,
+                                  labels=[member.id
+                                          for member in self.members])
+
+    def _reaction_bounds(self, reaction_ids, nonzero=False):
+        """Return the bounds of reactions in every member.
+
+        Starts from the invariant bounds in base_model (or
+        MISSING_ATTRIBUTE_DEFAULT for reactions not in base_model) and
+        overwrites the bounds that vary with the states of their features.
+        Only the columns of those features are read from the state storage.
+
+        Parameters
+        ----------
+        reaction_ids : list of str
+            The reactions to return bounds for.
+        nonzero : boolean, optional
+            Whether to return if each bound is nonzero instead of its value,
+            which is read directly from bits for reactions stored as bits.
+            Default False.
+
+        Returns
+        -------
+        dict
+            Maps each attribute in REACTION_ATTRIBUTES to a members x
+            reactions numpy.ndarray, in the order of self.members and
+            reaction_ids.
+        """
+        self._sync_states()
+        rows = np.fromiter((member._row for member in self.members),
+                           dtype=np.intp, count=len(self.members))
+        reaction_index = {rxn_id:i for i, rxn_id in enumerate(reaction_ids)}
+        columns = {attribute: [] for attribute in REACTION_ATTRIBUTES}
+        for feature in self.features:
+            if (isinstance(feature.base_component, Reaction) and
+                    feature.component_attribute in REACTION_ATTRIBUTES and
+                    feature.base_component.id in reaction_index):
+                columns[feature.component_attribute].append(
+                    (reaction_index[feature.base_component.id],
+                     feature._column))
+
+        bounds = {}
+        for attribute in REACTION_ATTRIBUTES:
+            values = np.array([
+                getattr(self.base_model.reactions.get_by_id(rxn_id), attribute)
+                if rxn_id in self.base_model.reactions
+                else MISSING_ATTRIBUTE_DEFAULT[attribute]
+                for rxn_id in reaction_ids], dtype=float)
+            if nonzero:
+                values = values != 0
+            values = np.tile(values, (len(self.members), 1))
+            if columns[attribute]:
+                targets, sources = zip(*columns[attribute])
+                if nonzero:
+                    values[:, list(targets)] = self._state_matrix.nonzero(
+                        rows, sources)
+                else:
+                    values[:, list(targets)] = self._state_matrix.get(
+                        rows, sources)
+            bounds[attribute] = values
+        return bounds
+
+    def merge(self, other, identifier=None, name=None):
+        """Combine the members of two ensembles into a new ensemble.
+
+        The base models are combined, features are aligned by reaction and
+        attribute, and the state matrices are stacked, so no member needs to
+        be converted to a cobra.Model. Reactions that are missing from one
+        of the base models are absent (MISSING_ATTRIBUTE_DEFAULT) in the
+        members of that ensemble. Gene-reaction rules, objective
+        coefficients and metabolite coefficients are aligned the same way,
+        and become features wherever they differ between members of the
+        merged ensemble.
+
+        Parameters
+        ----------
+        other : medusa.core.ensemble.Ensemble
+            The ensemble whose members are added. Member ids must not
+            overlap with those of this ensemble.
+        identifier : str, optional
+            Identifier of the merged ensemble. Defaults to the id of this
+            ensemble.
+        name : str, optional
+            Name of the merged ensemble. Defaults to the name of this
+            ensemble.
+
+        Returns
+        -------
+        medusa.core.ensemble.Ensemble
+            A new ensemble with the members of this ensemble followed by the
+            members of other. Neither input ensemble is modified.
+        """
+        ensembles = [self, other]
+        for ensemble in ensembles:
+            for feature in ensemble.features:
+                if not isinstance(feature.base_component, Reaction):
+                    raise NotImplementedError(
+                        "Only reaction features can be merged")
+        member_ids = [member.id for ensemble in ensembles
+                      for member in ensemble.members]
+        if len(member_ids) > len(set(member_ids)):
+            raise AssertionError("Ensemble members cannot have duplicate model ids.")
+
+        # Reactions whose bounds may differ between members of the merged
+        # ensemble: features of either ensemble, reactions in only one base
+        # model, and reactions whose invariant bounds differ between the two
+        reaction_ids = [feature.base_component.id for ensemble in ensembles
+                        for feature in ensemble.features
+                        if feature.component_attribute in
+                        REACTION_ATTRIBUTES]
+        for rxn in self.base_model.reactions:
+            if rxn.id not in other.base_model.reactions:
+                reaction_ids.append(rxn.id)
+        for rxn in other.base_model.reactions:
+            if rxn.id not in self.base_model.reactions:
+                reaction_ids.append(rxn.id)
+            elif rxn.bounds != self.base_model.reactions.get_by_id(
+                    rxn.id).bounds:
+                reaction_ids.append(rxn.id)
+        reaction_ids = list(dict.fromkeys(reaction_ids))
+
+        # Other attributes that may differ: features of either ensemble, and
+        # attributes of shared reactions that differ between the base models
+        other_attributes = [(feature.base_component.id,
+                             feature.component_attribute)
+                            for ensemble in ensembles
+                            for feature in ensemble.features
+                            if feature.component_attribute not in
+                            REACTION_ATTRIBUTES]
+        for rxn in other.base_model.reactions:
+            if rxn.id not in self.base_model.reactions:
+                continue
+            own_rxn = self.base_model.reactions.get_by_id(rxn.id)
+            metabolites = sorted(set(met.id for met in own_rxn.metabolites) |
+                                 set(met.id for met in rxn.metabolites))
+            for attribute in [GPR_ATTRIBUTE, OBJECTIVE_ATTRIBUTE] + \
+                    [COEFFICIENT_PREFIX + met for met in metabolites]:
+                if _reaction_state(own_rxn, attribute) != \
+                        _reaction_state(rxn, attribute):
+                    other_attributes.append((rxn.id, attribute))
+        other_attributes = list(dict.fromkeys(other_attributes))
+
+        bounds = [ensemble._reaction_bounds(reaction_ids)
+                  for ensemble in ensembles]
+        bounds = {attribute: np.vstack([ensemble_bounds[attribute]
+                                        for ensemble_bounds in bounds])
+                  for attribute in REACTION_ATTRIBUTES}
+
+        base_model = self.base_model.copy()
+        base_model.add_reactions([rxn.copy() for rxn
+                                  in other.base_model.reactions
+                                  if rxn.id not in base_model.reactions])
+        # metabolites that only other's members have in shared reactions
+        base_model.add_metabolites([met.copy() for met
+                                    in other.base_model.metabolites
+                                    if met.id not in base_model.metabolites])
+
+        merged = Ensemble(identifier=identifier if identifier else self.id,
+                          name=name if name else self.name)
+        merged.base_model = base_model
+        features = []
+        columns = []
+        for column, rxn_id in enumerate(reaction_ids):
+            reaction = base_model.reactions.get_by_id(rxn_id)
+            base_bounds = []
+            for attribute in REACTION_ATTRIBUTES:
+                values = bounds[attribute][:, column]
+                if (values != values[0]).any():
+                    features.append(Feature(identifier=rxn_id + '_' +
+                                                attribute,
+                                            name=reaction.name,
+                                            ensemble=merged,
+                                            base_component=reaction,
+                                            component_attribute=attribute))
+                    columns.append(values)
+                    base_bounds.append(getattr(reaction, attribute))
+                elif len(values):
+                    # invariant across all members of the merged ensemble
+                    base_bounds.append(float(values[0]))
+                else:
+                    base_bounds.append(getattr(reaction, attribute))
+            reaction.bounds = tuple(base_bounds)
+
+        # the decoded states of every feature of each ensemble, so that
+        # categorical features are aligned by category rather than by code
+        stored = []
+        for ensemble in ensembles:
+            ensemble_states = ensemble._aligned_state_matrix()
+            stored.append(dict(
+                ((feature.base_component.id, feature.component_attribute),
+                 _decode_states(feature, ensemble_states[:, column]))
+                for column, feature in enumerate(ensemble.features)))
+        for rxn_id, attribute in other_attributes:
+            reaction = base_model.reactions.get_by_id(rxn_id)
+            base_state = _reaction_state(reaction, attribute)
+            values = []
+            for ensemble, ensemble_states in zip(ensembles, stored):
+                if (rxn_id, attribute) in ensemble_states:
+                    values.extend(ensemble_states[(rxn_id, attribute)])
+                else:
+                    # reactions missing from an ensemble keep the state of
+                    # the merged base model, as they are absent anyway
+                    state = _reaction_state(
+                        ensemble.base_model.reactions.get_by_id(rxn_id),
+                        attribute) \
+                        if rxn_id in ensemble.base_model.reactions \
+                        else base_state
+                    values.extend([state] * len(ensemble.members))
+            categories = list(dict.fromkeys(values))
+            if len(categories) == 1:
+                # invariant across all members of the merged ensemble
+                _set_reaction_state(reaction, attribute, categories[0])
+                continue
+            feature = Feature(identifier=rxn_id + '_' + attribute,
+                              name=reaction.name,
+                              ensemble=merged,
+                              base_component=reaction,
+                              component_attribute=attribute)
+            if attribute in CATEGORICAL_ATTRIBUTES:
+                feature._categories = categories
+                codes = dict((category, code) for code, category
+                             in enumerate(categories))
+                values = [codes[value] for value in values]
+            features.append(feature)
+            columns.append(np.array(values, dtype=float))
+
+        states = np.column_stack(columns) if columns else \
+            np.empty((len(member_ids), 0))
+        member_names = [member.name for ensemble in ensembles
+                        for member in ensemble.members]
+        merged._populate_from_state_matrix(features, member_ids, states,
+                                           member_names=member_names)
+        return merged
 
     def set_state(self,member):
         """Set the state of the base model to represent a single member.
 
-        Sets all features to the state for the provided member. Only
-        reaction states are currently implemented (e.g. GPRs as features
-        will not work)
+        Sets all features to the state for the provided member. Features may
+        describe reaction bounds, gene-reaction rules, objective coefficients
+        or metabolite coefficients. Only states that differ from the current
+        state of base_model are applied, and the bounds and objective
+        coefficients of all reactions are each updated in one step.
 
         Parameters
         ----------
@@ -153,13 +970,78 @@ class Ensemble(Object):
         if isinstance(member, str):
             member = self.members.get_by_id(member)
 
+        self._sync_states()
+        row = self._state_matrix.row(member._row)
+        bounds = {}
+        objective = {}
         for feature in self.features:
-            if isinstance(feature.base_component, cobra.core.Reaction):
-                setattr(feature.base_component,\
-                        feature.component_attribute,\
-                        feature.states[member.id])
-            else:
+            reaction = feature.base_component
+            attribute = feature.component_attribute
+            if not isinstance(reaction, cobra.core.Reaction):
                 raise AttributeError("Only cobra.core.Reaction supported for base_component type")
+            state = _decode_state(feature, row[feature._column])
+            if attribute in REACTION_ATTRIBUTES:
+                if reaction not in bounds:
+                    bounds[reaction] = list(reaction.bounds)
+                bounds[reaction][REACTION_ATTRIBUTES.index(attribute)] = state
+            elif attribute == OBJECTIVE_ATTRIBUTE:
+                objective[reaction] = state
+            else:
+                _apply_state(feature, state)
+
+        for reaction, reaction_bounds in bounds.items():
+            reaction_bounds = tuple(reaction_bounds)
+            if reaction.bounds != reaction_bounds:
+                reaction.bounds = reaction_bounds
+        if objective:
+            coefficients = {}
+            for reaction, coefficient in objective.items():
+                coefficients[reaction.forward_variable] = coefficient
+                coefficients[reaction.reverse_variable] = -coefficient
+            self.base_model.objective.set_linear_coefficients(coefficients)
+
+    @contextmanager
+    def state_guard(self):
+        """Restore the state of base_model when leaving a block.
+
+        The bounds of all reactions, the objective and the attributes of all
+        other features are captured once on entry and restored in bulk on
+        exit, even if an exception is raised. Unlike ``with
+        ensemble.base_model:``, changes made inside the block are not
+        recorded one at a time, so memory stays constant no matter how many
+        times set_state is called.
+
+        Examples
+        --------
+        >>> with ensemble.state_guard():
+        ...     for member in ensemble.members:
+        ...         ensemble.set_state(member)
+        ...         ensemble.base_model.optimize()
+        """
+        model = self.base_model
+        reactions = list(model.reactions)
+        bounds = [reaction.bounds for reaction in reactions]
+        objective = model.solver.objective
+        direction = objective.direction
+        variables = [variable for reaction in reactions
+                     for variable in (reaction.forward_variable,
+                                      reaction.reverse_variable)]
+        coefficients = objective.get_linear_coefficients(variables)
+        others = [(feature, _model_state(feature)) for feature in self.features
+                  if feature.component_attribute not in
+                  REACTION_ATTRIBUTES + [OBJECTIVE_ATTRIBUTE]]
+        try:
+            yield self
+        finally:
+            for reaction, reaction_bounds in zip(reactions, bounds):
+                if reaction.bounds != reaction_bounds:
+                    reaction.bounds = reaction_bounds
+            if model.solver.objective is not objective:
+                model.objective = objective
+            objective.set_linear_coefficients(coefficients)
+            objective.direction = direction
+            for feature, state in others:
+                _apply_state(feature, state)
 
     def to_pickle(self, filename):
         """
@@ -200,3 +1082,74 @@ class Ensemble(Object):
 
         model = member.to_model()
         return model
+
+
+def _reaction_groups(features):
+    # positions of the bound features of each reaction, which may share bits
+    groups = {}
+    for column, feature in enumerate(features):
+        if (isinstance(feature.base_component, Reaction) and
+                feature.component_attribute in REACTION_ATTRIBUTES):
+            groups.setdefault(id(feature.base_component), []).append(column)
+    return list(groups.values())
+
+
+def _encode_state(feature, state):
+    # states of categorical features are stored as their category's position
+    if feature._categories is None:
+        if feature.component_attribute not in CATEGORICAL_ATTRIBUTES:
+            return state
+        feature._categories = []
+    if state not in feature._categories:
+        feature._categories.append(state)
+    return feature._categories.index(state)
+
+
+def _decode_state(feature, value):
+    if getattr(feature, '_categories', None) is None or np.isnan(value):
+        return value.item() if isinstance(value, np.generic) else value
+    return feature._categories[int(value)]
+
+
+def _decode_states(feature, values):
+    if getattr(feature, '_categories', None) is None:
+        return values.tolist()
+    return [_decode_state(feature, value) for value in values]
+
+
+def _model_state(feature):
+    """Return the current value of the attribute a feature describes."""
+    return _reaction_state(feature.base_component,
+                           feature.component_attribute)
+
+
+def _reaction_state(reaction, attribute):
+    """Return the current value of an attribute of reaction."""
+    if attribute.startswith(COEFFICIENT_PREFIX):
+        met_id = attribute[len(COEFFICIENT_PREFIX):]
+        return next((coefficient for met, coefficient
+                     in reaction.metabolites.items() if met.id == met_id), 0)
+    return getattr(reaction, attribute)
+
+
+def _apply_state(feature, state):
+    """Set the attribute of a feature's base_component to state."""
+    _set_reaction_state(feature.base_component, feature.component_attribute,
+                        state)
+
+
+def _set_reaction_state(reaction, attribute, state):
+    """Set an attribute of reaction to state."""
+    if attribute.startswith(COEFFICIENT_PREFIX):
+        metabolite = reaction.model.metabolites.get_by_id(
+            attribute[len(COEFFICIENT_PREFIX):])
+        if reaction.metabolites.get(metabolite, 0) != state:
+            reaction.add_metabolites({metabolite:state}, combine=False)
+    elif attribute in REACTION_ATTRIBUTES:
+        # set both bounds at once so the new bound is never inconsistent
+        # with the other one
+        bounds = list(reaction.bounds)
+        bounds[REACTION_ATTRIBUTES.index(attribute)] = state
+        reaction.bounds = tuple(bounds)
+    elif getattr(reaction, attribute) != state:
+        setattr(reaction, attribute, state)
@@ -1,6 +1,11 @@
 
 from __future__ import absolute_import
 
+try:
+    from collections.abc import Mapping
+except ImportError: # python 2
+    from collections import Mapping
+
 from cobra.core.object import Object
 
 class Feature(Object):
@@ -26,7 +31,9 @@ class Feature(Object):
     states : dictionary of string:component_attribute value
         dictionary of model ids mapping to the value of the Feature's
         component_attribute (value type depends on component_attribute type,
-        e.g. float for "lb", string for "_gene_reaction_rule")
+        e.g. float for "lb", string for "_gene_reaction_rule"). Once the
+        feature belongs to an ensemble, states is a view of the ensemble's
+        state matrix; assigning to it updates the ensemble.
 
     Attributes
     ----------
@@ -39,10 +46,61 @@ class Feature(Object):
         self.ensemble = ensemble
         self.base_component = base_component
         self.component_attribute = component_attribute
+        # column of the feature in ensemble._state_matrix, if any
+        self._column = None
+        # for categorical attributes (e.g. gene_reaction_rule), the states
+        # that the codes in ensemble._state_matrix refer to
+        self._categories = None
         self.states = states
 
+    @property
+    def states(self):
+        if self._column is None:
+            return self._states
+        return _FeatureStates(self)
+
+    @states.setter
+    def states(self, states):
+        if self._column is None:
+            self._states = states
+        else:
+            for member_id, state in states.items():
+                self.ensemble._set_state(self, member_id, state)
+
+    def __setstate__(self, state):
+        # features pickled before states were stored by the ensemble
+        if 'states' in state:
+            state['_states'] = state.pop('states')
+            state['_column'] = None
+        state.setdefault('_categories', None)
+        self.__dict__.update(state)
 
     def get_model_state(self,member_id):
         """Get the state of the feature for a particular member
         """
         return self.states[member_id]
+
+
+class _FeatureStates(Mapping):
+    """Mapping of member ids to the state of a feature in the ensemble."""
+
+    def __init__(self, feature):
+        self._feature = feature
+
+    def __getitem__(self, member_id):
+        return self._feature.ensemble._get_state(self._feature, member_id)
+
+    def __setitem__(self, member_id, state):
+        self._feature.ensemble._set_state(self._feature, member_id, state)
+
+    def __iter__(self):
+        return (member.id for member in self._feature.ensemble.members)
+
+    def __len__(self):
+        return len(self._feature.ensemble.members)
+
+    def __contains__(self, member_id):
+        return member_id in self._feature.ensemble.members
+
+    def __repr__(self):
+        return repr(dict(self))
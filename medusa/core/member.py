@@ -1,6 +1,11 @@
 
 from __future__ import absolute_import
 
+try:
+    from collections.abc import Mapping
+except ImportError: # python 2
+    from collections import Mapping
+
 from cobra.core.object import Object
 
 class Member(Object):
@@ -19,6 +24,8 @@ class Member(Object):
         dictionary of Features mapping to the value of the Feature's
         component_attribute (value type depends on component_attribute type,
         e.g. float for "lb", string for "_gene_reaction_rule") for the member.
+        Once the member belongs to an ensemble, states is a view of the
+        ensemble's state matrix; assigning to it updates the ensemble.
 
     Attributes
     ----------
@@ -28,8 +35,31 @@ class Member(Object):
     def __init__(self,ensemble=None, identifier=None, name=None, states=None):
         Object.__init__(self,identifier,name)
         self.ensemble = ensemble
+        # row of the member in ensemble._state_matrix, if any
+        self._row = None
         self.states = states
 
+    @property
+    def states(self):
+        if self._row is None:
+            return self._states
+        return _MemberStates(self)
+
+    @states.setter
+    def states(self, states):
+        if self._row is None:
+            self._states = states
+        else:
+            for feature, state in states.items():
+                self.ensemble._set_state(feature, self.id, state)
+
+    def __setstate__(self, state):
+        # members pickled before states were stored by the ensemble
+        if 'states' in state:
+            state['_states'] = state.pop('states')
+            state['_row'] = None
+        self.__dict__.update(state)
+
     def to_model(self):
         """
         Generate a cobra.Model object with the exact state of this member.
@@ -53,3 +83,28 @@ class Member(Object):
         model.remove_reactions(inactive_rxns, remove_orphans = True)
 
         return model
+
+
+class _MemberStates(Mapping):
+    """Mapping of features to their state in a member of the ensemble."""
+
+    def __init__(self, member):
+        self._member = member
+
+    def __getitem__(self, feature):
+        return self._member.ensemble._get_state(feature, self._member.id)
+
+    def __setitem__(self, feature, state):
+        self._member.ensemble._set_state(feature, self._member.id, state)
+
+    def __iter__(self):
+        return iter(self._member.ensemble.features)
+
+    def __len__(self):
+        return len(self._member.ensemble.features)
+
+    def __contains__(self, feature):
+        return feature in self._member.ensemble.features
+
+    def __repr__(self):
+        return repr(dict(self))
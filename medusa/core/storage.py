@@ -0,0 +1,276 @@
+
+from __future__ import absolute_import
+
+import numpy as np
+
+class StateMatrix(object):
+    """
+    members x features matrix of feature states.
+
+    Groups of columns (e.g. the lower and upper bound features of one
+    reaction) whose rows are all either zero or the same "on" values are
+    stored as a single bit per member, packed eight to a byte, plus the on
+    value of each column. All other columns are stored as floats. In
+    gap-filled ensembles, where every feature is a reaction bound that is
+    either its universal value or zero, this needs 1/128th of the memory of
+    a float matrix.
+
+    Columns leave their group, and are stored as floats, once they are set
+    to a value that does not fit it.
+
+    Parameters
+    ----------
+    states : numpy.ndarray
+        members x features matrix of states.
+    groups : list of lists of int, optional
+        Columns that may share a bit. Each column appears in at most one
+        group.
+    """
+
+    def __init__(self, states, groups=None):
+        states = np.array(states, dtype=float)
+        if states.ndim != 2:
+            raise ValueError("states must be a two dimensional matrix")
+        self.shape = states.shape
+        num_rows, num_columns = states.shape
+        # group of every packed column (-1 for float columns), its on
+        # value, and the position of every float column in _dense
+        self._group = np.full(num_columns, -1, dtype=np.intp)
+        self._on = np.zeros(num_columns)
+        self._dense_index = np.arange(num_columns)
+        self._dense = states
+        self._group_columns = []
+        self._bits = np.zeros((num_rows, 0), dtype=np.uint8)
+        if groups:
+            self.pack(groups)
+
+    @classmethod
+    def from_presence(cls, presence, on, groups, dense=None):
+        """Construct a StateMatrix whose grouped columns are packed.
+
+        Parameters
+        ----------
+        presence : numpy.ndarray
+            Boolean members x groups matrix, True where the columns of the
+            group take their on values.
+        on : numpy.ndarray
+            The on value of every column (ignored for columns in no group).
+        groups : list of lists of int
+            The columns of every group, one group per column of presence.
+        dense : numpy.ndarray, optional
+            members x columns matrix with the states of the columns that
+            belong to no group, in column order, which are stored as
+            floats. If None, every column must belong to a group.
+        """
+        presence = np.asarray(presence, dtype=bool)
+        on = np.asarray(on, dtype=float)
+        states = cls(np.empty((presence.shape[0], 0)))
+        states.shape = (presence.shape[0], len(on))
+        states._group = np.full(len(on), -1, dtype=np.intp)
+        states._group_columns = []
+        for group, columns in enumerate(groups):
+            columns = np.sort(np.asarray(columns, dtype=np.intp))
+            states._group[columns] = group
+            states._group_columns.append(columns)
+        ungrouped = np.flatnonzero(states._group < 0)
+        states._on = np.where(states._group >= 0, on, 0.)
+        states._dense_index = np.full(len(on), -1, dtype=np.intp)
+        if dense is None:
+            if len(ungrouped):
+                raise ValueError("every column must belong to a group")
+        else:
+            states._dense = np.ascontiguousarray(dense, dtype=float).reshape(
+                presence.shape[0], len(ungrouped))
+            states._dense_index[ungrouped] = np.arange(len(ungrouped))
+        states._bits = np.packbits(presence, axis=1)
+        return states
+
+    @property
+    def nbytes(self):
+        """Memory used by the states, in bytes."""
+        return self._bits.nbytes + self._dense.nbytes
+
+    def get(self, rows=None, columns=None):
+        """Return the states of rows in columns as a float matrix.
+
+        rows and columns are arrays of positions; None selects all of them.
+        """
+        rows, columns = self._positions(rows, columns)
+        values = np.empty((len(rows), len(columns)))
+        groups = self._group[columns]
+        packed = groups >= 0
+        if (~packed).any():
+            values[:, ~packed] = self._dense[
+                np.ix_(rows, self._dense_index[columns[~packed]])]
+        if packed.any():
+            values[:, packed] = np.where(self._presence(rows, groups[packed]),
+                                         self._on[columns[packed]], 0.)
+        return values
+
+    def nonzero(self, rows=None, columns=None):
+        """Return whether the states of rows in columns are nonzero.
+
+        Packed columns are read straight from their bits.
+        """
+        rows, columns = self._positions(rows, columns)
+        values = np.empty((len(rows), len(columns)), dtype=bool)
+        groups = self._group[columns]
+        packed = groups >= 0
+        if (~packed).any():
+            values[:, ~packed] = self._dense[
+                np.ix_(rows, self._dense_index[columns[~packed]])] != 0
+        if packed.any():
+            values[:, packed] = (self._presence(rows, groups[packed]) &
+                                 (self._on[columns[packed]] != 0))
+        return values
+
+    def row(self, row):
+        """Return the states of all columns in one row."""
+        return self.get([row])[0]
+
+    def value(self, row, column):
+        """Return the state of one column in one row."""
+        return self.get([row], [column])[0, 0]
+
+    def set(self, rows, columns, values):
+        """Set the states of rows in columns.
+
+        values is broadcast to rows x columns. Columns of a group are
+        validated together, so that e.g. both bounds of a reaction can be
+        turned off at once without leaving the group.
+        """
+        rows, columns = self._positions(rows, columns)
+        values = np.broadcast_to(np.asarray(values, dtype=float),
+                                 (len(rows), len(columns)))
+        for group in np.unique(self._group[columns]):
+            if group < 0:
+                continue
+            selected = np.flatnonzero(self._group[columns] == group)
+            group_columns = self._group_columns[group]
+            new_values = self.get(rows, group_columns)
+            positions = np.searchsorted(group_columns, columns[selected])
+            new_values[:, positions] = values[:, selected]
+            on = self._on[group_columns]
+            present = (new_values != 0).any(axis=1)
+            if (new_values[present] == on).all():
+                self._write_presence(rows, group, present)
+            else:
+                self._unpack(group)
+        dense = self._group[columns] < 0
+        if dense.any():
+            self._dense[np.ix_(rows, self._dense_index[columns[dense]])] = \
+                values[:, dense]
+
+    def append_column(self, values):
+        """Add a float column and return its position."""
+        values = np.asarray(values, dtype=float).reshape(self.shape[0], 1)
+        self._dense = np.hstack([self._dense, values])
+        self._group = np.append(self._group, -1)
+        self._on = np.append(self._on, 0.)
+        self._dense_index = np.append(self._dense_index,
+                                      self._dense.shape[1] - 1)
+        self.shape = (self.shape[0], self.shape[1] + 1)
+        return self.shape[1] - 1
+
+    def take(self, rows=None, columns=None):
+        """Return a new StateMatrix with the selected rows and columns.
+
+        Packed columns remain packed, without the states being converted to
+        floats.
+        """
+        rows, columns = self._positions(rows, columns)
+        taken = StateMatrix(np.empty((len(rows), 0)))
+        taken.shape = (len(rows), len(columns))
+        groups = self._group[columns]
+        old_groups = list(dict.fromkeys(groups[groups >= 0].tolist()))
+        new_groups = dict((old, new) for new, old in enumerate(old_groups))
+        taken._group = np.array([new_groups.get(group, -1)
+                                 for group in groups], dtype=np.intp)
+        taken._on = self._on[columns].copy()
+        taken._group_columns = [np.flatnonzero(taken._group == group)
+                                for group in range(len(old_groups))]
+        taken._bits = np.packbits(self._presence(rows, old_groups), axis=1) \
+            if old_groups else np.zeros((len(rows), 0), dtype=np.uint8)
+        dense = groups < 0
+        taken._dense = np.ascontiguousarray(
+            self._dense[np.ix_(rows, self._dense_index[columns[dense]])])
+        taken._dense_index = np.full(len(columns), -1, dtype=np.intp)
+        taken._dense_index[dense] = np.arange(dense.sum())
+        return taken
+
+    def pack(self, groups):
+        """Pack groups of float columns whose rows are all zero or on.
+
+        Groups with columns that are already packed, or whose rows do not
+        fit, are left unchanged.
+        """
+        packed = []
+        presence = []
+        for columns in groups:
+            columns = np.sort(np.asarray(columns, dtype=np.intp))
+            if not len(columns) or (self._group[columns] >= 0).any():
+                continue
+            values = self._dense[:, self._dense_index[columns]]
+            present = (values != 0).any(axis=1)
+            if not present.any():
+                continue
+            on = values[np.argmax(present)]
+            if np.isnan(on).any() or not (values[present] == on).all():
+                continue
+            packed.append((columns, on))
+            presence.append(present)
+        if not packed:
+            return
+
+        num_groups = len(self._group_columns)
+        presence = np.column_stack(presence)
+        existing = self._presence(np.arange(self.shape[0]),
+                                  np.arange(num_groups))
+        self._bits = np.packbits(np.hstack([existing, presence]), axis=1)
+        for group, (columns, on) in enumerate(packed, num_groups):
+            self._group[columns] = group
+            self._on[columns] = on
+            self._group_columns.append(columns)
+        self._compact_dense()
+
+    def _unpack(self, group):
+        # store the columns of group as floats
+        columns = self._group_columns[group]
+        values = self.get(None, columns)
+        self._dense_index[columns] = np.arange(self._dense.shape[1],
+                                               self._dense.shape[1] +
+                                               len(columns))
+        self._dense = np.hstack([self._dense, values])
+        self._group[columns] = -1
+        self._on[columns] = 0.
+        self._group_columns[group] = np.empty(0, dtype=np.intp)
+
+    def _compact_dense(self):
+        # drop float columns that have been packed
+        dense = np.flatnonzero(self._group < 0)
+        self._dense = np.ascontiguousarray(
+            self._dense[:, self._dense_index[dense]])
+        self._dense_index = np.full(self.shape[1], -1, dtype=np.intp)
+        self._dense_index[dense] = np.arange(len(dense))
+
+    def _presence(self, rows, groups):
+        # rows x groups boolean matrix read from the bits
+        groups = np.asarray(groups, dtype=np.intp)
+        shifts = (7 - (groups & 7)).astype(np.uint8)
+        return ((self._bits[np.ix_(rows, groups >> 3)] >> shifts) & 1) \
+            .astype(bool)
+
+    def _write_presence(self, rows, group, present):
+        byte = group >> 3
+        mask = np.uint8(1 << (7 - (group & 7)))
+        current = self._bits[rows, byte]
+        self._bits[rows, byte] = np.where(present, current | mask,
+                                          current & ~mask)
+
+    def _positions(self, rows, columns):
+        if rows is None:
+            rows = np.arange(self.shape[0])
+        if columns is None:
+            columns = np.arange(self.shape[1])
+        return (np.asarray(rows, dtype=np.intp).reshape(-1),
+                np.asarray(columns, dtype=np.intp).reshape(-1))
@@ -39,7 +39,7 @@ def ensemble_single_reaction_deletion(ensemble, num_models=None,
         model_list = sample(ensemble.members,num_models)
 
     deletion_results = {}
-    with ensemble.base_model:
+    with ensemble.state_guard():
         for model in model_list:
             print('performing deletions for ' + model.id)
             ensemble.set_state(model)
@@ -93,7 +93,7 @@ def ensemble_single_gene_deletion(ensemble, num_models=None,
         model_list = sample(ensemble.members,num_models)
 
     deletion_results = {}
-    with ensemble.base_model:
+    with ensemble.state_guard():
         for model in model_list:
             print('performing deletions for ' + model.id)
             ensemble.set_state(model)
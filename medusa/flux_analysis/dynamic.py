@@ -0,0 +1,191 @@
+
+from __future__ import absolute_import
+
+import multiprocessing
+
+import numpy as np
+from pandas import DataFrame
+
+from cobra import Reaction
+
+
+def ensemble_dfba(ensemble, initial_concentrations, initial_biomass,
+                  time_step, num_steps, max_uptake=10., km=0.01,
+                  specific_models=None, num_processes=None):
+    '''
+    Simulates batch culture of every member with dynamic FBA.
+
+    Each member is grown separately from the same initial culture. At every
+    time step, the uptake bounds of the substrates are set from their
+    concentrations with Michaelis-Menten kinetics, the objective (growth
+    rate) is maximized, and biomass and substrate concentrations are updated
+    assuming growth and exchange rates are constant during the step. The
+    state of each member is set once; afterwards only the substrate exchange
+    bounds change between steps, so every solve is warm-started from the
+    previous one.
+
+    Parameters
+    ----------
+    ensemble: medusa.core.Ensemble
+        The ensemble to simulate. The objective of base_model must be the
+        growth rate (e.g. the biomass reaction), and exchange reactions not
+        in initial_concentrations keep their bounds in base_model.
+        Substrate exchange reactions that are absent from a member stay
+        closed, so the member can't take up that substrate.
+    initial_concentrations: dict
+        Maps the ids of exchange reactions (or the reactions themselves) to
+        the initial concentration of their metabolite (mmol/L). Uptake
+        through each exchange reaction must be a negative flux, as for
+        boundary reactions in cobra (e.g. glc__D_e <=>).
+    initial_biomass: float
+        Initial biomass concentration (gDW/L).
+    time_step: float
+        Length of each time step (h).
+    num_steps: int
+        Number of time steps to simulate.
+    max_uptake: float or dict, optional
+        Maximum uptake rate of each substrate (mmol/gDW/h), either for all
+        substrates or as a dictionary keyed like initial_concentrations.
+        Default 10.
+    km: float or dict, optional
+        Half-saturation constant of each substrate (mmol/L). Default 0.01.
+    specific_models: list of str, optional
+        List of member.id of the members to simulate. If None, all members
+        are simulated.
+    num_processes : int, optional
+        An integer corresponding to the number of processes (i.e. cores)
+        over which members are distributed. If None, one core is used.
+
+    Returns
+    -------
+    biomass : pandas.DataFrame
+        members x time points biomass concentrations, starting at time 0.
+    concentrations : dict of pandas.DataFrame
+        For each substrate, the members x time points concentrations.
+    '''
+    substrates = [rxn.id if isinstance(rxn, Reaction) else rxn
+                  for rxn in initial_concentrations]
+    initial = np.array([initial_concentrations[rxn]
+                        for rxn in initial_concentrations], dtype=float)
+    max_uptake = _per_substrate(max_uptake, initial_concentrations)
+    km = _per_substrate(km, initial_concentrations)
+    if specific_models:
+        member_ids = [getattr(member, 'id', member)
+                      for member in specific_models]
+    else:
+        member_ids = [member.id for member in ensemble.members]
+    # whether each substrate exchange is present in each simulated member
+    presence = ensemble.feature_matrix(kind='presence')
+    present = np.ones((len(member_ids), len(substrates)), dtype=bool)
+    for column, rxn_id in enumerate(substrates):
+        if rxn_id in presence.columns:
+            present[:, column] = presence.loc[member_ids, rxn_id].values
+    present = dict(zip(member_ids, present))
+
+    if num_processes is None:
+        num_processes = 1
+    # Can't have fewer ensemble members than processes
+    num_processes = min(num_processes, len(member_ids))
+
+    settings = (substrates, initial, float(initial_biomass),
+                float(time_step), int(num_steps), max_uptake, km)
+    if num_processes > 1:
+        pool = multiprocessing.Pool(
+            num_processes,
+            initializer=_init_worker,
+            initargs=(ensemble, settings, present)
+        )
+        try:
+            results = dict(pool.imap_unordered(_dfba_worker, member_ids))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        with ensemble.state_guard():
+            results = dict(_member_dfba(ensemble, member_id,
+                                        present[member_id], *settings)
+                           for member_id in member_ids)
+
+    times = np.arange(int(num_steps) + 1) * float(time_step)
+    biomass = DataFrame(np.array([results[member_id][0]
+                                  for member_id in member_ids]).reshape(
+                                      len(member_ids), len(times)),
+                        index=member_ids, columns=times)
+    # members x time points x substrates
+    trajectories = np.array([results[member_id][1]
+                             for member_id in member_ids]).reshape(
+                                 len(member_ids), len(times),
+                                 len(substrates))
+    concentrations = dict((substrate, DataFrame(trajectories[:, :, i],
+                                                index=member_ids,
+                                                columns=times))
+                          for i, substrate in enumerate(substrates))
+    return biomass, concentrations
+
+
+def _per_substrate(values, substrates):
+    if isinstance(values, dict):
+        return np.array([values[rxn] for rxn in substrates], dtype=float)
+    return np.full(len(substrates), values, dtype=float)
+
+
+def _member_dfba(ensemble, member_id, present, substrates, initial,
+                 initial_biomass, time_step, num_steps, max_uptake, km):
+    ensemble.set_state(member_id)
+    model = ensemble.base_model
+    # exchange reactions that are absent from the member stay closed
+    reactions = [model.reactions.get_by_id(rxn)
+                 for rxn, is_present in zip(substrates, present)
+                 if is_present]
+    biomass = np.empty(num_steps + 1)
+    concentrations = np.empty((num_steps + 1, len(substrates)))
+    biomass[0] = initial_biomass
+    concentrations[0] = initial
+    for step in range(num_steps):
+        x = biomass[step]
+        c = concentrations[step]
+        # uptake is limited by the kinetics and by the amount of substrate
+        # that is left
+        uptake = max_uptake * c / (km + c)
+        if x > 0:
+            uptake = np.minimum(uptake, c / (x * time_step))
+        for reaction, bound in zip(reactions, uptake[present]):
+            reaction.lower_bound = -bound
+        growth = model.slim_optimize(error_value=np.nan)
+        if np.isnan(growth):
+            # the culture stops once e.g. the maintenance requirement can't
+            # be met
+            biomass[step + 1:] = x
+            concentrations[step + 1:] = c
+            break
+        growth = max(growth, 0.)
+        exchange = np.zeros(len(substrates))
+        exchange[present] = [reaction.flux for reaction in reactions]
+        # exact integral of the biomass over the step, given exponential
+        # growth at a constant rate
+        if growth * time_step > 1e-9:
+            factor = np.exp(growth * time_step)
+            integral = x * (factor - 1) / growth
+        else:
+            factor = 1.
+            integral = x * time_step
+        biomass[step + 1] = x * factor
+        concentrations[step + 1] = np.maximum(c + exchange * integral, 0.)
+    return member_id, (biomass, concentrations)
+
+
+def _dfba_worker(member_id):
+    global _ensemble
+    global _settings
+    global _present
+    return _member_dfba(_ensemble, member_id, _present[member_id],
+                        *_settings)
+
+
+def _init_worker(ensemble, settings, present):
+    global _ensemble
+    global _settings
+    global _present
+    _ensemble = ensemble
+    _settings = settings
+    _present = present
@@ -0,0 +1,237 @@
+
+from __future__ import absolute_import
+
+import multiprocessing
+
+import numpy as np
+from pandas import DataFrame
+
+from cobra import Reaction
+
+
+def ensemble_production_envelope(ensemble, reaction, points, objective=None,
+                                 fix=True, breakpoints=False,
+                                 specific_models=None, num_processes=None,
+                                 tolerance=1e-7, max_refinements=50):
+    '''
+    Computes the optimal objective value of every member over a range of
+    fluxes through one reaction, e.g. biomass production over a range of
+    glucose uptake rates.
+
+    The state of each member is set once, after which the points are solved
+    in increasing order, so every solve is warm-started from the previous
+    one.
+
+    The optimal objective of a linear program is a piecewise linear function
+    of a bound. With breakpoints=True, the exact function is computed for
+    every member between the smallest and largest point: the reduced cost of
+    the reaction at each point gives the slope of the function there, the
+    tangent lines of neighbouring points are intersected, and the
+    intersection is solved to confirm that it is a breakpoint (or refined
+    further if it is not).
+
+    Parameters
+    ----------
+    ensemble: medusa.core.Ensemble
+        The ensemble to simulate.
+    reaction: str or cobra.core.reaction.Reaction
+        The reaction whose flux is scanned. Uptake through an exchange
+        reaction is a negative flux, so e.g. glucose uptake rates from 0 to
+        20 are points from 0 to -20.
+    points: array-like of float
+        The fluxes through reaction at which to optimize.
+    objective: str or cobra.core.reaction.Reaction, optional
+        The reaction to maximize. If None, the objective of base_model is
+        used.
+    fix: boolean, optional
+        If True (default), the flux through reaction is fixed at each point.
+        Otherwise, only its lower bound is set to each point, i.e. uptake is
+        limited to at most the point.
+    breakpoints: boolean, optional
+        Whether to also return the exact piecewise linear function of each
+        member. Default False.
+    specific_models: list of str, optional
+        List of member.id of the members to simulate. If None, all members
+        are simulated.
+    num_processes : int, optional
+        An integer corresponding to the number of processes (i.e. cores)
+        over which members are distributed. If None, one core is used.
+    tolerance: float, optional
+        Relative tolerance when confirming breakpoints. Default 1e-7.
+    max_refinements: int, optional
+        Largest number of extra solves per interval between points when
+        computing breakpoints. Default 50.
+
+    Returns
+    -------
+    envelope : pandas.DataFrame
+        members x points optimal objective values; NaN where the problem is
+        infeasible, and for members that lack reaction.
+    vertices : dict of pandas.DataFrame
+        Only returned if breakpoints is True. For each member, the 'flux'
+        and 'objective' at the points and at every breakpoint between
+        them, in order of flux. Linear interpolation between vertices gives
+        the exact optimal objective, except across infeasible points.
+    '''
+    if isinstance(reaction, Reaction):
+        reaction = reaction.id
+    points = np.asarray(points, dtype=float).reshape(-1)
+    if specific_models:
+        member_ids = [getattr(member, 'id', member)
+                      for member in specific_models]
+    else:
+        member_ids = [member.id for member in ensemble.members]
+    # whether reaction is present in each simulated member
+    presence = ensemble.feature_matrix(kind='presence')
+    if reaction in presence.columns:
+        present = dict(zip(member_ids,
+                           presence.loc[member_ids, reaction].values))
+    else:
+        present = dict.fromkeys(member_ids, True)
+
+    if num_processes is None:
+        num_processes = 1
+    # Can't have fewer ensemble members than processes
+    num_processes = min(num_processes, len(member_ids))
+
+    settings = (reaction, points, fix, breakpoints, tolerance,
+                max_refinements)
+    with ensemble.state_guard():
+        if objective is not None:
+            ensemble.base_model.objective = objective
+        if num_processes > 1:
+            pool = multiprocessing.Pool(
+                num_processes,
+                initializer=_init_worker,
+                initargs=(ensemble, settings, present)
+            )
+            try:
+                results = dict(pool.imap_unordered(_envelope_worker,
+                                                   member_ids))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = dict(_member_envelope(ensemble, member_id,
+                                            present[member_id], *settings)
+                           for member_id in member_ids)
+
+    envelope = DataFrame(np.array([results[member_id][0]
+                                   for member_id in member_ids]).reshape(
+                                       len(member_ids), len(points)),
+                         index=member_ids, columns=points)
+    if not breakpoints:
+        return envelope
+    vertices = dict((member_id, DataFrame(results[member_id][1],
+                                          columns=['flux', 'objective']))
+                    for member_id in member_ids)
+    return envelope, vertices
+
+
+def _member_envelope(ensemble, member_id, present, reaction, points, fix,
+                     breakpoints, tolerance, max_refinements):
+    if not present:
+        # the flux through an absent reaction can only be zero
+        return member_id, (np.full(len(points), np.nan),
+                           [] if breakpoints else None)
+    ensemble.set_state(member_id)
+    reaction = ensemble.base_model.reactions.get_by_id(reaction)
+    # the scanned bounds are restored, so the next member (and the points
+    # solved without fix) start from the member's own bounds
+    bounds = reaction.bounds
+    try:
+        order = np.argsort(points, kind='mergesort')
+        values = np.empty(len(points))
+        solutions = []
+        for position in order:
+            solution = _solve(ensemble.base_model, reaction,
+                              points[position], fix, bounds)
+            values[position] = solution[0]
+            solutions.append((points[position],) + solution)
+        if not breakpoints:
+            return member_id, (values, None)
+
+        vertices = []
+        for left, right in zip(solutions[:-1], solutions[1:]):
+            vertices.append(left[:2])
+            if not np.isnan(left[1]) and not np.isnan(right[1]):
+                vertices.extend(_breakpoints(ensemble.base_model, reaction,
+                                             fix, bounds, left, right,
+                                             tolerance, max_refinements))
+        if solutions:
+            vertices.append(solutions[-1][:2])
+        return member_id, (values, vertices)
+    finally:
+        reaction.bounds = bounds
+
+
+def _breakpoints(model, reaction, fix, bounds, left, right, tolerance,
+                 max_refinements):
+    # breakpoints strictly between two solved points, given as (flux,
+    # objective, slope to the left, slope to the right). Tangent lines
+    # bound the optimal objective, which is concave (or convex when
+    # minimizing), so an intersection that lies on the function is a
+    # breakpoint joining two linear pieces.
+    found = []
+    intervals = [(left, right)]
+    refinements = 0
+    while intervals:
+        left, right = intervals.pop()
+        x_left, f_left, _, slope_left = left
+        x_right, f_right, slope_right, _ = right
+        if abs(slope_left - slope_right) <= tolerance * max(
+                1., abs(slope_left), abs(slope_right)):
+            continue
+        x = (f_right - f_left + slope_left * x_left - slope_right * x_right) \
+            / (slope_left - slope_right)
+        margin = tolerance * max(1., x_right - x_left)
+        if not x_left + margin < x < x_right - margin:
+            continue
+        if refinements >= max_refinements:
+            continue
+        refinements += 1
+        middle = (x,) + _solve(model, reaction, x, fix, bounds)
+        line = f_left + slope_left * (x - x_left)
+        if np.isnan(middle[1]):
+            continue
+        if abs(middle[1] - line) <= tolerance * max(1., abs(line)):
+            found.append(middle[:2])
+        else:
+            intervals.extend([(middle, right), (left, middle)])
+    return sorted(found)
+
+
+def _solve(model, reaction, point, fix, bounds):
+    # the optimal objective at point, and its slope to the left and right.
+    # Without fix, the lower bound is set to point and the upper bound is
+    # the member's own (bounds), unless point lies above it.
+    if fix or point > bounds[1]:
+        reaction.bounds = (point, point)
+    else:
+        reaction.bounds = (point, bounds[1])
+    value = model.slim_optimize(error_value=np.nan)
+    if np.isnan(value):
+        return value, np.nan, np.nan
+    # the flux is the forward minus the reverse variable, and only one of
+    # them is constrained by a nonzero point
+    forward = reaction.forward_variable.dual
+    reverse = -reaction.reverse_variable.dual
+    return (value, reverse if point <= 0 else forward,
+            forward if point >= 0 else reverse)
+
+
+def _envelope_worker(member_id):
+    global _ensemble
+    global _settings
+    global _present
+    return _member_envelope(_ensemble, member_id, _present[member_id],
+                            *_settings)
+
+
+def _init_worker(ensemble, settings, present):
+    global _ensemble
+    global _settings
+    global _present
+    _ensemble = ensemble
+    _settings = settings
+    _present = present
@@ -2,44 +2,118 @@
 from __future__ import absolute_import
 import multiprocessing
 
-from pandas import DataFrame
+import numpy as np
+from pandas import DataFrame, Series
+from scipy.stats import norm
 from random import sample
 
 from builtins import dict, map
 from functools import partial
 
 from cobra import Reaction
+from cobra.util.solver import assert_optimal
+from optlang.interface import OPTIMAL
 
 from medusa.core.member import Member
 
 
-def _optimize_ensemble(ensemble, return_flux, member_id, **kwargs):
+def _optimize_ensemble(ensemble, return_flux, member_id, variables=None,
+                       **kwargs):
     ensemble.set_state(member_id)
-    ensemble.base_model.optimize(**kwargs)
-    flux_dict = {rxn:ensemble.base_model.reactions.get_by_id(rxn).flux
-                        for rxn in return_flux}
-    return (member_id, flux_dict, ensemble.base_model.solver.status)
+    model = ensemble.base_model
+    if variables is None:
+        variables = _solution_variables(model, return_flux)
+    status = _slim_optimize(model, **kwargs)
+    fluxes, shadow_prices, reduced_costs = _read_solution(
+        model, status == OPTIMAL, *variables)
+    return (member_id, fluxes, shadow_prices, reduced_costs, status)
+
+
+def _solution_variables(model, return_flux, shadow_prices=False,
+                        reduced_costs=False):
+    # names of the solver variables and constraints read after every solve
+    reactions = [model.reactions.get_by_id(rxn) for rxn in return_flux]
+    metabolites = [met.id for met in model.metabolites] \
+        if shadow_prices else None
+    return ([rxn.id for rxn in reactions],
+            [rxn.reverse_id for rxn in reactions],
+            metabolites, reduced_costs)
+
+
+def _slim_optimize(model, objective_sense=None, raise_error=False):
+    # as cobra.Model.optimize, without constructing a Solution
+    original_direction = model.objective.direction
+    model.objective.direction = {"maximize": "max", "minimize": "min"}.get(
+        objective_sense, original_direction)
+    try:
+        model.slim_optimize()
+    finally:
+        model.objective.direction = original_direction
+    status = model.solver.status
+    if raise_error:
+        assert_optimal(model)
+    return status
+
+
+def _read_solution(model, optimal, forward, reverse, metabolites,
+                   reduced_costs):
+    # fluxes, shadow prices and reduced costs as float arrays, read in bulk
+    # from the solver; NaN if the solution is not optimal
+    num_metabolites = len(metabolites) if metabolites is not None else 0
+    if not optimal:
+        return (np.full(len(forward), np.nan),
+                np.full(num_metabolites, np.nan)
+                if metabolites is not None else None,
+                np.full(len(forward), np.nan) if reduced_costs else None)
+    primals = model.solver.primal_values
+    fluxes = np.array([primals[fwd] - primals[rev]
+                       for fwd, rev in zip(forward, reverse)])
+    shadow = None
+    if metabolites is not None:
+        constraint_duals = model.solver.shadow_prices
+        shadow = np.array([constraint_duals[met] for met in metabolites],
+                          dtype=float).reshape(num_metabolites)
+    reduced = None
+    if reduced_costs:
+        variable_duals = model.solver.reduced_costs
+        reduced = np.array([variable_duals[fwd] - variable_duals[rev]
+                            for fwd, rev in zip(forward, reverse)])
+    return fluxes, shadow, reduced
 
 
 def _optimize_ensemble_worker(member_id):
     global _ensemble
     global _return_flux
-    return _optimize_ensemble(_ensemble, _return_flux, member_id)
+    global _variables
+    global _kwargs
+    return _optimize_ensemble(_ensemble, _return_flux, member_id, _variables,
+                              **_kwargs)
 
 
-def _init_worker(ensemble, return_flux):
+def _init_worker(ensemble, return_flux, shadow_prices=False,
+                 reduced_costs=False, kwargs=None):
     global _ensemble
     global _return_flux
+    global _variables
+    global _kwargs
     _ensemble = ensemble
     _return_flux = return_flux
+    _kwargs = kwargs if kwargs is not None else {}
+    _variables = _solution_variables(ensemble.base_model, return_flux,
+                                 shadow_prices, reduced_costs)
 
 
 def optimize_ensemble(ensemble, return_flux = None, num_models = None,
                         specific_models = None, num_processes = None,
-                        **kwargs):
+                        return_shadow_prices = False,
+                        return_reduced_costs = False, **kwargs):
     '''
     Performs flux balance analysis (FBA) on models within an ensemble.
 
+    Fluxes, and optionally shadow prices and reduced costs, are read in bulk
+    from the solver after each solve, without constructing a cobra.Solution.
+    Models without an optimal solution have missing values.
+
     Parameters
     ----------
     ensemble: medusa.core.Ensemble
@@ -64,6 +138,15 @@ def optimize_ensemble(ensemble, return_flux = None, num_models = None,
         use. Using more cores will speed up computation, but will have a larger
         memory footprint because the ensemble object must be temporarily
         copied for each additional core used. If None, one core is used.
+    return_shadow_prices : boolean, optional
+        Whether to also return the shadow price of every metabolite in every
+        model. Default False.
+    return_reduced_costs : boolean, optional
+        Whether to also return the reduced cost of every reaction in
+        return_flux in every model. Default False.
+    **kwargs
+        Passed on to the solve of every model, as for cobra.Model.optimize
+        (objective_sense, raise_error).
 
     Returns
     -------
@@ -71,6 +154,12 @@ def optimize_ensemble(ensemble, return_flux = None, num_models = None,
         A dataframe in which each row (index) represents a model within the
         ensemble, and each column represents a reaction for which flux values
         are returned.
+    pandas.DataFrame
+        Only returned if return_shadow_prices is True. The models x
+        metabolites shadow prices.
+    pandas.DataFrame
+        Only returned if return_reduced_costs is True. The models x reactions
+        reduced costs, in the same layout as the fluxes.
     '''
     if not num_models:
         num_models = len(ensemble.members)
@@ -104,8 +193,8 @@ def optimize_ensemble(ensemble, return_flux = None, num_models = None,
     num_processes = min(num_processes, num_models)
 
     def extract_results(result_iter):
-        return {member_id:flux_dict for
-                (member_id, flux_dict, status) in result_iter}
+        return {member_id:values for (member_id, values) in
+                ((result[0], result[1:4]) for result in result_iter)}
 
     if num_processes > 1:
         # create worker
@@ -117,7 +206,8 @@ def optimize_ensemble(ensemble, return_flux = None, num_models = None,
         pool = multiprocessing.Pool(
             num_processes,
             initializer = _init_worker,
-            initargs = (ensemble, return_flux)
+            initargs = (ensemble, return_flux, return_shadow_prices,
+                        return_reduced_costs, kwargs)
         )
 
         results = extract_results(pool.imap_unordered(
@@ -129,8 +219,234 @@ def optimize_ensemble(ensemble, return_flux = None, num_models = None,
         pool.join()
     else:
         worker = _optimize_ensemble
+        variables = _solution_variables(ensemble.base_model, return_flux,
+                                    return_shadow_prices,
+                                    return_reduced_costs)
         results = extract_results(map(
-            partial(worker, ensemble, return_flux), model_list))
+            partial(worker, ensemble, return_flux, variables=variables, **kwargs),
+            model_list))
+
+    return_vals = _stack(results, model_list, 0, return_flux)
+    if not (return_shadow_prices or return_reduced_costs):
+        return return_vals
+    return_vals = [return_vals]
+    if return_shadow_prices:
+        return_vals.append(_stack(
+            results, model_list, 1,
+            [met.id for met in ensemble.base_model.metabolites]))
+    if return_reduced_costs:
+        return_vals.append(_stack(results, model_list, 2, return_flux))
+    return tuple(return_vals)
+
+
+def _stack(results, model_list, position, columns):
+    # models x columns dataframe from one of the arrays of every model
+    return DataFrame(np.array([results[member_id][position]
+                               for member_id in model_list],
+                              dtype=float).reshape(len(model_list),
+                                                   len(columns)),
+                     index=model_list, columns=columns)
+
+
+def optimize_ensemble_adaptive(ensemble, reaction, statistic='mean',
+                               tolerance=0.01, confidence=0.95, quantile=0.5,
+                               threshold=1e-6, batch_size=20,
+                               max_models=None, return_flux=None,
+                               num_processes=None, random_state=None,
+                               **kwargs):
+    '''
+    Performs FBA on randomly chosen members, in batches, until a statistic
+    of the flux through one reaction across the ensemble is known to a
+    given precision.
+
+    After each batch, a confidence interval is computed for the statistic,
+    accounting for the members sampled so far being a fraction of a finite
+    ensemble (so that the interval is empty once every member is solved).
+    Sampling stops once the half-width of the interval is at most
+    tolerance, which usually requires far fewer members than the whole
+    ensemble.
+
+    Members without an optimal solution (e.g. infeasible in the current
+    medium) are left out of the statistic, which therefore summarizes the
+    members that have a solution. They are excluded from the population in
+    the finite population correction as they are found, and their number
+    is reported in the summary.
+
+    Parameters
+    ----------
+    ensemble: medusa.core.Ensemble
+        The ensemble on which FBA is to be performed.
+    reaction: str or cobra.core.reaction.Reaction
+        The reaction whose flux is summarized, e.g. the biomass reaction.
+    statistic: str, optional
+        'mean' (default) for the mean flux, 'quantile' for the quantile of
+        the flux given by quantile, or 'fraction' for the fraction of
+        members with a flux above threshold (e.g. that grow).
+    tolerance: float, optional
+        Largest acceptable half-width of the confidence interval, in the
+        units of the statistic (flux for 'mean' and 'quantile', fraction of
+        members for 'fraction'). Default 0.01.
+    confidence: float, optional
+        Confidence level of the interval. Default 0.95.
+    quantile: float, optional
+        The quantile estimated when statistic is 'quantile'. Default 0.5.
+    threshold: float, optional
+        The flux above which a member counts when statistic is 'fraction'.
+        Default 1e-6.
+    batch_size: int, optional
+        Number of members solved between checks of the interval. Default
+        20.
+    max_models: int, optional
+        Largest number of members to solve. If None, sampling continues
+        until the tolerance is reached or every member is solved.
+    return_flux: str or list of str, optional
+        Reaction ids for which to return flux values in addition to
+        reaction. If None, only the flux through reaction is returned.
+    num_processes : int, optional
+        An integer corresponding to the number of processes (i.e. cores) to
+        use. See optimize_ensemble. If None, one core is used.
+    random_state : int, optional
+        Seed for the order in which members are sampled.
+    **kwargs
+        Passed on to the solve of every member, as for optimize_ensemble.
+
+    Returns
+    -------
+    fluxes : pandas.DataFrame
+        A dataframe in which each row (index) represents a solved member,
+        in the order they were sampled, and each column represents a
+        reaction for which flux values are returned.
+    summary : pandas.Series
+        The 'estimate' of the statistic, its confidence interval
+        ('ci_lower', 'ci_upper'), the number of members solved
+        ('num_models'), how many of them had no optimal solution
+        ('num_infeasible') and whether the tolerance was reached
+        ('converged').
+    '''
+    if statistic not in ('mean', 'quantile', 'fraction'):
+        raise ValueError("statistic must be 'mean', 'quantile' or "
+                         "'fraction'")
+    if isinstance(reaction, Reaction):
+        reaction = reaction.id
+    if return_flux is None:
+        return_flux = []
+    elif isinstance(return_flux, str):
+        return_flux = [return_flux]
+    return_flux = [rxn.id if isinstance(rxn, Reaction) else rxn
+                   for rxn in return_flux]
+    return_flux = [reaction] + [rxn for rxn in return_flux
+                                if rxn != reaction]
+
+    member_ids = [member.id for member in ensemble.members]
+    order = np.random.RandomState(random_state).permutation(len(member_ids))
+    model_list = [member_ids[i] for i in order]
+    if max_models is not None:
+        model_list = model_list[:max_models]
+    if not model_list:
+        raise ValueError("No members to solve; the ensemble must have "
+                         "members and max_models must be at least 1")
+
+    if num_processes is None:
+        num_processes = 1
+    # Can't have fewer ensemble members than processes
+    num_processes = min(num_processes, batch_size, len(model_list))
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(
+            num_processes,
+            initializer = _init_worker,
+            initargs = (ensemble, return_flux, False, False, kwargs)
+        )
+        solve = partial(pool.imap_unordered, _optimize_ensemble_worker)
+    else:
+        pool = None
+        variables = _solution_variables(ensemble.base_model, return_flux)
+        solve = partial(map, partial(_optimize_ensemble, ensemble,
+                                     return_flux, variables=variables, **kwargs))
+
+    results = {}
+    solved = []
+    values = []
+    converged = False
+    try:
+        for start in range(0, len(model_list), batch_size):
+            for member_id, fluxes, _, _, status in solve(
+                    model_list[start:start + batch_size]):
+                results[member_id] = (fluxes,)
+                solved.append(member_id)
+                values.append(fluxes[0])
+            estimate, lower, upper = _confidence_interval(
+                np.array(values, dtype=float), len(member_ids), statistic,
+                confidence, quantile, threshold)
+            if max(estimate - lower, upper - estimate) <= tolerance:
+                converged = True
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    fluxes = _stack(results, solved, 0, return_flux)
+    num_infeasible = int(np.isnan(values).sum())
+    summary = Series([estimate, lower, upper, len(solved), num_infeasible,
+                      converged],
+                     index=['estimate', 'ci_lower', 'ci_upper', 'num_models',
+                            'num_infeasible', 'converged'])
+    return fluxes, summary
+
+
+def _confidence_interval(values, population, statistic, confidence,
+                         quantile, threshold):
+    # normal approximation intervals with the finite population correction,
+    # expressed as an effective sample size that becomes infinite once the
+    # whole population is sampled. Members without a solution (NaN) are
+    # dropped from both the sample and the population.
+    infeasible = np.isnan(values)
+    values = values[~infeasible]
+    population = population - infeasible.sum()
+    n = len(values)
+    if n == 0:
+        if population <= 0:
+            return np.nan, np.nan, np.nan
+        return np.nan, -np.inf, np.inf
+    z = norm.ppf(0.5 + confidence / 2.)
+    if n >= population:
+        n_effective = np.inf
+    else:
+        n_effective = n * (population - 1.) / (population - n)
+
+    if statistic == 'fraction':
+        values = (values > threshold).astype(float)
+
+    if statistic == 'quantile':
+        estimate = np.percentile(values, 100 * quantile)
+    else:
+        estimate = values.mean()
+    if np.isinf(n_effective):
+        return estimate, estimate, estimate
+
+    if statistic == 'mean':
+        if n < 2:
+            return estimate, -np.inf, np.inf
+        half_width = z * values.std(ddof=1) / np.sqrt(n_effective)
+        return estimate, estimate - half_width, estimate + half_width
+
+    elif statistic == 'fraction':
+        # Wilson score interval, which does not collapse when all or none
+        # of the sampled members are above threshold
+        denominator = 1 + z ** 2 / n_effective
+        center = (estimate + z ** 2 / (2 * n_effective)) / denominator
+        half_width = z / denominator * np.sqrt(
+            estimate * (1 - estimate) / n_effective +
+            z ** 2 / (4 * n_effective ** 2))
+        return estimate, center - half_width, center + half_width
 
-    return_vals = DataFrame(results).transpose()
-    return return_vals
+    # distribution-free interval between order statistics whose ranks are
+    # a binomial interval around n * quantile
+    values = np.sort(values)
+    rank_width = z * np.sqrt(n * quantile * (1 - quantile) * n / n_effective)
+    lower_rank = int(np.floor(n * quantile - rank_width))
+    upper_rank = int(np.ceil(n * quantile + rank_width))
+    lower = values[min(lower_rank, n - 1)] if lower_rank >= 0 else -np.inf
+    upper = values[max(upper_rank - 1, 0)] if upper_rank <= n else np.inf
+    return estimate, min(lower, estimate), max(upper, estimate)
@@ -0,0 +1,203 @@
+
+from __future__ import absolute_import
+
+import multiprocessing
+
+import numpy as np
+from pandas import DataFrame
+
+from cobra.medium import find_boundary_types
+from optlang.interface import OPTIMAL
+from optlang.symbolics import Zero
+
+from medusa.core.ensemble import OBJECTIVE_ATTRIBUTE
+
+
+def ensemble_minimal_medium(ensemble, min_objective_value=0.1,
+                            minimize_components=False, open_exchanges=False,
+                            specific_models=None, num_processes=None):
+    '''
+    Finds the minimal medium of every member.
+
+    As for cobra.medium.minimal_medium, the minimal medium is either the one
+    requiring the smallest total import flux (a linear program), or the one
+    with the fewest components (a mixed integer program). The formulation is
+    added to base_model once per process, after which only the state of each
+    member is set before solving, instead of copying the model for every
+    member.
+
+    Parameters
+    ----------
+    ensemble: medusa.core.Ensemble
+        The ensemble to simulate.
+    min_objective_value: float, optional
+        The objective value (e.g. growth rate) of base_model that every
+        member has to achieve. Default 0.1.
+    minimize_components: boolean, optional
+        Whether to minimize the number of imported components instead of the
+        total import flux. Default False.
+    open_exchanges: boolean or float, optional
+        Whether to ignore the bounds of the exchange reactions and allow
+        every exchange reaction that is present in a member to import and
+        export up to 1000, or up to the number given. Exchange reactions
+        that are absent from a member (both bounds are zero) stay closed.
+        Default False.
+    specific_models: list of str, optional
+        List of member.id of the members to simulate. If None, all members
+        are simulated.
+    num_processes : int, optional
+        An integer corresponding to the number of processes (i.e. cores)
+        over which members are distributed. If None, one core is used.
+
+    Returns
+    -------
+    pandas.DataFrame
+        members x exchange reactions import fluxes in the minimal medium of
+        each member, which are positive for the components the member
+        requires and zero otherwise. Members that can't reach
+        min_objective_value have missing values.
+    '''
+    model = ensemble.base_model
+    if any(feature.component_attribute == OBJECTIVE_ATTRIBUTE
+           for feature in ensemble.features):
+        raise ValueError("minimal media can't be computed for ensembles "
+                         "whose members differ in their objective")
+    exchanges = [rxn.id for rxn in find_boundary_types(model, "exchange")]
+    if specific_models:
+        member_ids = [getattr(member, 'id', member)
+                      for member in specific_models]
+    else:
+        member_ids = [member.id for member in ensemble.members]
+
+    # the exchange bounds of every member, used to open the exchange
+    # reactions that are present and to size the indicator constraints
+    rows = dict((member.id, row)
+                for row, member in enumerate(ensemble.members))
+    rows = [rows[member_id] for member_id in member_ids]
+    bounds = ensemble._reaction_bounds(exchanges)
+    lower = bounds['lower_bound'][rows]
+    upper = bounds['upper_bound'][rows]
+    if open_exchanges:
+        open_bound = 1000. if isinstance(open_exchanges, bool) \
+            else float(open_exchanges)
+        present = (lower != 0) | (upper != 0)
+        lower = np.where(present, -open_bound, 0.)
+        upper = np.where(present, open_bound, 0.)
+        exchange_bounds = dict((member_id, (lower[i], upper[i]))
+                               for i, member_id in enumerate(member_ids))
+    else:
+        exchange_bounds = dict.fromkeys(member_ids)
+    big_m = max(np.abs(lower).max(initial=0.), np.abs(upper).max(initial=0.),
+                1.)
+
+    if num_processes is None:
+        num_processes = 1
+    # Can't have fewer ensemble members than processes
+    num_processes = min(num_processes, len(member_ids))
+
+    settings = (exchanges, min_objective_value, minimize_components, big_m)
+    if num_processes > 1:
+        pool = multiprocessing.Pool(
+            num_processes,
+            initializer=_init_worker,
+            initargs=(ensemble, settings, exchange_bounds)
+        )
+        try:
+            results = dict(pool.imap_unordered(_medium_worker, member_ids))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        with ensemble.state_guard():
+            formulation = _add_medium_formulation(model, *settings)
+            try:
+                results = dict(_member_medium(ensemble, member_id,
+                                              exchange_bounds[member_id],
+                                              formulation)
+                               for member_id in member_ids)
+            finally:
+                model.remove_cons_vars(formulation[0])
+
+    return DataFrame(np.array([results[member_id]
+                               for member_id in member_ids]).reshape(
+                                   len(member_ids), len(exchanges)),
+                     index=member_ids, columns=exchanges)
+
+
+def _add_medium_formulation(model, exchanges, min_objective_value,
+                            minimize_components, big_m):
+    # replace the objective with the minimal medium objective, constraining
+    # the original objective to at least min_objective_value. Returns the
+    # added variables and constraints, the exchange reactions, and the names
+    # of their import and export variables read after every solve.
+    prob = model.problem
+    added = [prob.Constraint(model.objective.expression,
+                             lb=min_objective_value,
+                             name="medium_obj_constraint")]
+    model.objective = Zero
+    coefficients = {}
+    reactions = [model.reactions.get_by_id(rxn_id) for rxn_id in exchanges]
+    forward = []
+    reverse = []
+    for reaction in reactions:
+        # import is the reverse direction of exchanges that consume the
+        # metabolite, as for cobra.medium.minimal_medium
+        if len(reaction.reactants) == 1:
+            imports, exports = (reaction.reverse_variable,
+                                reaction.forward_variable)
+        else:
+            imports, exports = (reaction.forward_variable,
+                                reaction.reverse_variable)
+        forward.append(imports.name)
+        reverse.append(exports.name)
+        if minimize_components:
+            indicator = prob.Variable("ind_" + reaction.id, lb=0, ub=1,
+                                      type="binary")
+            added.extend([indicator,
+                          prob.Constraint(imports - indicator * big_m, ub=0,
+                                          name="ind_constraint_" +
+                                          reaction.id)])
+            coefficients[indicator] = 1
+        else:
+            coefficients[imports] = 1
+    model.add_cons_vars(added)
+    model.solver.update()
+    model.objective.set_linear_coefficients(coefficients)
+    model.objective.direction = "min"
+    return added, reactions, forward, reverse
+
+
+def _member_medium(ensemble, member_id, exchange_bounds, formulation):
+    ensemble.set_state(member_id)
+    model = ensemble.base_model
+    _, reactions, forward, reverse = formulation
+    if exchange_bounds is not None:
+        for reaction, lower, upper in zip(reactions, *exchange_bounds):
+            if reaction.bounds != (lower, upper):
+                reaction.bounds = (lower, upper)
+    model.slim_optimize()
+    if model.solver.status != OPTIMAL:
+        return member_id, np.full(len(forward), np.nan)
+    primals = model.solver.primal_values
+    imports = np.array([primals[fwd] - primals[rev]
+                        for fwd, rev in zip(forward, reverse)])
+    tolerance = model.solver.configuration.tolerances.feasibility
+    imports[imports < tolerance] = 0.
+    return member_id, imports
+
+
+def _medium_worker(member_id):
+    global _ensemble
+    global _exchange_bounds
+    global _formulation
+    return _member_medium(_ensemble, member_id, _exchange_bounds[member_id],
+                          _formulation)
+
+
+def _init_worker(ensemble, settings, exchange_bounds):
+    global _ensemble
+    global _exchange_bounds
+    global _formulation
+    _ensemble = ensemble
+    _exchange_bounds = exchange_bounds
+    _formulation = _add_medium_formulation(ensemble.base_model, *settings)
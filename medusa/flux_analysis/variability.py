@@ -67,7 +67,7 @@ def ensemble_fva(ensemble, reaction_list, num_models=[],specific_models=None,
     else:
         model_list = sample(ensemble.members,num_models)
         model_list = [model.id for model in model_list]
-    with ensemble.base_model:
+    with ensemble.state_guard():
         for model in model_list:
             ensemble.set_state(model)
             fva_result = flux_variability_analysis(
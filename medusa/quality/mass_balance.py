@@ -1,4 +1,246 @@
 
+from __future__ import absolute_import
+
+import re
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from cobra.core import Reaction
+from cobra.util.solver import linear_reaction_coefficients
+
+from medusa.core.ensemble import Ensemble
+from medusa.flux_analysis.flux_balance import optimize_ensemble
+
+# functions for checking the mass and charge balance of reactions
+
+# an element followed by an optional integer or decimal count (e.g. C6,
+# H12, Fe0.5); a bare "." is not a count
+ELEMENT_RE = re.compile(r"([A-Z][a-z]*)([0-9]+(?:\.[0-9]+)?)?")
+FORMULA_RE = re.compile(r"(?:[A-Z][a-z]*(?:[0-9]+(?:\.[0-9]+)?)?)+")
+
+def element_matrix(metabolites):
+    """
+    Parses the formula of every metabolite into an element x metabolite
+    matrix.
+
+    Each distinct formula is parsed once, so metabolites that share a
+    formula (e.g. the same compound in different compartments) are cheap.
+
+    Parameters
+    ----------
+    metabolites : list of cobra.core.metabolite.Metabolite
+        The metabolites to parse, e.g. model.metabolites.
+
+    Returns
+    -------
+    elements : list of str
+        The elements found in any formula, one per row of the matrix.
+    matrix : scipy.sparse.csr_matrix
+        element x metabolite matrix with the number of atoms of each element
+        in each metabolite.
+    known : numpy.ndarray
+        Boolean array, True for metabolites with a formula that could be
+        parsed. Columns of unknown metabolites are empty.
+    """
+    parsed = {}
+    element_index = {}
+    rows = []
+    columns = []
+    counts = []
+    known = np.zeros(len(metabolites), dtype=bool)
+    for column, metabolite in enumerate(metabolites):
+        formula = metabolite.formula
+        if not formula:
+            continue
+        if formula not in parsed:
+            if FORMULA_RE.fullmatch(formula) is None:
+                parsed[formula] = None
+            else:
+                composition = {}
+                for element, count in ELEMENT_RE.findall(formula):
+                    composition[element] = (composition.get(element, 0) +
+                                            (float(count) if count else 1.))
+                parsed[formula] = composition
+        composition = parsed[formula]
+        if composition is None:
+            continue
+        known[column] = True
+        for element, count in composition.items():
+            if element not in element_index:
+                element_index[element] = len(element_index)
+            rows.append(element_index[element])
+            columns.append(column)
+            counts.append(count)
+
+    elements = sorted(element_index, key=element_index.get)
+    matrix = sparse.csr_matrix((counts, (rows, columns)),
+                               shape=(len(elements), len(metabolites)))
+    return elements, matrix, known
+
+
+def stoichiometric_matrix(model):
+    """
+    Builds the sparse metabolite x reaction stoichiometric matrix of model.
+
+    Parameters
+    ----------
+    model : cobra.Model
+        The model to build the matrix for.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+        metabolite x reaction matrix, with rows in the order of
+        model.metabolites and columns in the order of model.reactions.
+    """
+    metabolite_index = {met.id:i for i, met in enumerate(model.metabolites)}
+    rows = []
+    columns = []
+    coefficients = []
+    for column, reaction in enumerate(model.reactions):
+        for metabolite, coefficient in reaction.metabolites.items():
+            rows.append(metabolite_index[metabolite.id])
+            columns.append(column)
+            coefficients.append(coefficient)
+    return sparse.csc_matrix((coefficients, (rows, columns)),
+                             shape=(len(model.metabolites),
+                                    len(model.reactions)))
+
+
+def check_mass_balance(model, check_charge=True):
+    """
+    Computes the element and charge imbalance of every reaction in model.
+
+    All metabolite formulas are parsed once into an element x metabolite
+    matrix, and the imbalance of every reaction is computed with a single
+    sparse product with the stoichiometric matrix.
+
+    Parameters
+    ----------
+    model : cobra.Model
+        The model to check.
+    check_charge : boolean, optional
+        Whether to also compute the charge imbalance. Default True.
+
+    Returns
+    -------
+    imbalance : pandas.DataFrame
+        A dataframe in which each row (index) represents a reaction and each
+        column represents an element (plus 'charge' if check_charge is True)
+        with the net amount produced by the reaction.
+    unknown : pandas.Series
+        Boolean series indexed by reaction, True for reactions involving a
+        metabolite whose formula (or charge) is missing or unparseable; the
+        imbalance of these reactions cannot be determined.
+    """
+    stoichiometry = stoichiometric_matrix(model)
+    elements, composition, known = element_matrix(model.metabolites)
+    imbalance = (composition * stoichiometry).toarray().T
+    columns = list(elements)
+
+    if check_charge:
+        charges = np.array([np.nan if met.charge is None else met.charge
+                            for met in model.metabolites], dtype=float)
+        known = known & ~np.isnan(charges)
+        charge_imbalance = stoichiometry.T.dot(np.nan_to_num(charges))
+        imbalance = np.column_stack([imbalance, charge_imbalance])
+        columns.append('charge')
+
+    # a reaction is unknown if it involves any metabolite that is not known
+    unknown = abs(stoichiometry).T.dot((~known).astype(float)) > 0
+
+    reaction_ids = [rxn.id for rxn in model.reactions]
+    return (pd.DataFrame(imbalance, index=reaction_ids, columns=columns),
+            pd.Series(unknown, index=reaction_ids))
+
+
+def find_imbalanced_reactions(model, tolerance=1e-6, check_charge=True,
+                              ignore_boundary=True, ignore_objective=True,
+                              allow_unknown=False):
+    """
+    Identifies reactions that are not mass (and charge) balanced.
+
+    Parameters
+    ----------
+    model : cobra.Model
+        The model to check.
+    tolerance : float, optional
+        The largest absolute imbalance of any element (or charge) that is
+        considered balanced. Default 1e-6.
+    check_charge : boolean, optional
+        Whether reactions must also be charge balanced. Default True.
+    ignore_boundary : boolean, optional
+        Whether to skip boundary reactions (exchanges, demands and sinks),
+        which are imbalanced by definition. Default True.
+    ignore_objective : boolean, optional
+        Whether to skip reactions in the objective (e.g. biomass
+        pseudo-reactions). Default True.
+    allow_unknown : boolean, optional
+        Whether reactions involving metabolites with missing or unparseable
+        formulas are considered balanced. Default False.
+
+    Returns
+    -------
+    list of str
+        Ids of the imbalanced reactions.
+    """
+    imbalance, unknown = check_mass_balance(model, check_charge=check_charge)
+    imbalanced = (imbalance.abs() > tolerance).any(axis=1)
+    if allow_unknown:
+        imbalanced = imbalanced & ~unknown
+    else:
+        imbalanced = imbalanced | unknown
+
+    ignored = set()
+    if ignore_boundary:
+        ignored.update(rxn.id for rxn in model.reactions if rxn.boundary)
+    if ignore_objective:
+        ignored.update(rxn.id for rxn
+                       in linear_reaction_coefficients(model).keys())
+    return [rxn for rxn in imbalanced.index[imbalanced.values]
+            if rxn not in ignored]
+
+
+def remove_imbalanced_reactions(model, **kwargs):
+    """
+    Removes all imbalanced reactions from a model or an ensemble in bulk.
+
+    Metabolites and genes left without reactions are removed as well. When
+    an ensemble is provided, its base_model is filtered and any features
+    describing a removed reaction are removed from the ensemble and from the
+    states of its members.
+
+    Parameters
+    ----------
+    model : cobra.Model or medusa.core.Ensemble
+        The universal, model or ensemble to filter in place.
+    **kwargs
+        Passed to find_imbalanced_reactions.
+
+    Returns
+    -------
+    list of str
+        Ids of the removed reactions.
+    """
+    if isinstance(model, Ensemble):
+        ensemble = model
+        model = ensemble.base_model
+    else:
+        ensemble = None
+
+    imbalanced = find_imbalanced_reactions(model, **kwargs)
+    removed = set(imbalanced)
+
+    if ensemble is not None:
+        ensemble.remove_features([feature for feature in ensemble.features
+                                  if feature.base_component.id in removed])
+
+    model.remove_reactions([model.reactions.get_by_id(rxn)
+                            for rxn in imbalanced], remove_orphans=True)
+    return imbalanced
+
 
 def leak_test(ensemble,metabolites_to_test=[],\
              exchange_prefix='EX_',verbose=False,num_models=[],**kwargs):
@@ -11,15 +253,15 @@ def leak_test(ensemble,metabolites_to_test=[],\
 
     if not num_models:
         # if the number of models wasn't specified, test all
-        num_models = len(self.reaction_diffs.keys())
+        num_models = len(ensemble.members)
 
     if not metabolites_to_test:
-        metabolites_to_test = [met for met in self.base_model.metabolites]
+        metabolites_to_test = [met for met in ensemble.base_model.metabolites]
 
     old_objective = ensemble.base_model.objective
     dm_rxns = []
     for met in metabolites_to_test:
-        rxn = cobra.Reaction(id='leak_DM_' + met.id)
+        rxn = Reaction(id='leak_DM_' + met.id)
         rxn.lower_bound = 0.0
         rxn.upper_bound = 0.0
         rxn.add_metabolites({met:-1})
@@ -27,6 +269,13 @@ def leak_test(ensemble,metabolites_to_test=[],\
     ensemble.base_model.add_reactions(dm_rxns)
     ensemble.base_model.repair()
 
+    # close all exchange reactions
+    exchanges = [rxn for rxn in ensemble.base_model.reactions
+                 if rxn.id.startswith(exchange_prefix)]
+    exchange_bounds = [rxn.lower_bound for rxn in exchanges]
+    for rxn in exchanges:
+        rxn.lower_bound = 0.0
+
     leaks = {}
 
     for rxn in dm_rxns:
@@ -35,14 +284,17 @@ def leak_test(ensemble,metabolites_to_test=[],\
 
         if verbose:
             print('checking leak for ' + rxn.id)
-        solutions = ensemble.optimize_ensemble(return_flux=[rxn.id],num_models=num_models,**kwargs)
+        solutions = optimize_ensemble(ensemble,return_flux=[rxn.id],num_models=num_models,**kwargs)
         leaks[rxn.id.split('_DM_')[1]] = {}
-        for model in solutions.keys():
-            leaks[rxn.id.split('_DM_')[1]][model] = solutions[model][rxn.id] > 0.0001
+        for model in solutions.index:
+            leaks[rxn.id.split('_DM_')[1]][model] = solutions.loc[model,rxn.id] > 0.0001
         #rxn.objective_coefficient = 0.0
         rxn.upper_bound = 0.0
 
-    # remove the demand reactions and restore the original objective
+    # remove the demand reactions and restore the exchanges and original
+    # objective
+    for rxn, lower_bound in zip(exchanges, exchange_bounds):
+        rxn.lower_bound = lower_bound
     ensemble.base_model.remove_reactions(dm_rxns,remove_orphans=True)
     ensemble.base_model.repair()
     ensemble.base_model.objective = old_objective
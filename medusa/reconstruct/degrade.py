@@ -1,18 +1,27 @@
 
 from __future__ import absolute_import
 
+import multiprocessing
 
+import numpy as np
 
+from cobra.util.solver import linear_reaction_coefficients
 
-
-
+from medusa.core.ensemble import Ensemble
 
 # functions for degrading networks to construct ensembles
 
-def degrade_reactions(base_model,num_reactions,num_models=10):
+def degrade_reactions(base_model,num_reactions,num_models=10,
+                      reaction_list=None, viability_threshold=None,
+                      max_attempts=None, num_processes=None):
     """
     Removes reactions from an existing COBRA model to generate an ensemble.
 
+    The reactions removed from each member are drawn directly into a
+    member x reaction matrix, from which the features and members of the
+    ensemble are built. No model is copied per member; the base model is
+    copied once to become the ensemble's base_model.
+
     Parameters
     ----------
     base_model: cobra.Model
@@ -22,11 +31,138 @@ def degrade_reactions(base_model,num_reactions,num_models=10):
         Must be smaller than the total number of reactions in the model
     num_models: int
         The number of models to generate by randomly removing num_reactions from
-        the base_model. Reactions are removed with replacement.
+        the base_model. The reactions removed from each member are drawn
+        without replacement, independently of the other members.
+    reaction_list: list of str, optional
+        Ids of the reactions that may be removed. If None, all reactions
+        other than those in the objective are candidates for removal.
+    viability_threshold: float, optional
+        If provided, members whose objective value (as returned by
+        slim_optimize on base_model with the member's reactions removed) is
+        below viability_threshold are rejected and new members are drawn in
+        their place.
+    max_attempts: int, optional
+        The maximum number of members to draw when viability_threshold is
+        provided. Defaults to 100 times num_models.
+    num_processes : int, optional
+        An integer corresponding to the number of processes (i.e. cores) to
+        use for viability checks. Each process keeps a single copy of the
+        model and toggles reaction bounds, so each check is warm-started
+        from the previous solution. If None, one core is used.
 
     Returns
     -------
     Medusa.core.ensemble
         An ensemble
     """
-    filler=1
+    if reaction_list is None:
+        objective = set(rxn.id for rxn
+                        in linear_reaction_coefficients(base_model).keys())
+        reaction_list = [rxn.id for rxn in base_model.reactions
+                         if rxn.id not in objective]
+    if num_reactions >= len(reaction_list):
+        raise ValueError("num_reactions must be smaller than the number of "
+                         "reactions that can be removed")
+    if max_attempts is None:
+        max_attempts = 100*num_models
+    if num_processes is None:
+        num_processes = 1
+
+    if viability_threshold is None:
+        removed = _draw_removals(num_models, len(reaction_list),
+                                 num_reactions)
+    else:
+        removed = _draw_viable_removals(base_model, reaction_list,
+                                        num_reactions, num_models,
+                                        viability_threshold, max_attempts,
+                                        num_processes)
+
+    identifier = base_model.id + '_degraded'
+    ensemble = Ensemble(identifier=identifier, name=base_model.name)
+    ensemble.base_model = base_model.copy()
+    reactions = [ensemble.base_model.reactions.get_by_id(rxn)
+                 for rxn in reaction_list]
+    member_ids = [identifier + '_' + str(i) for i in range(num_models)]
+    ensemble._populate_from_presence_matrix(reactions, member_ids, ~removed,
+                            member_names=[base_model.name] * num_models)
+    return ensemble
+
+
+def _draw_removals(num_draws, num_candidates, num_reactions):
+    # for each draw, the num_reactions candidates with the lowest random keys
+    # form a uniform sample without replacement
+    keys = np.random.random_sample((num_draws, num_candidates))
+    chosen = np.argpartition(keys, num_reactions - 1,
+                             axis=1)[:, :num_reactions]
+    removed = np.zeros((num_draws, num_candidates), dtype=bool)
+    removed[np.arange(num_draws)[:, None], chosen] = True
+    return removed
+
+
+def _draw_viable_removals(base_model, reaction_list, num_reactions,
+                          num_models, viability_threshold, max_attempts,
+                          num_processes):
+    accepted = []
+    attempts = 0
+    # Can't have fewer draws than processes
+    num_processes = min(num_processes, num_models)
+    if num_processes > 1:
+        pool = multiprocessing.Pool(
+            num_processes,
+            initializer = _init_worker,
+            initargs = (base_model, reaction_list)
+        )
+    else:
+        model = base_model.copy()
+        reactions = [model.reactions.get_by_id(rxn) for rxn in reaction_list]
+
+    try:
+        while len(accepted) < num_models:
+            if attempts >= max_attempts:
+                raise RuntimeError("Only found " + str(len(accepted)) +
+                                   " viable members in " + str(attempts) +
+                                   " attempts. Try lowering "
+                                   "viability_threshold or num_reactions.")
+            # draw enough candidates to replace the members still missing
+            num_draws = min(num_models - len(accepted),
+                            max_attempts - attempts)
+            removed = _draw_removals(num_draws, len(reaction_list),
+                                     num_reactions)
+            draws = [np.flatnonzero(row) for row in removed]
+            if num_processes > 1:
+                chunk_size = max(1, num_draws // num_processes)
+                objective_values = pool.map(_viability_worker, draws,
+                                            chunksize=chunk_size)
+            else:
+                objective_values = [_check_viability(model, reactions, draw)
+                                    for draw in draws]
+            objective_values = np.array(objective_values, dtype=float)
+            accepted.extend(removed[objective_values >= viability_threshold])
+            attempts += num_draws
+    finally:
+        if num_processes > 1:
+            pool.close()
+            pool.join()
+
+    return np.array(accepted, dtype=bool).reshape(num_models,
+                                                  len(reaction_list))
+
+
+def _check_viability(model, reactions, removed):
+    with model:
+        for index in removed:
+            reactions[index].bounds = (0, 0)
+        return model.slim_optimize(error_value=0.)
+
+
+def _viability_worker(removed):
+    global _model
+    global _reactions
+    return _check_viability(_model, _reactions, removed)
+
+
+def _init_worker(model, reaction_list):
+    global _model
+    global _reactions
+    _model = model
+    _reactions = [model.reactions.get_by_id(rxn) for rxn in reaction_list]
@@ -1,19 +1,21 @@
 
 import itertools
+import multiprocessing
 import random
-from itertools import chain
+import numpy as np
+from pandas import DataFrame
+from functools import partial
 
 from optlang.interface import OPTIMAL
+from optlang.symbolics import Zero
+from swiglpk import glp_std_basis
 
+from cobra import Model
 from cobra.flux_analysis.gapfilling import GapFiller
-from cobra.flux_analysis.parsimonious import add_pfba
-from cobra.core import DictList
 
 from cobra.util.solver import linear_reaction_coefficients
 
 from medusa.core.ensemble import Ensemble
-from medusa.core.feature import Feature
-from medusa.core.member import Member
 # functions for expanding existing models to generate an ensemble
 
 REACTION_ATTRIBUTES = ['lower_bound', 'upper_bound']
@@ -21,7 +23,8 @@ MISSING_ATTRIBUTE_DEFAULT = {'lower_bound':0,'upper_bound':0}
 
 def gapfill_to_ensemble(model, iterations=1, universal=None, lower_bound=0.05,
                  penalties=None, exchange_reactions=False,
-                 demand_reactions=False, integer_threshold=1e-6):
+                 demand_reactions=False, integer_threshold=1e-6,
+                 prune_universal=False):
     """
     Performs gapfilling on model, pulling reactions from universal.
     Any existing constraints on base_model are maintained during gapfilling, so
@@ -58,13 +61,23 @@ def gapfill_to_ensemble(model, iterations=1, universal=None, lower_bound=0.05,
         in the model.
     demand_reactions : bool, False
         Consider adding demand reactions for all metabolites.
+    prune_universal : bool, False
+        Gapfill only with the universal reactions that can carry flux when
+        connected to model, as found by reachable_universal. The problem
+        has fewer variables but the same optimal solutions, although ties
+        between equally good solutions may be broken differently.
 
     Returns
     -------
     ensemble : medusa.core.Ensemble
         The ensemble object created from the gapfill solutions.
     """
-    gapfiller = GapFiller(model, universal=universal,
+    candidates = universal
+    if prune_universal:
+        candidates = reachable_universal(
+            model, universal, exchange_reactions=exchange_reactions,
+            demand_reactions=demand_reactions)
+    gapfiller = GapFiller(model, universal=candidates,
                           lower_bound=lower_bound, penalties=penalties,
                           demand_reactions=demand_reactions,
                           exchange_reactions=exchange_reactions,
@@ -84,7 +97,10 @@ def iterative_gapfill_from_binary_phenotypes(model,universal,phenotype_dict,
                                             exchange_reactions=False,
                                             demand_reactions=False,
                                             inclusion_threshold=1e-6,
-                                            exchange_prefix="EX_"):
+                                            exchange_prefix="EX_",
+                                            num_processes=1,
+                                            prune_universal=False,
+                                            return_summary=False):
     """
     Performs gapfilling on model, pulling reactions from universal.
     Any existing constraints on base_model are maintained during gapfilling, so
@@ -153,12 +169,35 @@ def iterative_gapfill_from_binary_phenotypes(model,universal,phenotype_dict,
         reactions. "EX_" is standard for modelSEED models. This will be
         updated to be more database-agnostic when cobrapy boundary
         determination is finalized for cobrapy version 1.0.
+    num_processes : int, 1
+        The number of processes (i.e. cores) to distribute cycles across.
+        Each process builds the gapfilling problem once and performs its
+        share of the cycles. Using more cores will speed up computation, but
+        will have a larger memory footprint because the model and universal
+        must be copied for each additional core used. Solutions are collected
+        in the same order as the cycles, so the result does not depend on the
+        number of processes.
+    prune_universal : bool, False
+        Gapfill only with the universal reactions that can carry flux when
+        connected to model in at least one of the conditions, as found by
+        reachable_universal. The gapfilling problem has fewer variables,
+        which makes each cycle faster and shrinks the copy sent to each
+        process, but the same optimal solutions (although ties between
+        equally good solutions may be broken differently).
+    return_summary : bool, False
+        Also return how many conditions were filled and skipped in each
+        cycle. A condition is skipped when the reactions already added for
+        earlier conditions in the cycle satisfy it.
 
     Returns
     -------
-    solutions : list
-        list of lists; each list contains a gapfill solution for a single
-        cycle. Number of lists is equal to output_ensemble_size.
+    ensemble : medusa.core.Ensemble
+        An ensemble with a member for each unique gapfill solution, one of
+        which is found per cycle.
+    summary : pandas.DataFrame
+        Only returned if return_summary is True. A cycles x ['filled',
+        'skipped'] dataframe with the number of conditions filled and
+        skipped in each cycle.
     """
     if gapfill_type not in ["integer","continuous"]:
         raise ValueError("only gapfill types of integer and continuous"
@@ -180,6 +219,13 @@ def iterative_gapfill_from_binary_phenotypes(model,universal,phenotype_dict,
                             'reactions prior to gapfilling.')
 
 
+    candidates = universal
+    if prune_universal:
+        candidates = reachable_universal(
+            model, universal, media=phenotype_dict.values(),
+            exchange_reactions=exchange_reactions,
+            demand_reactions=demand_reactions)
+
     # pre-generate the random orderings of conditions to ensure there are no
     # duplicates.
     cycle_order = []
@@ -193,223 +239,638 @@ def iterative_gapfill_from_binary_phenotypes(model,universal,phenotype_dict,
     # our strategy is to reduce the cost for the reactions returned by the
     # previous solution to 0, such that they are automatically included in
     # the model for the next condition.
-    if gapfill_type is "integer":
+    if gapfill_type == "integer":
         solutions =  _integer_iterative_binary_gapfill(model,
                               phenotype_dict,
                               cycle_order,
-                              universal=universal,
+                              universal=candidates,
                               output_ensemble_size=output_ensemble_size,
                               lower_bound=lower_bound,
                               penalties=penalties,
                               demand_reactions=demand_reactions,
                               exchange_reactions=exchange_reactions,
-                              integer_threshold=inclusion_threshold)
-    elif gapfill_type is "continuous":
+                              integer_threshold=inclusion_threshold,
+                              num_processes=num_processes,
+                              return_summary=return_summary)
+    elif gapfill_type == "continuous":
         solutions = _continuous_iterative_binary_gapfill(model,
                               phenotype_dict,
                               cycle_order,
-                              universal=universal,
+                              universal=candidates,
                               output_ensemble_size=output_ensemble_size,
                               lower_bound=lower_bound,
                               penalties=penalties,
                               demand_reactions=demand_reactions,
                               exchange_reactions=exchange_reactions,
                               flux_cutoff=inclusion_threshold,
-                              exchange_prefix='EX_')
+                              exchange_prefix=exchange_prefix,
+                              num_processes=num_processes,
+                              return_summary=return_summary)
 
+    if return_summary:
+        solutions, summary = solutions
     ensemble =_build_ensemble_from_gapfill_solutions(model,solutions,
                                                     universal=universal)
+    if return_summary:
+        return ensemble, summary
     return ensemble
 
+def reachable_universal(model, universal, media=None, seed_metabolites=None,
+                        exchange_reactions=False, demand_reactions=False):
+    """
+    Returns the universal reactions that can carry flux when added to model.
+
+    Gapfilling only ever uses universal reactions that can carry flux at
+    steady state once connected to model, which in a large universal model
+    are typically a small fraction of all reactions. A reaction (in a
+    direction allowed by its bounds) is kept only if it is reachable both
+    forward, i.e. all of its substrates can be made from the metabolites of
+    model, the media and other kept reactions, and backward, i.e. all of its
+    products can be used by model or other kept reactions. Both scope
+    expansions are repeated on the kept reactions until nothing changes.
+
+    Reactions that are removed could at most carry flux around closed loops
+    of metabolites that neither model nor the media provide, such as loops
+    that recycle a cofactor the network can't make. If such cofactors should
+    be considered available, pass them as seed_metabolites.
+
+    Parameters
+    ----------
+    model : cobra.Model
+        The model to be gapfilled. Its metabolites are considered available
+        and usable.
+    universal : cobra.Model
+        A universal model with reactions that can be used to complete the
+        model.
+    media : iterable of dict, optional
+        Media as in cobra.core.model.medium (e.g. phenotype_dict.values()).
+        The metabolites of their exchange reactions, looked up in model or
+        universal, are considered available.
+    seed_metabolites : iterable of str, optional
+        Ids of additional metabolites that are considered available and
+        usable.
+    exchange_reactions : bool, False
+        Whether gapfilling may add exchange (uptake) reactions for all
+        metabolites, in which case every metabolite of model and universal
+        is considered available.
+    demand_reactions : bool, False
+        Whether gapfilling may add demand reactions for all metabolites, in
+        which case every metabolite of model and universal is considered
+        usable.
+
+    Returns
+    -------
+    cobra.Model
+        A model with copies of the universal reactions that can carry flux.
+    """
+    available = set(met.id for met in model.metabolites)
+    usable = set(available)
+    if seed_metabolites is not None:
+        available.update(seed_metabolites)
+        usable.update(seed_metabolites)
+    for medium in media if media is not None else []:
+        for rxn_id in medium:
+            if rxn_id in model.reactions:
+                reaction = model.reactions.get_by_id(rxn_id)
+            elif rxn_id in universal.reactions:
+                reaction = universal.reactions.get_by_id(rxn_id)
+            else:
+                continue
+            available.update(met.id for met in reaction.metabolites)
+    # gapfilling may add uptake or demand reactions for any metabolite
+    all_metabolites = set(met.id for met in model.metabolites) | \
+        set(met.id for met in universal.metabolites)
+    if exchange_reactions:
+        available.update(all_metabolites)
+    if demand_reactions:
+        usable.update(all_metabolites)
+
+    # every direction a universal reaction can run in, as (reaction,
+    # substrates, products)
+    directions = []
+    for reaction in universal.reactions:
+        reactants = [met.id for met in reaction.reactants]
+        products = [met.id for met in reaction.products]
+        if reaction.upper_bound > 0:
+            directions.append((reaction, reactants, products))
+        if reaction.lower_bound < 0:
+            directions.append((reaction, products, reactants))
+
+    kept = list(range(len(directions)))
+    while True:
+        forward = _scope_expansion(
+            [(directions[i][1], directions[i][2]) for i in kept], available)
+        backward = _scope_expansion(
+            [(directions[i][2], directions[i][1]) for i in kept], usable)
+        reachable = [i for i, f, b in zip(kept, forward, backward) if f and b]
+        if len(reachable) == len(kept):
+            break
+        kept = reachable
+
+    reactions = list(dict.fromkeys(directions[i][0] for i in kept))
+    pruned = Model(universal.id + '_reachable')
+    pruned.add_reactions([rxn.copy() for rxn in reactions])
+    print("kept " + str(len(reactions)) + " of " +
+          str(len(universal.reactions)) + " universal reactions")
+    return pruned
+
+
+def _scope_expansion(directions, seeds):
+    """Find the directions whose inputs are all reachable from seeds.
+
+    directions is a list of (inputs, outputs) metabolite id lists. The
+    outputs of every reachable direction become reachable in turn. Each
+    direction keeps a count of its unreachable inputs, so every
+    metabolite-direction pair is visited once.
+    """
+    missing = np.array([len(set(inputs)) for inputs, outputs in directions],
+                       dtype=np.intp)
+    consumers = {}
+    for i, (inputs, outputs) in enumerate(directions):
+        for met in set(inputs):
+            consumers.setdefault(met, []).append(i)
+    reached = set(seeds)
+    for met in reached:
+        for i in consumers.get(met, []):
+            missing[i] -= 1
+    queue = [i for i in range(len(directions)) if missing[i] == 0]
+    while queue:
+        i = queue.pop()
+        for met in directions[i][1]:
+            if met in reached:
+                continue
+            reached.add(met)
+            for j in consumers.get(met, []):
+                missing[j] -= 1
+                if missing[j] == 0:
+                    queue.append(j)
+    return missing == 0
+
+
 def _continuous_iterative_binary_gapfill(model,phenotype_dict,cycle_order,
                       universal=None, output_ensemble_size=1,
                       lower_bound=0.05, penalties=None,
                       demand_reactions=False,
                       exchange_reactions=False,
                       flux_cutoff=1E-8,
-                      exchange_prefix='EX_'):
-    if exchange_reactions:
-        raise NotImplementedError("Inclusion of new exchange reactions is not"
-                            "supported for continuous gapfill")
-    if demand_reactions:
-        raise NotImplementedError("Inclusion of demand reactions is not"
-                            "supported for continuous gapfill")
-
-    solutions = []
-    gapfiller = universal.copy()
-
-
-
-    # get the original objective from the model being gapfilled
-    model_to_gapfill = model.copy()
-    original_objective = linear_reaction_coefficients(model_to_gapfill)
-    # convert to IDs to avoid issues with model membership when these reactions
-    # are added to gapfiller
-    original_objective = {rxn.id:original_objective[rxn] for rxn
-                            in original_objective.keys()}
-
-    # get the reactions in the original model, which need to be removed from
-    # the universal if present. This cannot catch identical reactions that do
-    # not share IDs, so make sure your model and universal are in the same
-    # namespace.
-    rxns_to_remove = [rxn for rxn in gapfiller.reactions if rxn.id in \
-                        [rxn.id for rxn in model_to_gapfill.reactions]]
-    gapfiller.remove_reactions(rxns_to_remove)
-
-    # get the list of reactions currently in the gapfiller, which are the ones
-    # we will need to check for flux after solving the problem (e.g. these are
-    # the reactions we are considering adding to the model)
-    get_fluxes = [rxn.id for rxn in gapfiller.reactions]
-
-    # add the reactions from the model to the gapfiller, which are not
-    # included in the pFBA formulation, and thus flux is not penalized
-    # through them.
-    original_model_reactions = [rxn.copy() for rxn
-                                in model_to_gapfill.reactions]
-    gapfiller.add_reactions(original_model_reactions)
-    original_reaction_ids = [reaction.id for reaction
-                                in original_model_reactions]
-
-
-    # Add the pFBA constraints and objective (minimizes sum of fluxes)
-    add_pfba(gapfiller)
-
-    # set the linear coefficients for reactions in the original model to 0
-    coefficients = (gapfiller.objective
-                    .get_linear_coefficients(gapfiller.variables))
-    reaction_variables = (((gapfiller.reactions.get_by_id(reaction)
-                            .forward_variable),
-                           (gapfiller.reactions.get_by_id(reaction)
-                            .reverse_variable))
-                            for reaction in original_reaction_ids)
-    variables = chain(*reaction_variables)
-    for variable in variables:
-        coefficients[variable] = 0.0
-    gapfiller.objective.set_linear_coefficients(coefficients)
-
-    ## set a constraint on flux through the original objective
-    for reaction in original_objective.keys():
-        print("Constraining lower bound for " + reaction)
-        gapfiller.reactions.get_by_id(reaction).lower_bound = lower_bound
-
-    exchange_reactions = [rxn for rxn in gapfiller.reactions if\
-                            rxn.id.startswith(exchange_prefix)]
-    for rxn in exchange_reactions:
-        rxn.lower_bound = 0
-
-    for cycle_num in range(0,output_ensemble_size):
-        print("starting cycle number " + str(cycle_num))
-        cycle_reactions = set()
-        original_coefficients = \
-            gapfiller.objective.get_linear_coefficients(gapfiller.variables)
-
-        for condition in cycle_order[cycle_num]:
-            # set the medium for this condition.
-            for ex_rxn in phenotype_dict[condition].keys():
-                gapfiller.reactions.get_by_id(ex_rxn).lower_bound = \
-                    -1.0*phenotype_dict[condition][ex_rxn]
-                gapfiller.reactions.get_by_id(ex_rxn).upper_bound = \
-                    1.0*phenotype_dict[condition][ex_rxn]
-
-            # gapfill and get the solution
-            iteration_solution = gapfiller.optimize()
-
-            filtered_solution = {rxn:iteration_solution.fluxes[rxn] for rxn in\
-               get_fluxes if abs(iteration_solution.fluxes[rxn]) > flux_cutoff}
-
-            add_rxns = [universal.reactions.get_by_id(rxn).copy() for \
-                                            rxn in filtered_solution.keys()]
-            # combine the solution from this iteration with all others within
-            # the current cycle
-            cycle_reactions = cycle_reactions | \
-                                set([rxn.id for rxn in add_rxns])
-
-            # validate that the proposed solution restores flux through the
-            # objective in the original model
-            # set the bounds on the original model to represent media
-            # and validate the gapfill solution
-            for ex_rxn in [rxn for rxn in model_to_gapfill.reactions if \
-                            rxn.id.startswith(exchange_prefix)]:
-                ex_rxn.lower_bound = 0
-            for ex_rxn in phenotype_dict[condition].keys():
-                model_to_gapfill.reactions.get_by_id(ex_rxn).lower_bound = \
-                    -1.0*phenotype_dict[condition][ex_rxn]
-                model_to_gapfill.reactions.get_by_id(ex_rxn).upper_bound = \
-                    1.0*phenotype_dict[condition][ex_rxn]
-            if not validate(model_to_gapfill,\
-                            [universal.reactions.get_by_id(rxn).copy() for \
-                            rxn in cycle_reactions],lower_bound):
-                raise RuntimeError('Failed to validate gapfilled model, '
-                                    'try lowering the flux_cutoff through '
-                                    'inclusion_threshold')
-
-            # remove the flux minimization penalty on the gapfilled reactions
-            coefficients = (gapfiller.objective.
-                        get_linear_coefficients(gapfiller.variables).copy())
-            reaction_variables = (((gapfiller.reactions.get_by_id(rxn)
-                                    .forward_variable),
-                                    (gapfiller.reactions.get_by_id(rxn)
-                                    .reverse_variable))
-                                     for rxn in cycle_reactions)
-            variables = chain(*reaction_variables)
-            for variable in variables:
-                 coefficients[variable] = 0.0
-
-            gapfiller.objective.set_linear_coefficients(coefficients)
-            check = gapfiller.slim_optimize() # optimizing might be necessary
-            # to update coefficients.
-
-            # reset the media condition
-            for ex_rxn in exchange_reactions:
-                ex_rxn.lower_bound = 0
-
-        gapfiller.objective.set_linear_coefficients(original_coefficients)
-        solutions.append(list(cycle_reactions))
-    return solutions
+                      exchange_prefix='EX_',
+                      num_processes=1,
+                      return_summary=False):
+    setup = partial(Gapfiller, model, universal,
+                    gapfill_type="continuous",
+                    lower_bound=lower_bound,
+                    penalties=penalties,
+                    demand_reactions=demand_reactions,
+                    exchange_reactions=exchange_reactions,
+                    inclusion_threshold=flux_cutoff,
+                    exchange_prefix=exchange_prefix)
+    return _run_gapfill_cycles(setup, phenotype_dict,
+                               cycle_order[:output_ensemble_size],
+                               num_processes=num_processes,
+                               return_summary=return_summary)
 
 
 def _integer_iterative_binary_gapfill(model,phenotype_dict,cycle_order,
                       universal=None, output_ensemble_size=0,
-                      lower_bound=0.05, penalties=False,
+                      lower_bound=0.05, penalties=None,
                       demand_reactions=False,
                       exchange_reactions=False,
-                      integer_threshold=1E-6):
+                      integer_threshold=1E-6,
+                      num_processes=1,
+                      return_summary=False):
+    setup = partial(Gapfiller, model, universal,
+                    gapfill_type="integer",
+                    lower_bound=lower_bound,
+                    penalties=penalties,
+                    demand_reactions=demand_reactions,
+                    exchange_reactions=exchange_reactions,
+                    inclusion_threshold=integer_threshold)
+    return _run_gapfill_cycles(setup, phenotype_dict,
+                               cycle_order[:output_ensemble_size],
+                               num_processes=num_processes,
+                               return_summary=return_summary)
+
+
+class Gapfiller(object):
+    """
+    A gapfilling problem that is built once and solved many times.
 
+    Building the problem (adding the universal reactions to the model and
+    formulating the objective) is by far the most expensive part of
+    gapfilling against a large universal model. A Gapfiller keeps the
+    problem around so that any number of conditions and cycles can be
+    filled without rebuilding it; between cycles only the costs are reset.
 
-    gapfiller = GapFiller(model, universal=universal,
-                          lower_bound=lower_bound, penalties=penalties,
-                          demand_reactions=demand_reactions,
-                          exchange_reactions=exchange_reactions,
-                          integer_threshold=integer_threshold)
-    original_costs = gapfiller.costs
+    Parameters
+    ----------
+    model : cobra.Model
+        The model to perform gap filling on. The model is copied and is not
+        modified.
+    universal : cobra.Model
+        A universal model with reactions that can be used to complete the
+        model. Reactions sharing an id with a reaction in model are not
+        considered for gapfilling.
+    gapfill_type : string, "continuous"
+        "continuous" minimizes the summed flux through universal reactions
+        (a pFBA formulation); "integer" minimizes the number of universal
+        reactions used (cobra.flux_analysis.gapfilling.GapFiller).
+    lower_bound : float, 0.05
+        The minimally accepted flux for the objective in the filled model.
+    penalties : dict, None
+        A dictionary with keys being 'universal' (all reactions included in
+        the universal model), 'exchange' and 'demand' (all additionally
+        added exchange and demand reactions) for the three reaction types.
+        Can also have reaction identifiers for reaction specific costs.
+        Defaults are 1, 100 and 1 respectively. In the continuous
+        formulation, the cost scales the flux through a reaction.
+    exchange_reactions : bool, False
+        Consider adding exchange (uptake) reactions for all metabolites
+        in the model. Only supported for integer gapfilling.
+    demand_reactions : bool, False
+        Consider adding demand reactions for all metabolites. Only supported
+        for integer gapfilling.
+    inclusion_threshold : float, 1e-6
+        The threshold at which a value is considered non-zero (aka
+        integrality threshold in the integer formulation, or the flux
+        threshold in the continuous formulation).
+    exchange_prefix : string, "EX_"
+        The reaction ID prefix used to identify exchange reactions when
+        setting the medium for a condition in continuous gapfilling.
 
-    solutions = []
-    for cycle_num in range(0,output_ensemble_size):
-        print("starting cycle number " + str(cycle_num))
-        cycle_reactions = set()
-        for condition in cycle_order[cycle_num]:
-            gapfiller.model.medium = phenotype_dict[condition]
+    Attributes
+    ----------
+    model : cobra.Model
+        The model representing the gapfilling problem.
+    candidates : set
+        Ids of the universal reactions that can be added to the model.
+    cycle_summary : dict
+        The number of conditions in the last cycle that were 'filled', and
+        that were 'skipped' because the reactions found earlier in the cycle
+        already restored growth.
+    """
+
+    def __init__(self, model, universal, gapfill_type="continuous",
+                 lower_bound=0.05, penalties=None, exchange_reactions=False,
+                 demand_reactions=False, inclusion_threshold=1e-6,
+                 exchange_prefix="EX_"):
+        if gapfill_type not in ["integer","continuous"]:
+            raise ValueError("only gapfill types of integer and continuous"
+                             "are supported")
+        self.gapfill_type = gapfill_type
+        self.universal = universal
+        self.lower_bound = lower_bound
+        self.inclusion_threshold = inclusion_threshold
+        self.exchange_prefix = exchange_prefix
+
+        if gapfill_type == "continuous":
+            if exchange_reactions:
+                raise NotImplementedError("Inclusion of new exchange "
+                                    "reactions is not supported for "
+                                    "continuous gapfill")
+            if demand_reactions:
+                raise NotImplementedError("Inclusion of demand reactions is "
+                                    "not supported for continuous gapfill")
+            self._build_continuous(model, penalties)
+        else:
+            self._build_integer(model, penalties, exchange_reactions,
+                                demand_reactions)
+        self._build_cycle_model(model)
+        self.cycle_summary = dict(filled=0, skipped=0)
+
+    def _build_continuous(self, model, penalties):
+        costs = dict(universal=1)
+        if penalties is not None:
+            costs.update(penalties)
+
+        # get the reactions in the universal that are not in the original
+        # model. This cannot catch identical reactions that do not share IDs,
+        # so make sure your model and universal are in the same namespace.
+        model_reactions = set(rxn.id for rxn in model.reactions)
+        candidates = [rxn for rxn in self.universal.reactions
+                      if rxn.id not in model_reactions]
+        self.candidates = set(rxn.id for rxn in candidates)
+
+        self.model = model.copy()
+        original_objective = linear_reaction_coefficients(self.model)
+        self.model.add_reactions([rxn.copy() for rxn in candidates])
+
+        # constrain flux through the original objective rather than
+        # maximizing it
+        for reaction in original_objective.keys():
+            print("Constraining lower bound for " + reaction.id)
+            reaction.lower_bound = self.lower_bound
+
+        # minimize the (weighted) sum of fluxes through the candidate
+        # reactions; reactions from the original model are not penalized.
+        self._candidate_reactions = [self.model.reactions.get_by_id(rxn.id)
+                                     for rxn in candidates]
+        self._costs = {}
+        for rxn in self._candidate_reactions:
+            cost = costs.get(rxn.id, costs['universal'])
+            self._costs[rxn.forward_variable] = cost
+            self._costs[rxn.reverse_variable] = cost
+        self.model.objective = self.model.problem.Objective(
+            Zero, direction="min", sloppy=True)
+        self.model.objective.set_linear_coefficients(self._costs)
+
+        self._exchanges = [rxn for rxn in self.model.reactions
+                           if rxn.id.startswith(self.exchange_prefix)]
+        for rxn in self._exchanges:
+            rxn.lower_bound = 0
+
+        # solutions are validated in a copy of the original model, which
+        # only ever receives the reactions in the solution.
+        self._validation_model = model.copy()
+        self._validation_exchanges = [rxn for rxn
+                                      in self._validation_model.reactions
+                                      if rxn.id.startswith(
+                                        self.exchange_prefix)]
+
+    def _build_integer(self, model, penalties, exchange_reactions,
+                       demand_reactions):
+        # GapFiller validates solutions against the model it was given, so
+        # give it a copy whose medium can follow the condition being filled.
+        self._gapfiller = GapFiller(model.copy(), universal=self.universal,
+                            lower_bound=self.lower_bound,
+                            penalties=penalties,
+                            demand_reactions=demand_reactions,
+                            exchange_reactions=exchange_reactions,
+                            integer_threshold=self.inclusion_threshold)
+        self.model = self._gapfiller.model
+        self.candidates = set(indicator.rxn_id for indicator
+                              in self._gapfiller.indicators)
+        # GapFiller.fill() updates the costs in place, so keep a copy of
+        # the costs every cycle starts from.
+        self._costs = dict(self._gapfiller.costs)
+
+    def _build_cycle_model(self, model):
+        # a copy of the original model that receives the reactions of the
+        # current cycle as they are found, so that checking whether they
+        # already restore growth in a condition is a small LP rather than a
+        # gapfill
+        self._cycle_model = model.copy()
+        self._cycle_metabolites = set(met.id for met
+                                      in self._cycle_model.metabolites)
+        self._cycle_exchanges = [rxn for rxn in self._cycle_model.reactions
+                                 if rxn.id.startswith(self.exchange_prefix)]
+        self._cycle_reactions = []
+
+    def reset(self):
+        """Restore the original costs of all candidate reactions."""
+        if self.gapfill_type == "continuous":
+            self.model.objective.set_linear_coefficients(self._costs)
+            _reset_basis(self.model)
+        else:
+            self._gapfiller.costs = dict(self._costs)
+            self.model.objective.set_linear_coefficients(
+                self._gapfiller.costs)
+        if self._cycle_reactions:
+            self._cycle_model.remove_reactions(self._cycle_reactions)
+            added_metabolites = [met for met in self._cycle_model.metabolites
+                                 if met.id not in self._cycle_metabolites]
+            if added_metabolites:
+                self._cycle_model.remove_metabolites(added_metabolites)
+            self._cycle_reactions = []
+
+    def fill(self, medium):
+        """
+        Gapfill a single condition with the current costs.
+
+        Parameters
+        ----------
+        medium : dict
+            A dictionary of exchange reaction ids to bounds, as set in
+            cobra.core.model.medium.
+
+        Returns
+        -------
+        list
+            Ids of the universal reactions in the gapfill solution.
+        """
+        if self.gapfill_type == "continuous":
+            _set_medium(self._exchanges, self.model.reactions, medium)
+            self.model.slim_optimize()
+            if self.model.solver.status != OPTIMAL:
+                raise RuntimeError('Gapfilling optimization failed with '
+                                   'status ' + self.model.solver.status)
+            primals = self.model.solver.primal_values
+            solution = [rxn.id for rxn in self._candidate_reactions
+                        if abs(primals[rxn.id] - primals[rxn.reverse_id])
+                        > self.inclusion_threshold]
+        else:
+            self.model.medium = medium
+            self._gapfiller.original_model.medium = medium
             # gapfill and get the solution. The 0 index is necessary because
             # gapfill will return a list of lists; we are only taking the
             # first (and only) list here.
-            gapfilled_reactions = gapfiller.fill()[0]
-            cycle_reactions = cycle_reactions | set(gapfilled_reactions)
-            # iterate through indicators, find those corresponding to the
-            # gapfilled reactions from any iteration within this cycle, and
-            # reset their cost to 0. Doing this for all reactions from any
-            # iteration within the cycle is necessary because cobrapy's
-            # gapfill function performs update_costs, which will reset costs
-            # and iteratively increase them; without this manual override
-            # performed here, costs for previous conditions within a cycle
-            # would revert to 1 instead of the desired 0
-            for reaction_indicator in [indicator for indicator
-                                        in gapfiller.indicators]:
-                if reaction_indicator.rxn_id in cycle_reactions:
-                    gapfiller.costs[reaction_indicator] = 0
-            gapfiller.model.objective.set_linear_coefficients(gapfiller.costs)
-        solutions.append(list(cycle_reactions))
-        gapfiller.model.objective.set_linear_coefficients(original_costs)
-    return solutions
+            solution = [rxn.id for rxn in self._gapfiller.fill()[0]]
+        return solution
+
+    def fill_cycle(self, conditions, phenotype_dict):
+        """
+        Gapfill each condition in turn, accumulating a single solution.
+
+        After each condition, the cost of every reaction in the solution so
+        far is set to 0, so that those reactions are freely used in the
+        following conditions. Costs are reset before the cycle starts, so
+        each cycle is independent of the cycles filled before it.
+
+        Parameters
+        ----------
+        conditions : list
+            Keys of phenotype_dict, in the order in which they are filled.
+        phenotype_dict : dict
+            A dictionary of condition_name:media_dict, as in
+            iterative_gapfill_from_binary_phenotypes.
+
+        Returns
+        -------
+        list
+            Ids of the universal reactions in the solution for the cycle.
+        """
+        self.reset()
+        self.cycle_summary = dict(filled=0, skipped=0)
+        cycle_reactions = set()
+        for condition in conditions:
+            medium = phenotype_dict[condition]
+            # if the reactions found so far already restore growth, filling
+            # the condition would add nothing, since they are free to use
+            if self._cycle_satisfies(medium):
+                self.cycle_summary['skipped'] += 1
+                continue
+            self.cycle_summary['filled'] += 1
+            solution = set(self.fill(medium)) - cycle_reactions
+            cycle_reactions = cycle_reactions | solution
+            self._add_cycle_reactions(solution)
+
+            if self.gapfill_type == "continuous":
+                # validate that the proposed solution restores flux through
+                # the objective in the original model
+                if not self._cycle_satisfies(medium):
+                    raise RuntimeError('Failed to validate gapfilled model, '
+                                        'try lowering the flux_cutoff through '
+                                        'inclusion_threshold')
+                # remove the flux minimization penalty on the gapfilled
+                # reactions
+                coefficients = {}
+                for rxn_id in cycle_reactions:
+                    rxn = self.model.reactions.get_by_id(rxn_id)
+                    coefficients[rxn.forward_variable] = 0.0
+                    coefficients[rxn.reverse_variable] = 0.0
+                self.model.objective.set_linear_coefficients(coefficients)
+            else:
+                # iterate through indicators, find those corresponding to the
+                # gapfilled reactions from any iteration within this cycle,
+                # and reset their cost to 0. Doing this for all reactions
+                # from any iteration within the cycle is necessary because
+                # cobrapy's gapfill function performs update_costs, which
+                # will reset costs and iteratively increase them; without
+                # this manual override performed here, costs for previous
+                # conditions within a cycle would revert to 1 instead of the
+                # desired 0
+                for reaction_indicator in self._gapfiller.indicators:
+                    if reaction_indicator.rxn_id in cycle_reactions:
+                        self._gapfiller.costs[reaction_indicator] = 0
+                self.model.objective.set_linear_coefficients(
+                    self._gapfiller.costs)
+        return list(cycle_reactions)
+
+    def _add_cycle_reactions(self, reactions):
+        new_reactions = [self.model.reactions.get_by_id(rxn).copy()
+                         for rxn in sorted(reactions)]
+        self._cycle_model.add_reactions(new_reactions)
+        self._cycle_reactions.extend(
+            self._cycle_model.reactions.get_by_id(rxn.id)
+            for rxn in new_reactions)
+
+    def _cycle_satisfies(self, medium):
+        # whether the original model with the reactions found so far in the
+        # cycle reaches lower_bound in medium
+        with self._cycle_model as model:
+            if self.gapfill_type == "continuous":
+                _set_medium(self._cycle_exchanges, model.reactions, medium)
+            else:
+                model.medium = medium
+            model.slim_optimize()
+            return (model.solver.status == OPTIMAL and
+                    model.solver.objective.value >= self.lower_bound)
+
+    def validate(self, reactions, medium):
+        """
+        Check whether reactions restore growth of the original model.
+
+        Parameters
+        ----------
+        reactions : iterable
+            Ids of universal reactions to add to the original model.
+        medium : dict
+            A dictionary of exchange reaction ids to bounds, as set in
+            cobra.core.model.medium.
+
+        Returns
+        -------
+        bool
+            True if the objective of the original model with reactions
+            added reaches lower_bound in medium.
+        """
+        if self.gapfill_type == "integer":
+            return self._gapfiller.validate(
+                [self.model.reactions.get_by_id(rxn) for rxn in reactions])
+        with self._validation_model as model:
+            _set_medium(self._validation_exchanges, model.reactions, medium)
+            return validate(model,
+                            [self.universal.reactions.get_by_id(rxn).copy()
+                             for rxn in reactions],
+                            self.lower_bound)
+
+
+def _set_medium(exchanges, reactions, medium):
+    # close uptake through all exchanges, then open those in the medium
+    for rxn in exchanges:
+        rxn.lower_bound = 0
+    for ex_rxn in medium.keys():
+        reaction = reactions.get_by_id(ex_rxn)
+        reaction.lower_bound = -1.0*medium[ex_rxn]
+        reaction.upper_bound = 1.0*medium[ex_rxn]
+
+
+def _reset_basis(model):
+    """Discard the basis left by the previous solve.
+
+    Continuous gapfilling is degenerate, so a warm-started solve can land on
+    a different (equally optimal) solution depending on what was solved
+    before it. Starting each cycle from the standard basis keeps a cycle's
+    solution independent of which process ran it. Only GLPK is reset; other
+    solvers keep warm-starting.
+    """
+    if 'glpk' in model.solver.interface.__name__:
+        glp_std_basis(model.solver.problem)
+
+
+def _run_gapfill_cycles(setup, phenotype_dict, cycle_order, num_processes=1,
+                        return_summary=False):
+    """Fill every cycle in cycle_order with the Gapfiller built by setup().
+
+    setup() is called once per process. Solutions are returned in the order
+    of cycle_order, regardless of which process finished first. If
+    return_summary is True, a cycles x ['filled', 'skipped'] dataframe with
+    the Gapfiller.cycle_summary of every cycle is returned as well.
+    """
+    cycles = list(enumerate(cycle_order))
+
+    if num_processes is None:
+        num_processes = 1
+    # Can't have fewer cycles than processes
+    num_processes = min(num_processes, len(cycles))
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(
+            num_processes,
+            initializer = _init_gapfill_worker,
+            initargs = (setup, phenotype_dict)
+        )
+        try:
+            # cycles are long-running, so hand them out one at a time
+            results = dict(pool.imap_unordered(_gapfill_cycle_worker, cycles))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        gapfiller = setup()
+        results = dict(_gapfill_cycle(gapfiller, phenotype_dict, cycle)
+                       for cycle in cycles)
+
+    solutions = [results[cycle_num][0] for cycle_num, conditions in cycles]
+    if not return_summary:
+        return solutions
+    summary = DataFrame([results[cycle_num][1]
+                         for cycle_num, conditions in cycles],
+                        index=[cycle_num for cycle_num, conditions in cycles],
+                        columns=['filled', 'skipped'])
+    return solutions, summary
+
+
+def _gapfill_cycle(gapfiller, phenotype_dict, cycle):
+    cycle_num, conditions = cycle
+    print("starting cycle number " + str(cycle_num))
+    solution = gapfiller.fill_cycle(conditions, phenotype_dict)
+    print("cycle number " + str(cycle_num) + " skipped " +
+          str(gapfiller.cycle_summary['skipped']) + " of " +
+          str(len(conditions)) + " conditions already satisfied")
+    return (cycle_num, (solution, dict(gapfiller.cycle_summary)))
+
+
+def _gapfill_cycle_worker(cycle):
+    global _gapfiller
+    global _phenotype_dict
+    return _gapfill_cycle(_gapfiller, _phenotype_dict, cycle)
+
+
+def _init_gapfill_worker(setup, phenotype_dict):
+    global _gapfiller
+    global _phenotype_dict
+    _gapfiller = setup()
+    _phenotype_dict = phenotype_dict
 
 
 def _build_ensemble_from_gapfill_solutions(model,solutions,universal=None):
@@ -417,118 +878,42 @@ def _build_ensemble_from_gapfill_solutions(model,solutions,universal=None):
     ensemble = Ensemble(identifier=model.id,name=model.name)
     ensemble.base_model = model.copy()
 
-    # generate member identifiers for each solution
-    # Convert the solution to a dictlist so we can retrieve reactions by id
-    solution_dict = {}
-    i = 0
-    for solution in solutions:
-        solution_id = model.id + '_gapfilled_' + str(i)
-        solution_as_rxn_objs = [universal.reactions.get_by_id(rxn).copy()
-                                    for rxn in solution]
-        solution_dict[solution_id] = DictList() + solution_as_rxn_objs
-        i += 1
-
-    # scan through other members and remove them if they are identical.
-    # as long as we're looping, we'll also find reactions that are in
-    # all solutions and get the list of reactions that are in any ensemble.
-
-    # first, convert the solution dictionary to the same structure except with
-    # reaction ids rather than reaction objects so that we can perform set
-    # operations
-    solutions_as_ids = {}
-    for member_id in solution_dict.keys():
-        solutions_as_ids[member_id] = [rxn.id for
-                                        rxn in solution_dict[member_id]]
-
-    used_members = []
-    duplicate_solutions = []
-    all_reactions = set()
-    in_all = set()
-    for member_id in solutions_as_ids.keys():
-        used_members.append(member_id)
-        member_solution = set(solutions_as_ids[member_id])
-        if in_all:
-            in_all = member_solution & in_all
-        #if this is the first ensemble member, set intersection will fail
-        # because of the empty set, so we need this exception
-        else:
-            in_all = member_solution
-        all_reactions = all_reactions | member_solution
-        for other_member in solutions_as_ids.keys():
-            if other_member not in used_members:
-                other_solution = solutions_as_ids[other_member]
-                if set(other_solution) == member_solution:
-                    duplicate_solutions.append(other_member)
-                    used_members.append(other_member)
-
-    # perform the removal of duplicate solutions on the original solution
-    # object which contains reaction objects rather than reaction ids as
-    # strings
-    for duplicate in duplicate_solutions:
-        solution_dict.pop(duplicate,None)
-
-    # Reactions that need features are those that were not in all the gapfill
-    # solutions.
-    reactions_needing_features = list(all_reactions - in_all)
-    reactions_needing_features_objs = [
-                    universal.reactions.get_by_id(rxn).copy()
-                    for rxn in reactions_needing_features]
-
-    # add reaction objects to the base model for all reactions
-    all_reactions_as_objects = [universal.reactions.get_by_id(rxn).copy()
-                                for rxn in all_reactions]
-    ensemble.base_model.add_reactions(all_reactions_as_objects)
-
-    # add metabolite objects to the base model for all new metabolites from
-    # the new reactions
-    mets = [x.metabolites for x in all_reactions_as_objects]
-    all_keys = set().union(*(d.keys() for d in mets))
-    ensemble.base_model.add_metabolites(all_keys)
+    # generate member identifiers for each solution. Solutions are hashed as
+    # sets of reaction ids, so a solution identical to an earlier one is
+    # dropped in constant time.
+    unique_solutions = {}
+    for i, solution in enumerate(solutions):
+        solution = frozenset(getattr(rxn, 'id', rxn) for rxn in solution)
+        if solution not in unique_solutions:
+            unique_solutions[solution] = model.id + '_gapfilled_' + str(i)
+    member_ids = list(unique_solutions.values())
+    solutions = list(unique_solutions.keys())
+
+    # build a boolean solution x reaction matrix over every reaction found
+    # in any solution
+    all_reactions = sorted(set().union(*solutions))
+    reaction_index = {rxn:i for i, rxn in enumerate(all_reactions)}
+    rows = [i for i, solution in enumerate(solutions) for rxn in solution]
+    columns = [reaction_index[rxn] for solution in solutions
+                for rxn in solution]
+    in_solution = np.zeros((len(solutions), len(all_reactions)), dtype=bool)
+    in_solution[rows, columns] = True
+
+    # add each reaction (and any new metabolites) to the base model once
+    ensemble.base_model.add_reactions(
+        [universal.reactions.get_by_id(rxn).copy() for rxn in all_reactions])
 
     print('building features...')
-    # generate features for the reactions that vary across solutions and add
-    # them to the ensemble. assume that all reactions have the same attribute
-    # values; if different attribute values are desired for reactions with the
-    # same ID, these need to be added to the universal reaction bag prior to
+    # Reactions that need features are those that were not in all the gapfill
+    # solutions. Assume that all reactions have the same attribute values; if
+    # different attribute values are desired for reactions with the same ID,
+    # these need to be added to the universal reaction bag prior to
     # gapfilling
-    features = DictList()
-    for reaction in reactions_needing_features_objs:
-        for attribute in REACTION_ATTRIBUTES:
-            identifier = reaction.id + "_" + attribute
-            name = reaction.name
-            feature = Feature(identifier,name)
-            feature.ensemble = ensemble
-            feature.base_component = (ensemble.base_model.reactions
-                                        .get_by_id(reaction.id))
-            feature.component_attribute = attribute
-            # get the states for this feature as {member.id:value}
-            states = {}
-            for member_id in solution_dict.keys():
-                # get the reaction and it's value for the attribute
-                if reaction.id in [rxn.id for rxn in solution_dict[member_id]]:
-                    rxn_obj = solution_dict[member_id].get_by_id(reaction.id)
-                    states[member_id] = getattr(rxn_obj,attribute)
-                else:
-                    states[member_id] = MISSING_ATTRIBUTE_DEFAULT[attribute]
-            feature.states = states
-            features += [feature]
-
-    ensemble.features = features
-
-    print('updating members...')
-    # update members for the ensemble
-    members = DictList()
-    for member_id in solution_dict.keys():
-        model_states = dict()
-        for feature in ensemble.features:
-            model_states[feature] = feature.get_model_state(member_id)
-        member = Member(ensemble=ensemble,\
-                        identifier=member_id,\
-                        name=ensemble.name,\
-                        states=model_states)
-        members += [member]
-
-    ensemble.members = members
+    reactions = [ensemble.base_model.reactions.get_by_id(rxn)
+                 for rxn in all_reactions]
+    ensemble._populate_from_presence_matrix(reactions, member_ids,
+                            in_solution,
+                            member_names=[ensemble.name] * len(member_ids))
 
     return ensemble
 
@@ -541,3 +926,131 @@ def validate(original_model, reactions, lower_bound):
             model.slim_optimize()
             return (model.solver.status == OPTIMAL and
                     model.solver.objective.value >= lower_bound)
+
+
+def validate_solutions(model, solutions, phenotype_dict, universal,
+                       lower_bound=0.05, exchange_prefix="EX_",
+                       num_processes=None):
+    """
+    Checks every gapfill solution under every condition in phenotype_dict.
+
+    The reactions from all solutions are added to a single copy of model.
+    Each solution is then represented by closing the bounds of the added
+    reactions that are not part of it (the same approach used to set the
+    state of ensemble members), rather than by adding and removing its
+    reactions one solution at a time.
+
+    Parameters
+    ----------
+    model : cobra.Model
+        The model that was gapfilled. The model is copied and is not
+        modified.
+    solutions : list or dict
+        Gapfill solutions as lists of reaction ids (or reactions), e.g. as
+        returned by the iterative gapfill functions. If a dict, keys are used
+        to identify solutions in the output; otherwise solutions are
+        identified by their position.
+    phenotype_dict : dict
+        A dictionary of condition_name:media_dict, as in
+        iterative_gapfill_from_binary_phenotypes.
+    universal : cobra.Model
+        The universal model the solution reactions were taken from.
+    lower_bound : float, 0.05
+        The minimally accepted flux for the objective.
+    exchange_prefix : string, "EX_"
+        The reaction ID prefix used to identify exchange reactions when
+        setting the medium for a condition.
+    num_processes : int, optional
+        An integer corresponding to the number of processes (i.e. cores) to
+        use. Each process keeps a single copy of the model. If None, one core
+        is used.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A boolean dataframe in which each row (index) represents a solution
+        and each column represents a condition, True where the solution
+        allows the objective to reach lower_bound in the condition.
+    """
+    if isinstance(solutions, dict):
+        solution_ids = list(solutions.keys())
+        solutions = list(solutions.values())
+    else:
+        solution_ids = list(range(len(solutions)))
+    solutions = [set(getattr(rxn, 'id', rxn) for rxn in solution)
+                 for solution in solutions]
+
+    # add every reaction used by any solution to the model once
+    model_reactions = set(rxn.id for rxn in model.reactions)
+    added_reactions = sorted(set().union(*solutions) - model_reactions)
+    test_model = model.copy()
+    test_model.add_reactions([universal.reactions.get_by_id(rxn).copy()
+                              for rxn in added_reactions])
+
+    if num_processes is None:
+        num_processes = 1
+    # Can't have fewer solutions than processes
+    num_processes = min(num_processes, len(solutions))
+
+    if num_processes > 1:
+        chunk_size = max(1, len(solutions) // num_processes)
+        pool = multiprocessing.Pool(
+            num_processes,
+            initializer = _init_validation_worker,
+            initargs = (test_model, added_reactions, phenotype_dict,
+                        lower_bound, exchange_prefix)
+        )
+        try:
+            results = pool.map(_validation_worker, solutions,
+                               chunksize = chunk_size)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        validation_args = _validation_args_for(test_model, added_reactions,
+                                               phenotype_dict, lower_bound,
+                                               exchange_prefix)
+        results = [_validate_solution(*(validation_args + (solution,)))
+                   for solution in solutions]
+
+    return DataFrame(results, index=solution_ids,
+                     columns=list(phenotype_dict.keys()))
+
+
+def _validate_solution(model, added_reactions, exchanges, phenotype_dict,
+                       lower_bound, solution):
+    results = {}
+    with model:
+        for rxn in added_reactions:
+            if rxn.id not in solution:
+                rxn.bounds = (0, 0)
+        for condition in phenotype_dict.keys():
+            with model:
+                _set_medium(exchanges, model.reactions,
+                            phenotype_dict[condition])
+                model.slim_optimize()
+                results[condition] = (model.solver.status == OPTIMAL and
+                        model.solver.objective.value >= lower_bound)
+    return results
+
+
+def _validation_worker(solution):
+    global _validation_args
+    return _validate_solution(*(_validation_args + (solution,)))
+
+
+def _init_validation_worker(model, added_reactions, phenotype_dict,
+                            lower_bound, exchange_prefix):
+    global _validation_args
+    _validation_args = _validation_args_for(model, added_reactions,
+                                            phenotype_dict, lower_bound,
+                                            exchange_prefix)
+
+
+def _validation_args_for(model, added_reactions, phenotype_dict, lower_bound,
+                         exchange_prefix):
+    added_reactions = [model.reactions.get_by_id(rxn)
+                       for rxn in added_reactions]
+    exchanges = [rxn for rxn in model.reactions
+                 if rxn.id.startswith(exchange_prefix)]
+    return (model, added_reactions, exchanges, phenotype_dict, lower_bound)
@@ -1,18 +1,24 @@
 from __future__ import absolute_import
 
 import cobra
+import gc
+import hashlib
 import json
+import numpy as np
+import os
 import pandas as pd
+import tempfile
 
 import cobra.test
-from cobra.core import Reaction
+from cobra.core import DictList, Metabolite, Model, Reaction
+from cobra.util.solver import linear_reaction_coefficients, set_objective
 
 from medusa.core.ensemble import Ensemble
 
 from cobra.io import load_json_model
 from os.path import abspath, dirname, join
 
-from pickle import load
+from pickle import dump, load, PicklingError, UnpicklingError
 
 medusa_directory = abspath(join(dirname(abspath(__file__)), ".."))
 data_dir = join(medusa_directory,"test","data","")
@@ -56,31 +62,241 @@ def load_biolog_plata():
 
     return biolog_base_composition, biolog_base_dict, biolog_thresholded
 
-def load_universal_modelseed():
-    seed_rxn_table = pd.read_csv(join(data_dir,'reactions_seed_20180809.tsv'),sep='\t')
+def load_universal_modelseed(use_cache=True, cache_dir=None):
+    """Returns the filtered modelSEED universal used for gapfilling tests.
+
+    Parsing the universal JSON and filtering it is slow, so the result is
+    cached as plain reaction and metabolite tables, keyed on the hashes of
+    the input files, and the cache is rebuilt whenever either input file
+    changes. Later calls rebuild the universal from the cached tables in
+    well under a second; its solver problem is only built when the solver
+    is first used.
+
+    Parameters
+    ----------
+    use_cache : boolean, optional
+        Whether to load from (and save to) the cache. Default True.
+    cache_dir : str, optional
+        Directory in which the cached universal is stored. Defaults to
+        medusa in the user cache directory ($XDG_CACHE_HOME, or ~/.cache).
+    """
+    source_files = [join(data_dir, 'reactions_seed_20180809.tsv'),
+                    join(data_dir, 'universal_mundy.json')]
+    if not use_cache:
+        return _build_universal_modelseed(*source_files)
+    if cache_dir is None:
+        cache_dir = _user_cache_dir()
+    tables = _load_cached(source_files, _build_universal_modelseed_tables,
+                          cache_dir, 'universal_modelseed_tables')
+    return _model_from_tables(tables)
+
+def _build_universal_modelseed(seed_rxn_file, universal_file):
+    seed_rxn_table = pd.read_csv(seed_rxn_file,sep='\t')
     seed_rxn_table['id'] = seed_rxn_table['id'] + '_c'
-    universal = load_json_model(join(data_dir,'universal_mundy.json'))
+    universal = load_json_model(universal_file)
     # remove any reactions from the universal that don't have "OK" status
     # in modelSEED (guards against mass and charge-imbalanced reactions)
-    ok_ids = list(seed_rxn_table.loc[(seed_rxn_table['status'] == 'OK') | (seed_rxn_table['status'] == 'HB')]['id'])
-    remove_rxns = []
-    for reaction in universal.reactions:
-        if reaction.id not in ok_ids:
-            remove_rxns.append(reaction)
-    universal.remove_reactions(remove_rxns)
-    # remove metabolites from the universal that are no longer present in any
-    # reactions.
-    mets_in_reactions = []
-    for reaction in universal.reactions:
-        mets = [met.id for met in reaction.metabolites]
-        mets_in_reactions.extend(mets)
-    mets_in_reactions = set(mets_in_reactions)
-
-    mets_missing_reactions = []
-    for metabolite in universal.metabolites:
-        if metabolite.id not in mets_in_reactions:
-            mets_missing_reactions.append(metabolite)
-    universal.remove_metabolites(mets_missing_reactions)
-
+    ok_ids = set(seed_rxn_table.loc[
+        seed_rxn_table['status'].isin(['OK', 'HB']), 'id'])
+    remove_rxns = [reaction for reaction in universal.reactions
+                   if reaction.id not in ok_ids]
+    # removing all reactions at once also removes metabolites that are no
+    # longer present in any reaction
+    universal.remove_reactions(remove_rxns, remove_orphans=True)
     universal.repair()
-    return universal
\ No newline at end of file
+    return universal
+
+def _build_universal_modelseed_tables(seed_rxn_file, universal_file):
+    return _model_tables(_build_universal_modelseed(seed_rxn_file,
+                                                    universal_file))
+
+_METABOLITE_COLUMNS = ['id', 'name', 'formula', 'charge', 'compartment',
+                       'notes', 'annotation']
+_REACTION_COLUMNS = ['id', 'name', 'subsystem', 'lower_bound',
+                     'upper_bound', 'gene_reaction_rule', 'notes',
+                     'annotation']
+
+class _LazySolverModel(Model):
+    """A cobra Model that builds its solver problem on first use.
+
+    Building the solver problem dominates the time taken to load a large
+    universal, and gapfilling only reads reactions from the universal, so
+    models rebuilt by _model_from_tables defer it until the solver is
+    accessed.
+    """
+
+    def _pending_solver(self):
+        # copies share __dict__ entries with the original, so the pending
+        # state only applies while the solver is the one it was created for
+        pending = self.__dict__.get('_lazy_solver')
+        if pending is not None and pending[0] is self._solver:
+            return pending
+        return None
+
+    def _get_solver(self):
+        pending = self._pending_solver()
+        if pending is not None:
+            del self._lazy_solver
+            _, objective, direction = pending
+            self._populate_solver(self.reactions, self.metabolites)
+            set_objective(self, {self.reactions.get_by_id(rxn): coefficient
+                                 for rxn, coefficient in objective.items()})
+            self.objective_direction = direction
+        return self._solver
+
+    solver = property(_get_solver, Model.solver.fset, doc=Model.solver.__doc__)
+
+    def copy(self):
+        if self._pending_solver() is None:
+            return super(_LazySolverModel, self).copy()
+        # copying the model copies its solver, so rebuild it from tables
+        # instead to keep the copy's solver pending as well
+        return _model_from_tables(_model_tables(self))
+
+def _model_tables(model):
+    """Return the contents of model as plain lists and arrays.
+
+    The tables only contain builtin types and numpy arrays, which pickle
+    and unpickle much faster than the cobra objects themselves. Genes are
+    recreated from the gene reaction rules.
+    """
+    pending = model._pending_solver() \
+        if isinstance(model, _LazySolverModel) else None
+    if pending is not None:
+        _, objective, direction = pending
+    else:
+        objective = {rxn.id: coefficient for rxn, coefficient
+                     in linear_reaction_coefficients(model).items()}
+        direction = model.objective_direction
+
+    met_index = {met.id: i for i, met in enumerate(model.metabolites)}
+    rows = []
+    columns = []
+    coefficients = []
+    for j, rxn in enumerate(model.reactions):
+        for met, coefficient in rxn.metabolites.items():
+            rows.append(met_index[met.id])
+            columns.append(j)
+            coefficients.append(coefficient)
+
+    return {
+        'id': model.id,
+        'name': model.name,
+        'compartments': dict(model.compartments),
+        'metabolites': {column: [getattr(met, column)
+                                 for met in model.metabolites]
+                        for column in _METABOLITE_COLUMNS},
+        'reactions': {column: [getattr(rxn, column)
+                               for rxn in model.reactions]
+                      for column in _REACTION_COLUMNS},
+        'rows': np.array(rows, dtype=np.int32),
+        'columns': np.array(columns, dtype=np.int32),
+        'coefficients': np.array(coefficients, dtype=float),
+        'objective': objective,
+        'objective_direction': direction}
+
+def _model_from_tables(tables):
+    """Rebuild a model from the output of _model_tables.
+
+    The reactions and metabolites are created and linked in bulk rather
+    than through Model.add_reactions, and the solver problem is deferred
+    until first use (see _LazySolverModel).
+    """
+    # creating tens of thousands of linked objects triggers many garbage
+    # collections that find nothing to free, which more than doubles the
+    # time taken, so pause the collector while building
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        model = _LazySolverModel(tables['id'], name=tables['name'])
+        model.compartments = tables['compartments']
+
+        met_table = tables['metabolites']
+        metabolites = []
+        for met_id, name, formula, charge, compartment, notes, annotation \
+                in zip(*[met_table[column] for column in _METABOLITE_COLUMNS]):
+            met = Metabolite(met_id, formula=formula, name=name,
+                             charge=charge, compartment=compartment)
+            met.notes = notes
+            met.annotation = annotation
+            met._model = model
+            metabolites.append(met)
+
+        rxn_table = tables['reactions']
+        reactions = []
+        for rxn_id, name, subsystem, lower_bound, upper_bound, rule, notes, \
+                annotation in zip(*[rxn_table[column]
+                                    for column in _REACTION_COLUMNS]):
+            rxn = Reaction(rxn_id, name=name, subsystem=subsystem,
+                           lower_bound=lower_bound, upper_bound=upper_bound)
+            rxn.notes = notes
+            rxn.annotation = annotation
+            rxn._model = model
+            reactions.append(rxn)
+
+        for i, j, coefficient in zip(tables['rows'].tolist(),
+                                     tables['columns'].tolist(),
+                                     tables['coefficients'].tolist()):
+            reactions[j]._metabolites[metabolites[i]] = coefficient
+            metabolites[i]._reaction.add(reactions[j])
+
+        model.metabolites = DictList(metabolites)
+        model.reactions = DictList(reactions)
+        # setting the rule with the reaction in the model adds its genes to
+        # model.genes
+        for rxn, rule in zip(reactions, rxn_table['gene_reaction_rule']):
+            if rule:
+                rxn.gene_reaction_rule = rule
+        model._lazy_solver = (model._solver, tables['objective'],
+                              tables['objective_direction'])
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return model
+
+def _user_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        join(os.path.expanduser('~'), '.cache')
+    return join(cache_home, 'medusa')
+
+def _hash_files(filenames):
+    sha = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def _load_cached(source_files, build, cache_dir, prefix):
+    """Load the output of build(*source_files) from cache_dir if available.
+
+    The cache file name contains the hash of the source files, so stale
+    caches are never loaded. cache_dir is created if needed. If the cache
+    cannot be read, it is rebuilt, and if it cannot be written (e.g. the
+    directory is read-only), the freshly built object is still returned.
+    """
+    cache_file = join(cache_dir,
+                      prefix + '_' + _hash_files(source_files) + '.pickle')
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as infile:
+                return load(infile)
+        except (OSError, EOFError, UnpicklingError):
+            pass
+
+    result = build(*source_files)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        handle, temp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    except OSError:
+        return result
+    # write to a temporary file first so that concurrent callers never load
+    # a partially written cache
+    try:
+        with os.fdopen(handle, 'wb') as outfile:
+            dump(result, outfile, protocol=4)
+        os.replace(temp_file, cache_file)
+    except (OSError, PicklingError):
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return result
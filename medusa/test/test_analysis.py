@@ -0,0 +1,195 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from scipy import stats
+
+from medusa.analysis import compare
+
+
+def construct_condition_results():
+    # fluxes through four reactions for 40 members in three conditions
+    random_state = np.random.RandomState(0)
+    members = ['member_' + str(i) for i in range(40)]
+    reactions = ['rxn_' + str(i) for i in range(4)]
+    reference = random_state.normal(size=(40, 4)).round(1)
+    shifted = reference + random_state.normal(0.5, 1, size=(40, 4)).round(1)
+    unchanged = reference.copy()
+    results = {'reference': pd.DataFrame(reference, index=members,
+                                         columns=reactions),
+               'shifted': pd.DataFrame(shifted, index=members,
+                                       columns=reactions),
+               'unchanged': pd.DataFrame(unchanged, index=members,
+                                         columns=reactions)}
+    return results
+
+
+def test_paired_tests_match_scipy():
+    results = construct_condition_results()
+    x = results['shifted'].values
+    y = results['reference'].values
+
+    statistic, pvalue, rank_biserial = compare.wilcoxon_signed_rank(x, y)
+    statistic_t, pvalue_t = compare.paired_ttest(x, y)
+    for column in range(x.shape[1]):
+        expected = stats.wilcoxon(x[:, column], y[:, column],
+                                  method='approx')
+        assert statistic[column] == pytest.approx(expected.statistic)
+        assert pvalue[column] == pytest.approx(expected.pvalue)
+        expected = stats.ttest_rel(x[:, column], y[:, column])
+        assert statistic_t[column] == pytest.approx(expected.statistic)
+        assert pvalue_t[column] == pytest.approx(expected.pvalue)
+    assert ((rank_biserial >= -1) & (rank_biserial <= 1)).all()
+
+
+def test_paired_tests_missing_values():
+    # members without a solution in one condition are left out of each test
+    results = construct_condition_results()
+    x = results['shifted'].values.copy()
+    y = results['reference'].values.copy()
+    x[3, 0] = np.nan
+    x[[5, 7, 11], 1] = np.nan
+    y[[0, 9], 2] = np.nan
+    x[:, 3] = np.nan
+
+    statistic, pvalue, rank_biserial = compare.wilcoxon_signed_rank(x, y)
+    statistic_t, pvalue_t = compare.paired_ttest(x, y)
+    for column in range(3):
+        expected = stats.wilcoxon(x[:, column], y[:, column],
+                                  method='approx', nan_policy='omit')
+        assert statistic[column] == pytest.approx(expected.statistic)
+        assert pvalue[column] == pytest.approx(expected.pvalue)
+        expected = stats.ttest_rel(x[:, column], y[:, column],
+                                   nan_policy='omit')
+        assert statistic_t[column] == pytest.approx(expected.statistic)
+        assert pvalue_t[column] == pytest.approx(expected.pvalue)
+    assert np.isnan(pvalue[3]) and np.isnan(pvalue_t[3])
+
+    lower, upper = compare.bootstrap_ci(x - y, random_state=0)
+    mean = np.nanmean((x - y)[:, :3], axis=0)
+    assert (lower[:3] <= mean).all() and (mean <= upper[:3]).all()
+    assert np.isnan(lower[3]) and np.isnan(upper[3])
+
+    results['shifted'] = pd.DataFrame(x, index=results['shifted'].index,
+                                      columns=results['shifted'].columns)
+    results['reference'] = pd.DataFrame(
+        y, index=results['reference'].index,
+        columns=results['reference'].columns)
+    comparison = compare.compare_conditions(results, reference='reference',
+                                            random_state=0)
+    shifted = comparison.loc['shifted']
+    differences = results['shifted'] - results['reference']
+    assert np.allclose(shifted['mean_difference'][:3],
+                       differences.mean()[:3])
+    assert np.allclose(shifted['pvalue'][:3], pvalue[:3])
+
+
+def test_adjust_pvalues():
+    pvalues = np.array([0.01, 0.04, 0.03, 0.2, np.nan])
+    assert np.allclose(compare.adjust_pvalues(pvalues, 'fdr_bh')[:4],
+                       [0.04, 0.16 / 3, 0.16 / 3, 0.2])
+    assert np.allclose(compare.adjust_pvalues(pvalues, 'holm')[:4],
+                       [0.04, 0.09, 0.09, 0.2])
+    assert np.allclose(compare.adjust_pvalues(pvalues, 'bonferroni')[:4],
+                       [0.04, 0.16, 0.12, 0.8])
+    assert np.isnan(compare.adjust_pvalues(pvalues)[4])
+
+
+def test_compare_conditions():
+    results = construct_condition_results()
+    comparison = compare.compare_conditions(results, reference='reference',
+                                            random_state=0)
+    assert list(comparison.index.get_level_values('condition').unique()) \
+        == ['shifted', 'unchanged']
+    assert len(comparison) == 8
+
+    shifted = comparison.loc['shifted']
+    differences = results['shifted'] - results['reference']
+    assert np.allclose(shifted['mean_difference'], differences.mean())
+    assert (shifted['ci_lower'] <= shifted['mean_difference']).all()
+    assert (shifted['ci_upper'] >= shifted['mean_difference']).all()
+    assert (shifted['adjusted_pvalue'] >= shifted['pvalue']).all()
+    # identical conditions can't be tested
+    assert comparison.loc['unchanged', 'pvalue'].isnull().all()
+
+    ttest = compare.compare_conditions(results, test='ttest',
+                                       correction=None, num_bootstrap=0)
+    assert 'adjusted_pvalue' not in ttest.columns
+    assert 'ci_lower' not in ttest.columns
+
+
+def test_select_representatives():
+    from medusa.analysis.representatives import (select_representatives,
+                                                 summarize_coverage)
+    # three groups of 20 rows, each a noisy copy of a different prototype
+    random_state = np.random.RandomState(0)
+    prototypes = random_state.rand(3, 200) > 0.5
+    groups = np.repeat(np.arange(3), 20)
+    noise = random_state.rand(60, 200) < 0.02
+    vectors = prototypes[groups] ^ noise
+
+    for method in ['kmedoids', 'farthest_point', 'stratified']:
+        selected, assignment, distance = select_representatives(
+            vectors, 3, method=method)
+        assert len(selected) == 3
+        assert np.allclose(distance, [
+            compare_distance(vectors[selected[a]], vectors[i])
+            for i, a in enumerate(assignment)])
+        representatives, coverage = summarize_coverage(
+            vectors, selected, assignment, distance)
+        assert representatives['weight'].sum() == pytest.approx(1)
+        assert representatives['cluster_size'].sum() == 60
+        assert coverage['max_distance'] == pytest.approx(distance.max())
+        if method != 'stratified':
+            # one representative per group, representing its whole group
+            assert sorted(groups[selected]) == [0, 1, 2]
+            assert (groups[selected][assignment] == groups).all()
+            assert coverage['mean_frequency_error'] < 0.05
+
+    # no more representatives than distinct rows
+    selected, _, distance = select_representatives(prototypes[groups], 5,
+                                                   method='farthest_point')
+    assert len(selected) == 3
+    assert (distance == 0).all()
+
+
+def compare_distance(x, y):
+    union = (x | y).sum()
+    return (x ^ y).sum() / float(union) if union else 0.
+
+
+def test_roc_assessment():
+    from medusa.analysis import phenotype
+    random_state = np.random.RandomState(0)
+    conditions = ['condition_' + str(i) for i in range(30)]
+    observed = pd.Series(random_state.rand(30) > 0.5, index=conditions)
+    growth = pd.DataFrame(random_state.rand(10, 30) > 0.4,
+                          index=['member_' + str(i) for i in range(10)],
+                          columns=conditions)
+    # conditions without an observation are ignored
+    observed['condition_0'] = np.nan
+
+    performance = phenotype.member_performance(growth, observed)
+    kept = observed.dropna().astype(bool)
+    for member, predicted in growth[kept.index].iterrows():
+        row = performance.loc[member]
+        assert row['true_positives'] == (predicted & kept).sum()
+        assert row['false_negatives'] == (~predicted & kept).sum()
+        assert row['auc'] == pytest.approx(
+            (row['sensitivity'] + row['specificity']) / 2)
+
+    # the AUC is the probability that a positive outranks a negative
+    scores = random_state.rand(3, 29).round(1)
+    positives = scores[:, kept.values]
+    negatives = scores[:, ~kept.values]
+    expected = ((positives[:, :, None] > negatives[:, None, :]).mean(
+        axis=(1, 2)) + 0.5 * (positives[:, :, None] ==
+                              negatives[:, None, :]).mean(axis=(1, 2)))
+    assert np.allclose(phenotype.roc_auc(scores, kept.values), expected)
+
+    curve, auc = phenotype.ensemble_roc(growth, observed)
+    assert curve['false_positive_rate'].iloc[0] == 0
+    assert curve['true_positive_rate'].iloc[-1] == 1
+    assert curve['false_positive_rate'].is_monotonic_increasing
+    assert auc == pytest.approx(np.trapz(curve['true_positive_rate'],
+                                         curve['false_positive_rate']))
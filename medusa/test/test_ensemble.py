@@ -1,5 +1,8 @@
+import pytest
+
 from cobra.test import create_test_model
 from medusa.core.ensemble import Ensemble
+from medusa.core.feature import Feature
 
 from pickle import load
 
@@ -142,3 +145,443 @@ def test_pickle():
         assert feature.base_component in test_ensemble.base_model.reactions
         assert feature.component_attribute in REACTION_ATTRIBUTES
         assert len(set(feature.states.values())) > 1
+
+def test_feature_matrix():
+    test_ensemble = construct_mixed_ensemble()
+
+    presence = test_ensemble.feature_matrix()
+    assert list(presence.index) == [member.id for member in test_ensemble.members]
+    # lower and upper bound features are combined per reaction
+    reactions = set(feature.base_component.id
+                    for feature in test_ensemble.features)
+    assert set(presence.columns) == reactions
+    assert presence.dtypes.eq(bool).all()
+    for member in test_ensemble.members:
+        model = test_ensemble.extract_member(member)
+        for reaction in presence.columns:
+            assert presence.loc[member.id, reaction] == \
+                (reaction in model.reactions)
+
+    bounds = test_ensemble.feature_matrix(kind='bounds')
+    for feature in test_ensemble.features:
+        column = (feature.base_component.id, feature.component_attribute)
+        for member in test_ensemble.members:
+            assert bounds.loc[member.id, column] == feature.states[member.id]
+
+    array = test_ensemble.feature_matrix(dtype=int, output='array')
+    assert (array == presence.values.astype(int)).all()
+    sparse_matrix = test_ensemble.feature_matrix(output='sparse')
+    assert (sparse_matrix.toarray() == presence.values).all()
+
+
+def test_feature_and_member_states_stay_consistent():
+    test_ensemble = construct_textbook_ensemble()
+    feature = test_ensemble.features[0]
+    member = test_ensemble.members[1]
+
+    feature.states[member.id] = 0
+    assert member.states[feature] == 0
+    member.states[feature] = -5
+    assert feature.states[member.id] == -5
+    bounds = test_ensemble.feature_matrix(kind='bounds')
+    assert bounds.loc[member.id, (feature.base_component.id,
+                                  feature.component_attribute)] == -5
+
+    # features added directly keep the states they were created with
+    reaction = test_ensemble.base_model.reactions.PFK
+    new_feature = Feature(identifier='PFK_upper_bound', ensemble=test_ensemble,
+                          base_component=reaction,
+                          component_attribute='upper_bound',
+                          states={test_ensemble.members[0].id:0,
+                                  test_ensemble.members[1].id:1000})
+    test_ensemble.features += [new_feature]
+    assert test_ensemble.members[0].states[new_feature] == 0
+    presence = test_ensemble.feature_matrix()
+    assert not presence.loc[test_ensemble.members[0].id, 'PFK']
+    assert presence.loc[test_ensemble.members[1].id, 'PFK']
+    assert new_feature.states[test_ensemble.members[1].id] == 1000
+
+def test_bulk_feature_editing():
+    test_ensemble = construct_mixed_ensemble()
+    member_ids = [member.id for member in test_ensemble.members]
+
+    # turn a reaction off in a subset of members, then back on
+    reaction = test_ensemble.features[0].base_component
+    mask = [True, False, True, False]
+    test_ensemble.set_reaction_state(reaction, False, members=mask)
+    presence = test_ensemble.feature_matrix()
+    assert not presence.loc[member_ids[0], reaction.id]
+    assert not presence.loc[member_ids[2], reaction.id]
+    for feature in test_ensemble.features:
+        if feature.base_component is reaction:
+            assert feature.states[member_ids[0]] == 0
+            assert test_ensemble.members[0].states[feature] == 0
+    test_ensemble.set_reaction_state(reaction.id, True)
+    assert test_ensemble.feature_matrix()[reaction.id].all()
+
+    # turning off a reaction that is not a feature creates its features
+    test_ensemble.set_reaction_state('PFK', False, members=[member_ids[1]])
+    assert 'PFK_upper_bound' in test_ensemble.features
+    presence = test_ensemble.feature_matrix()
+    assert list(presence['PFK']) == [True, False, True, True]
+    model = test_ensemble.extract_member(member_ids[1])
+    assert 'PFK' not in model.reactions
+
+    # filtering members keeps the views consistent
+    keep = presence['PFK']
+    test_ensemble.filter_members(keep)
+    assert [member.id for member in test_ensemble.members] == \
+        [member_ids[0], member_ids[2], member_ids[3]]
+    for feature in test_ensemble.features:
+        assert set(feature.states.keys()) == set(keep.index[keep])
+        for member in test_ensemble.members:
+            assert member.states[feature] == feature.states[member.id]
+
+    # PFK is now on in every member, so its features are invariant
+    removed = test_ensemble.remove_invariant_features()
+    assert 'PFK_upper_bound' in [feature.id for feature in removed]
+    assert 'PFK_upper_bound' not in test_ensemble.features
+    assert test_ensemble.base_model.reactions.PFK.upper_bound == 1000
+    states = test_ensemble.feature_matrix(kind='bounds', output='array')
+    for member in test_ensemble.members:
+        assert len(member.states) == len(test_ensemble.features)
+    assert test_ensemble.feature_matrix().shape[1] * 2 == states.shape[1]
+    # removed features keep their states
+    assert removed[0].states[member_ids[0]] is not None
+
+    # features can also be removed directly, by object or id
+    feature = test_ensemble.features[0]
+    num_features = len(test_ensemble.features)
+    test_ensemble.remove_features([feature.id])
+    assert feature.id not in test_ensemble.features
+    assert len(test_ensemble.features) == num_features - 1
+    for member in test_ensemble.members:
+        assert feature not in member.states
+        assert len(member.states) == len(test_ensemble.features)
+    assert feature.states[member_ids[0]] is not None
+
+def test_merge():
+    first = construct_textbook_ensemble()
+    model3 = create_test_model("textbook")
+    model3.remove_reactions(model3.reactions[5:7])
+    model3.id = 'third_textbook'
+    model4 = model3.copy()
+    model4.id = 'dual_features'
+    model4.reactions[1].lower_bound = 0
+    second = Ensemble(list_of_models=[model3, model4],
+                      identifier='second_ensemble')
+
+    merged = first.merge(second)
+    expected = construct_mixed_ensemble()
+    assert [member.id for member in merged.members] == \
+        [member.id for member in expected.members]
+    assert set(feature.id for feature in merged.features) == \
+        set(feature.id for feature in expected.features)
+    for feature in expected.features:
+        merged_feature = merged.features.get_by_id(feature.id)
+        assert merged_feature.base_component is \
+            merged.base_model.reactions.get_by_id(feature.base_component.id)
+        assert dict(merged_feature.states) == dict(feature.states)
+    for member in merged.members:
+        assert len(member.states) == len(merged.features)
+
+    # the inputs are not modified
+    assert len(first.members) == 2
+    assert len(second.members) == 2
+
+    with pytest.raises(AssertionError):
+        first.merge(first)
+
+def test_ensemble_builder(tmpdir):
+    from cobra.io import save_json_model
+    from medusa.core import EnsembleBuilder
+
+    expected = construct_mixed_ensemble()
+    models = []
+    for model_id, start, stop in [('first_textbook', 1, 3),
+                                  ('second_textbook', 4, 6),
+                                  ('third_textbook', 5, 7)]:
+        model = create_test_model("textbook")
+        model.remove_reactions(model.reactions[start:stop])
+        model.id = model_id
+        models.append(model)
+    model4 = models[2].copy()
+    model4.id = 'dual_features'
+    model4.reactions[1].lower_bound = 0
+    models.append(model4)
+
+    paths = []
+    for model in models[1:]:
+        path = str(tmpdir.join(model.id + '.json'))
+        save_json_model(model, path)
+        paths.append(path)
+
+    for num_processes in [1, 2]:
+        builder = EnsembleBuilder('textbook_ensemble')
+        builder.add_model(models[0])
+        builder.add_files(paths, num_processes=num_processes)
+        ensemble = builder.build()
+
+        assert [member.id for member in ensemble.members] == \
+            [member.id for member in expected.members]
+        assert set(feature.id for feature in ensemble.features) == \
+            set(feature.id for feature in expected.features)
+        for feature in expected.features:
+            assert dict(ensemble.features.get_by_id(feature.id).states) == \
+                dict(feature.states)
+        assert len(ensemble.base_model.reactions) == \
+            len(expected.base_model.reactions)
+
+    # building the states a few reactions at a time gives the same ensemble
+    ensemble = Ensemble(identifier='textbook_ensemble')
+    builder._populate(ensemble, block_size=7)
+    for feature in expected.features:
+        assert dict(ensemble.features.get_by_id(feature.id).states) == \
+            dict(feature.states)
+    assert ensemble._state_matrix.nbytes == expected._state_matrix.nbytes
+
+    # the added model is copied rather than modified
+    assert len(models[0].reactions) == len(expected.base_model.reactions) - 2
+    with pytest.raises(AssertionError):
+        builder.add_model(models[0])
+
+def test_non_bound_features():
+    # members that differ in gene-reaction rules, stoichiometry and
+    # objective coefficients
+    model1 = create_test_model("textbook")
+    model1.id = 'first_textbook'
+    model2 = create_test_model("textbook")
+    model2.id = 'second_textbook'
+    model2.reactions.PGI.gene_reaction_rule = 'b4025 or b0001'
+    model2.reactions.ATPM.add_metabolites({model2.metabolites.h_c:-1})
+    model3 = create_test_model("textbook")
+    model3.id = 'third_textbook'
+    model3.reactions.ATPM.add_metabolites({model3.metabolites.h2o_c:1,
+                                           model3.metabolites.pi_c:-1})
+    model3.reactions.Biomass_Ecoli_core.objective_coefficient = 0.5
+    models = [model1, model2, model3]
+    test_ensemble = Ensemble(list_of_models=models,
+                             identifier='textbook_ensemble')
+
+    feature_ids = set(feature.id for feature in test_ensemble.features)
+    assert feature_ids == set(['PGI_gene_reaction_rule',
+                               'ATPM_coefficient:h_c',
+                               'ATPM_coefficient:h2o_c',
+                               'ATPM_coefficient:pi_c',
+                               'Biomass_Ecoli_core_objective_coefficient'])
+    gpr = test_ensemble.features.get_by_id('PGI_gene_reaction_rule')
+    assert gpr.states['second_textbook'] == 'b4025 or b0001'
+    assert test_ensemble.members[0].states[gpr] == 'b4025'
+
+    for member, model in zip(test_ensemble.members, models):
+        test_ensemble.set_state(member)
+        base_model = test_ensemble.base_model
+        for reaction_id in ['PGI', 'ATPM']:
+            reaction = model.reactions.get_by_id(reaction_id)
+            base_reaction = base_model.reactions.get_by_id(reaction_id)
+            assert base_reaction.gene_reaction_rule == \
+                reaction.gene_reaction_rule
+            assert dict((met.id, coefficient) for met, coefficient
+                        in base_reaction.metabolites.items()) == \
+                dict((met.id, coefficient) for met, coefficient
+                     in reaction.metabolites.items())
+        assert base_model.reactions.Biomass_Ecoli_core.objective_coefficient \
+            == model.reactions.Biomass_Ecoli_core.objective_coefficient
+        assert abs(base_model.slim_optimize() - model.slim_optimize()) < 1e-6
+
+    # categorical states can be edited through the views
+    gpr.states['first_textbook'] = 'b0001'
+    test_ensemble.set_state('first_textbook')
+    assert test_ensemble.base_model.reactions.PGI.gene_reaction_rule == \
+        'b0001'
+
+def test_merge_non_bound_features():
+    # gene-reaction rules, stoichiometry and objective coefficients that
+    # vary within either ensemble or differ between them
+    models = []
+    for model_id in ['first', 'second', 'third', 'fourth']:
+        model = create_test_model("textbook")
+        model.id = model_id
+        models.append(model)
+    models[1].reactions.PGI.gene_reaction_rule = 'b4025 or b0001'
+    models[1].reactions.ATPM.add_metabolites({models[1].metabolites.h_c:-1})
+    models[2].reactions.PGI.gene_reaction_rule = 'b0001'
+    models[2].reactions.Biomass_Ecoli_core.objective_coefficient = 0.5
+    models[3].reactions.PGI.gene_reaction_rule = 'b0001'
+    models[3].reactions.ATPM.add_metabolites({models[3].metabolites.h2o_c:1,
+                                              models[3].metabolites.pi_c:-1})
+    models[3].remove_reactions([models[3].reactions.PFK])
+    first = Ensemble(list_of_models=models[:2], identifier='first')
+    second = Ensemble(list_of_models=models[2:], identifier='second')
+
+    merged = first.merge(second)
+    expected = Ensemble(list_of_models=models, identifier='expected')
+    assert set(feature.id for feature in merged.features) == \
+        set(feature.id for feature in expected.features)
+    for feature in expected.features:
+        assert dict(merged.features.get_by_id(feature.id).states) == \
+            dict(feature.states)
+
+    for member, model in zip(merged.members, models):
+        merged.set_state(member)
+        base_model = merged.base_model
+        for reaction_id in ['PGI', 'ATPM']:
+            reaction = model.reactions.get_by_id(reaction_id)
+            base_reaction = base_model.reactions.get_by_id(reaction_id)
+            assert base_reaction.gene_reaction_rule == \
+                reaction.gene_reaction_rule
+            assert dict((met.id, coefficient) for met, coefficient
+                        in base_reaction.metabolites.items()) == \
+                dict((met.id, coefficient) for met, coefficient
+                     in reaction.metabolites.items())
+        assert base_model.reactions.Biomass_Ecoli_core.objective_coefficient \
+            == model.reactions.Biomass_Ecoli_core.objective_coefficient
+        assert abs(base_model.slim_optimize() - model.slim_optimize()) < 1e-6
+
+def test_member_distances(tmpdir):
+    from scipy.spatial.distance import pdist, squareform
+    import numpy as np
+    import pandas as pd
+
+    test_ensemble = construct_mixed_ensemble()
+    presence = test_ensemble.feature_matrix(output='array')
+    for metric in ['jaccard', 'hamming']:
+        expected = squareform(pdist(presence, metric))
+        distances = test_ensemble.member_distances(metric=metric,
+                                                   block_size=3)
+        assert np.allclose(distances, expected)
+
+    # larger matrices are streamed to a memmap, optionally in parallel
+    random_state = np.random.RandomState(0)
+    vectors = random_state.rand(50, 70) > 0.6
+    fluxes = pd.DataFrame(vectors * random_state.rand(50, 70),
+                          index=['member_' + str(i) for i in range(50)])
+    from medusa.analysis.distance import pairwise_distances
+    filename = str(tmpdir.join('distances.npy'))
+    pairwise_distances(fluxes.values > 1e-6, block_size=16,
+                       out=filename, num_processes=2)
+    assert np.allclose(np.load(filename), squareform(pdist(vectors,
+                                                           'jaccard')))
+
+    member_ids = [member.id for member in test_ensemble.members]
+    fluxes = fluxes.iloc[:len(member_ids)]
+    fluxes.index = member_ids[::-1]
+    distances = test_ensemble.member_distances(on='fluxes', fluxes=fluxes,
+                                               metric='hamming')
+    expected = squareform(pdist(vectors[:len(member_ids)][::-1], 'hamming'))
+    assert np.allclose(distances, expected)
+
+def test_select_representatives():
+    test_ensemble = construct_mixed_ensemble()
+    representatives, coverage = test_ensemble.select_representatives(2)
+    assert len(representatives) == 2
+    assert set(representatives.index) <= \
+        set(member.id for member in test_ensemble.members)
+    assert representatives['cluster_size'].sum() == len(test_ensemble.members)
+    assert coverage['max_distance'] <= 1
+
+    representatives, coverage = test_ensemble.select_representatives(
+        len(test_ensemble.members), method='stratified')
+    assert coverage['max_distance'] == 0
+    assert coverage['max_frequency_error'] == pytest.approx(0)
+
+def test_state_matrix_matches_float_matrix():
+    import numpy as np
+    from medusa.core.storage import StateMatrix
+
+    # pairs of columns that are either both zero or both on, plus a column
+    # with arbitrary values
+    random_state = np.random.RandomState(0)
+    present = random_state.rand(30, 3) > 0.5
+    expected = np.column_stack([present[:, 0] * -1000., present[:, 0] * 1000.,
+                                present[:, 1] * 0., present[:, 1] * 5.,
+                                present[:, 2] * 10.,
+                                random_state.rand(30)])
+    states = StateMatrix(expected, groups=[[0, 1], [2, 3], [4], [5]])
+    assert states._dense.shape[1] == 1
+    assert np.array_equal(states.get(), expected)
+    assert np.array_equal(states.nonzero(), expected != 0)
+    assert states.value(3, 1) == expected[3, 1]
+    assert np.array_equal(states.row(7), expected[7])
+
+    # turning both bounds off and on keeps them packed
+    states.set([0, 1, 2], [0, 1], 0)
+    states.set([3], [0, 1], [[-1000, 1000]])
+    expected[[0, 1, 2], :2] = 0
+    expected[3, :2] = [-1000, 1000]
+    assert states._dense.shape[1] == 1
+    # other values are stored as floats
+    states.set([4], [1], 500)
+    states.set([5, 6], [4], [[1.], [2.]])
+    expected[4, 1] = 500
+    expected[[5, 6], 4] = [1., 2.]
+    assert states._dense.shape[1] == 4
+    assert np.array_equal(states.get(), expected)
+
+    column = states.append_column(np.arange(30.))
+    expected = np.column_stack([expected, np.arange(30.)])
+    assert column == 6
+    rows = [5, 1, 3, 29]
+    columns = [3, 2, 6, 0, 1]
+    taken = states.take(rows, columns)
+    assert np.array_equal(taken.get(), expected[np.ix_(rows, columns)])
+    # the unpacked pair fits again among the taken rows
+    taken.pack([[3, 4]])
+    assert np.array_equal(taken.get(), expected[np.ix_(rows, columns)])
+    assert taken._dense.shape[1] == 1
+
+def test_presence_ensemble_is_stored_as_bits():
+    import numpy as np
+    model = create_test_model("textbook")
+    reactions = list(model.reactions)
+    random_state = np.random.RandomState(0)
+    presence = random_state.rand(200, len(reactions)) > 0.3
+    member_ids = ['member_' + str(i) for i in range(200)]
+    test_ensemble = Ensemble(identifier='presence_ensemble')
+    test_ensemble.base_model = model
+    test_ensemble._populate_from_presence_matrix(reactions, member_ids,
+                                                 presence)
+
+    storage = test_ensemble._state_matrix
+    assert storage._dense.shape[1] == 0
+    assert storage.nbytes * 64 < 200 * len(test_ensemble.features) * 8
+    frame = test_ensemble.feature_matrix()
+    assert np.array_equal(frame.values,
+                          presence[:, [reactions.index(
+                              model.reactions.get_by_id(rxn_id))
+                              for rxn_id in frame.columns]])
+
+    test_ensemble.set_reaction_state('PGI', False, members=member_ids[:50])
+    test_ensemble.set_reaction_state('PGI', True, members=member_ids[:10])
+    assert storage._dense.shape[1] == 0
+    pgi = test_ensemble.features.get_by_id('PGI_lower_bound')
+    assert pgi.states['member_5'] == model.reactions.PGI.lower_bound
+    assert pgi.states['member_20'] == 0
+
+    test_ensemble.set_state('member_20')
+    assert model.reactions.PGI.bounds == (0, 0)
+    test_ensemble.set_state('member_5')
+    assert model.reactions.PGI.bounds == (-1000, 1000)
+    test_ensemble.filter_members(member_ids[:100])
+    assert test_ensemble._state_matrix._dense.shape[1] == 0
+    assert len(test_ensemble.feature_matrix()) == 100
+
+def test_state_guard():
+    test_ensemble = construct_mixed_ensemble()
+    base_model = test_ensemble.base_model
+    bounds = [reaction.bounds for reaction in base_model.reactions]
+    objective = str(base_model.objective.expression)
+
+    with pytest.raises(RuntimeError):
+        with test_ensemble.state_guard():
+            for member in test_ensemble.members:
+                test_ensemble.set_state(member)
+                # no history is recorded for the changes
+                assert not base_model._contexts
+            base_model.objective = base_model.reactions.ATPM
+            base_model.objective_direction = 'min'
+            raise RuntimeError()
+
+    assert [reaction.bounds for reaction in base_model.reactions] == bounds
+    assert str(base_model.objective.expression) == objective
+    assert base_model.objective_direction == 'max'
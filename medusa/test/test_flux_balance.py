@@ -1,3 +1,4 @@
+import pytest
 
 from cobra.test import create_test_model
 from medusa.core.ensemble import Ensemble
@@ -88,3 +89,332 @@ def test_fba_specific_models():
 
         assert rownames.contains(model1.id)
         assert rownames.contains(model2.id)
+
+def test_fba_kwargs_multiprocessing():
+        import numpy as np
+        from medusa.flux_analysis.flux_balance import (
+            optimize_ensemble_adaptive)
+        ensemble = construct_mixed_ensemble()
+        maximized = optimize_ensemble(ensemble,
+                                      return_flux='Biomass_Ecoli_core')
+        for function in [optimize_ensemble, optimize_ensemble_adaptive]:
+            single, multiprocess = [function(
+                ensemble, 'Biomass_Ecoli_core', num_processes=num_processes,
+                objective_sense='minimize')
+                for num_processes in [1, 2]]
+            if function is optimize_ensemble_adaptive:
+                single, multiprocess = single[0], multiprocess[0]
+            single = single.loc[maximized.index]
+            multiprocess = multiprocess.loc[maximized.index]
+            assert np.allclose(single.values, multiprocess.values,
+                               equal_nan=True)
+            # the minimal growth rate is zero, unlike the maximal one
+            assert np.allclose(single.dropna().values, 0)
+            assert (maximized.loc[single.dropna().index].values > 0.1).any()
+
+def test_fba_adaptive():
+        from medusa.flux_analysis.flux_balance import (
+            optimize_ensemble_adaptive)
+        ensemble = construct_mixed_ensemble()
+        all_fluxes = optimize_ensemble(ensemble,
+                                       return_flux='Biomass_Ecoli_core')
+        biomass = all_fluxes['Biomass_Ecoli_core']
+
+        # an impossible tolerance requires every member, after which the
+        # statistics are exact
+        for statistic, expected in [('mean', biomass.mean()),
+                                    ('fraction', (biomass > 0.1).mean()),
+                                    ('quantile', biomass.median())]:
+            fluxes, summary = optimize_ensemble_adaptive(
+                ensemble, 'Biomass_Ecoli_core', statistic=statistic,
+                tolerance=-1, threshold=0.1, batch_size=3, random_state=0)
+            assert summary['num_models'] == len(ensemble.members)
+            assert not summary['converged']
+            assert abs(summary['estimate'] - expected) < 1e-6
+            assert summary['ci_lower'] == summary['ci_upper']
+            assert set(fluxes.index) == set(biomass.index)
+
+        # a loose tolerance is reached after the first batch
+        fluxes, summary = optimize_ensemble_adaptive(
+            ensemble, ensemble.base_model.reactions.Biomass_Ecoli_core,
+            tolerance=10, batch_size=2, return_flux=['PGI'],
+            num_processes=2, random_state=0)
+        assert summary['converged']
+        assert summary['num_models'] == 2
+        assert list(fluxes.columns) == ['Biomass_Ecoli_core', 'PGI']
+        assert summary['ci_lower'] <= summary['estimate'] <= \
+            summary['ci_upper']
+
+        # there must be at least one member to solve
+        with pytest.raises(ValueError):
+            optimize_ensemble_adaptive(ensemble, 'Biomass_Ecoli_core',
+                                       max_models=0)
+
+def test_fba_adaptive_infeasible():
+        import numpy as np
+        from medusa.flux_analysis.flux_balance import (
+            optimize_ensemble_adaptive)
+        # 30 members with increasing maintenance, three of which can't meet
+        # it at all
+        base_model = create_test_model("textbook")
+        models = []
+        for i in range(30):
+            model = base_model.copy()
+            model.id = 'member_%d' % i
+            model.reactions.ATPM.lower_bound = 500. if i % 10 == 3 \
+                else 1. + i
+            models.append(model)
+        ensemble = Ensemble(list_of_models=models, identifier='infeasible')
+        biomass = optimize_ensemble(
+            ensemble, return_flux='Biomass_Ecoli_core')['Biomass_Ecoli_core']
+        assert biomass.isnull().sum() == 3
+
+        # infeasible members are left out of the statistic
+        for statistic, expected in [('mean', biomass.mean()),
+                                    ('fraction', (biomass.dropna() > 0.8)
+                                     .mean()),
+                                    ('quantile', biomass.median())]:
+            fluxes, summary = optimize_ensemble_adaptive(
+                ensemble, 'Biomass_Ecoli_core', statistic=statistic,
+                tolerance=-1, threshold=0.8, batch_size=7, random_state=0)
+            assert summary['num_infeasible'] == 3
+            assert abs(summary['estimate'] - expected) < 1e-6
+            assert summary['ci_lower'] == summary['ci_upper']
+            assert fluxes['Biomass_Ecoli_core'].isnull().sum() == 3
+
+        fluxes, summary = optimize_ensemble_adaptive(
+            ensemble, 'Biomass_Ecoli_core', tolerance=0.05, batch_size=5,
+            random_state=0)
+        assert summary['converged']
+        assert summary['num_models'] < len(ensemble.members)
+        assert not np.isnan(summary['estimate'])
+        assert summary['ci_lower'] <= summary['estimate'] <= \
+            summary['ci_upper']
+
+def test_predict_growth():
+        import numpy as np
+        from medusa.analysis.phenotype import predict_growth
+        ensemble = construct_mixed_ensemble()
+        # textbook has one carbon source open, glucose
+        medium = ensemble.base_model.medium
+        medium.pop('EX_glc__D_e')
+        conditions = {'glucose': dict(medium, EX_glc__D_e=10),
+                      'fructose': dict(medium, EX_fru_e=10),
+                      'acetate': dict(medium, EX_ac_e=10),
+                      'none': medium}
+        bounds = [rxn.bounds for rxn in ensemble.base_model.reactions]
+
+        values = predict_growth(ensemble, conditions, return_values=True)
+        assert [rxn.bounds for rxn in ensemble.base_model.reactions] == \
+            bounds
+        for member in ensemble.members:
+            for condition, condition_medium in conditions.items():
+                with ensemble.base_model as model:
+                    ensemble.set_state(member)
+                    model.medium = condition_medium
+                    expected = model.slim_optimize(error_value=np.nan)
+                assert np.isclose(values.loc[member.id, condition],
+                                  expected, atol=1e-6, equal_nan=True)
+        # without a carbon source the maintenance requirement can't be met
+        assert values['none'].isnull().all()
+
+        growth = predict_growth(ensemble, conditions, num_processes=2,
+                                specific_models=[ensemble.members[0].id])
+        assert growth.shape == (1, 4)
+        assert growth.loc[ensemble.members[0].id, 'glucose']
+        assert not growth.loc[ensemble.members[0].id, 'none']
+
+def test_production_envelope():
+        import numpy as np
+        from medusa.flux_analysis.envelope import (
+            ensemble_production_envelope)
+        ensemble = construct_mixed_ensemble()
+        base_model = ensemble.base_model
+        bounds = [rxn.bounds for rxn in base_model.reactions]
+        # growth over a range of oxygen uptake rates
+        points = np.linspace(0, -40, 5)
+        envelope, vertices = ensemble_production_envelope(
+            ensemble, 'EX_o2_e', points, objective='Biomass_Ecoli_core',
+            breakpoints=True)
+        assert envelope.shape == (len(ensemble.members), len(points))
+        assert [rxn.bounds for rxn in base_model.reactions] == bounds
+
+        # the vertices describe the optimal objective exactly, including
+        # between the points
+        scan = np.linspace(-40, 0, 37)
+        member = ensemble.members.get_by_id('first_textbook')
+        member_vertices = vertices[member.id]
+        assert len(member_vertices) > len(points)
+        with base_model:
+            ensemble.set_state(member)
+            oxygen = base_model.reactions.EX_o2_e
+            for point, value in zip(points, envelope.loc[member.id].values):
+                oxygen.bounds = (point, point)
+                assert np.isclose(base_model.slim_optimize(), value)
+            for point in scan:
+                oxygen.bounds = (point, point)
+                assert np.isclose(base_model.slim_optimize(),
+                                  np.interp(point, member_vertices['flux'],
+                                            member_vertices['objective']))
+
+        parallel = ensemble_production_envelope(
+            ensemble, base_model.reactions.EX_o2_e, points, fix=False,
+            num_processes=2)
+        assert parallel.shape == envelope.shape
+        # limiting uptake can only improve growth over fixing it
+        assert (parallel.values >= envelope.values - 1e-9).all()
+
+def test_production_envelope_restores_bounds():
+        import numpy as np
+        from medusa.flux_analysis.envelope import (
+            ensemble_production_envelope)
+        ensemble = construct_mixed_ensemble()
+        base_model = ensemble.base_model
+        base_model.reactions.ATPM.bounds = (8.39, 20)
+        # without fix, maximizing ATPM reaches its upper bound, unless the
+        # point lies above it; every member starts from its own bounds
+        envelope = ensemble_production_envelope(
+            ensemble, 'ATPM', [10, 30], objective='ATPM', fix=False)
+        assert np.allclose(envelope[10.], 20.)
+        assert np.allclose(envelope[30.], 30.)
+        assert base_model.reactions.ATPM.bounds == (8.39, 20)
+
+        # members that lack the reaction have no envelope
+        presence = ensemble.feature_matrix()['ACONTb']
+        envelope, vertices = ensemble_production_envelope(
+            ensemble, 'ACONTb', [0, 1], breakpoints=True)
+        assert envelope.loc[~presence].isnull().values.all()
+        assert envelope.loc[presence].notnull().values.all()
+        for member_id in presence.index[~presence]:
+            assert len(vertices[member_id]) == 0
+
+def test_dfba():
+        import numpy as np
+        from medusa.flux_analysis.dynamic import ensemble_dfba
+        ensemble = construct_mixed_ensemble()
+        bounds = [rxn.bounds for rxn in ensemble.base_model.reactions]
+        biomass, concentrations = ensemble_dfba(
+            ensemble, {'EX_glc__D_e': 10., 'EX_ac_e': 0.}, 0.01,
+            time_step=0.5, num_steps=30, max_uptake={'EX_glc__D_e': 10.,
+                                                     'EX_ac_e': 5.})
+        assert [rxn.bounds for rxn in ensemble.base_model.reactions] == \
+            bounds
+        assert biomass.shape == (len(ensemble.members), 31)
+        assert set(concentrations) == set(['EX_glc__D_e', 'EX_ac_e'])
+        glucose = concentrations['EX_glc__D_e']
+        assert (biomass.values[:, 0] == 0.01).all()
+        assert (np.diff(biomass.values, axis=1) >= 0).all()
+        assert (np.diff(glucose.values, axis=1) <= 1e-12).all()
+        assert (glucose.values >= 0).all()
+        # the glucose is used up and the cultures grow, apart from
+        # second_textbook, which can't grow but consumes glucose for
+        # maintenance
+        growing = biomass.index != 'second_textbook'
+        assert (glucose.values[growing, -1] < 1e-6).all()
+        assert (biomass.values[growing, -1] > 0.1).all()
+        assert (biomass.loc['second_textbook'] == 0.01).all()
+        assert glucose.loc['second_textbook'].values[-1] < 10.
+
+        # the first step grows at the maximal growth rate of each member
+        member = ensemble.members[0]
+        with ensemble.base_model as model:
+            ensemble.set_state(member)
+            model.reactions.EX_glc__D_e.lower_bound = -10. * 10. / 10.01
+            model.reactions.EX_ac_e.lower_bound = 0.
+            growth = model.slim_optimize()
+        assert np.isclose(biomass.loc[member.id].values[1],
+                          0.01 * np.exp(growth * 0.5))
+
+        parallel, parallel_concentrations = ensemble_dfba(
+            ensemble, {ensemble.base_model.reactions.EX_glc__D_e: 10.},
+            0.01, time_step=0.5, num_steps=10, num_processes=2,
+            specific_models=[member.id])
+        serial, _ = ensemble_dfba(
+            ensemble, {'EX_glc__D_e': 10.}, 0.01, time_step=0.5,
+            num_steps=10, specific_models=[member.id])
+        assert np.allclose(parallel.values, serial.values)
+        assert list(parallel_concentrations) == ['EX_glc__D_e']
+
+
+def test_fba_duals():
+        import numpy as np
+        ensemble = construct_mixed_ensemble()
+        fluxes, shadow_prices, reduced_costs = optimize_ensemble(
+            ensemble, return_shadow_prices=True, return_reduced_costs=True)
+        assert shadow_prices.shape == (len(ensemble.members),
+                                       len(ensemble.base_model.metabolites))
+        assert reduced_costs.shape == fluxes.shape
+        # the values match cobra's solution for every member. Duals are not
+        # unique, so each is compared with the basis that was just solved.
+        for member in ensemble.members:
+            fluxes, shadow_prices, reduced_costs = optimize_ensemble(
+                ensemble, specific_models=[member.id],
+                return_shadow_prices=True, return_reduced_costs=True)
+            solution = ensemble.base_model.optimize()
+            assert np.allclose(fluxes.loc[member.id],
+                               solution.fluxes[fluxes.columns])
+            assert np.allclose(shadow_prices.loc[member.id],
+                               solution.shadow_prices[shadow_prices.columns])
+            assert np.allclose(reduced_costs.loc[member.id],
+                               solution.reduced_costs[reduced_costs.columns])
+
+        fluxes, reduced_costs = optimize_ensemble(
+            ensemble, return_flux=['PGI', 'EX_glc__D_e'],
+            return_reduced_costs=True, num_processes=2)
+        assert list(reduced_costs.columns) == ['PGI', 'EX_glc__D_e']
+        assert reduced_costs.shape == (len(ensemble.members), 2)
+        assert fluxes.shape == (len(ensemble.members), 2)
+
+def test_minimal_medium():
+        import numpy as np
+        from cobra.medium import minimal_medium
+        from medusa.flux_analysis.medium import ensemble_minimal_medium
+        ensemble = construct_mixed_ensemble()
+        base_model = ensemble.base_model
+        bounds = [rxn.bounds for rxn in base_model.reactions]
+        variables = len(base_model.variables)
+        constraints = len(base_model.constraints)
+        objective = str(base_model.objective.expression)
+
+        medium = ensemble_minimal_medium(ensemble, minimize_components=True)
+        assert medium.shape == (len(ensemble.members),
+                                len(base_model.exchanges))
+        assert [rxn.bounds for rxn in base_model.reactions] == bounds
+        assert len(base_model.variables) == variables
+        assert len(base_model.constraints) == constraints
+        assert str(base_model.objective.expression) == objective
+        # second_textbook can't grow
+        assert medium.loc['second_textbook'].isnull().all()
+        for member in ['first_textbook', 'third_textbook']:
+            expected = minimal_medium(ensemble.extract_member(member), 0.1,
+                                      minimize_components=True)
+            assert (medium.loc[member] > 0).sum() == len(expected)
+
+        # the smallest total import flux is unique, although the medium
+        # reaching it may not be
+        total = ensemble_minimal_medium(ensemble, num_processes=2,
+                                        specific_models=['first_textbook'])
+        expected = minimal_medium(ensemble.extract_member('first_textbook'),
+                                  0.1)
+        assert total.shape == (1, len(base_model.exchanges))
+        assert np.isclose(total.loc['first_textbook'].sum(), expected.sum())
+
+def test_dfba_absent_exchange():
+        from medusa.flux_analysis.dynamic import ensemble_dfba
+        with_glucose = create_test_model("textbook")
+        with_glucose.id = 'with_glucose'
+        without_glucose = create_test_model("textbook")
+        without_glucose.remove_reactions(
+            [without_glucose.reactions.EX_glc__D_e])
+        without_glucose.id = 'without_glucose'
+        ensemble = Ensemble(list_of_models=[with_glucose, without_glucose],
+                            identifier='glucose_ensemble')
+        for num_processes in [1, 2]:
+            biomass, concentrations = ensemble_dfba(
+                ensemble, {'EX_glc__D_e': 10.}, 0.01, time_step=0.5,
+                num_steps=10, num_processes=num_processes)
+            glucose = concentrations['EX_glc__D_e']
+            assert biomass.loc['with_glucose'].values[-1] > 0.01
+            # the member without the exchange can't take up glucose or grow
+            assert (glucose.loc['without_glucose'] == 10.).all()
+            assert (biomass.loc['without_glucose'] == 0.01).all()
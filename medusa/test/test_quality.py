@@ -0,0 +1,75 @@
+
+from cobra.test import create_test_model
+
+from medusa.core.ensemble import Ensemble
+from medusa.quality import mass_balance
+
+
+def test_check_mass_balance():
+    model = create_test_model("textbook")
+    imbalance, unknown = mass_balance.check_mass_balance(model)
+    assert 'charge' in imbalance.columns
+    assert not unknown.any()
+
+    # agrees with cobrapy's reaction-by-reaction check
+    for reaction in model.reactions:
+        expected = reaction.check_mass_balance()
+        for element in imbalance.columns:
+            assert abs(imbalance.loc[reaction.id, element] -
+                       expected.get(element, 0)) < 1e-9
+
+
+def test_element_matrix():
+    from cobra import Metabolite
+    formulas = ['C6H12O6', 'Fe0.5S', 'C.', 'C6H12O6.', 'R', None]
+    metabolites = [Metabolite('met_' + str(i), formula=formula)
+                   for i, formula in enumerate(formulas)]
+    elements, matrix, known = mass_balance.element_matrix(metabolites)
+    # malformed counts make a formula unknown instead of failing
+    assert list(known) == [True, True, False, False, True, False]
+    matrix = matrix.toarray()
+    counts = dict(zip(elements, matrix[:, 0]))
+    assert counts == {'C': 6, 'H': 12, 'O': 6, 'Fe': 0, 'S': 0, 'R': 0}
+    assert dict(zip(elements, matrix[:, 1]))['Fe'] == 0.5
+    assert dict(zip(elements, matrix[:, 1]))['S'] == 1
+    assert not matrix[:, 2:4].any()
+
+
+def test_find_imbalanced_reactions():
+    model = create_test_model("textbook")
+    assert mass_balance.find_imbalanced_reactions(model) == []
+
+    model.reactions.PGI.add_metabolites({model.metabolites.h_c:1})
+    model.metabolites.get_by_id('13dpg_c').formula = None
+    imbalanced = mass_balance.find_imbalanced_reactions(model)
+    assert 'PGI' in imbalanced
+    assert set(['PGK', 'GAPD']) <= set(imbalanced)
+    # reactions with unknown formulas can be kept instead
+    imbalanced = mass_balance.find_imbalanced_reactions(model,
+                                                        allow_unknown=True)
+    assert imbalanced == ['PGI']
+    # charge can be ignored, but the extra proton is still a mass imbalance
+    imbalanced = mass_balance.find_imbalanced_reactions(
+        model, check_charge=False, allow_unknown=True)
+    assert imbalanced == ['PGI']
+
+
+def test_remove_imbalanced_reactions():
+    model1 = create_test_model("textbook")
+    model1.remove_reactions([model1.reactions.PGI])
+    model1.id = 'first_textbook'
+    model2 = create_test_model("textbook")
+    model2.remove_reactions([model2.reactions.FUM])
+    model2.id = 'second_textbook'
+    ensemble = Ensemble(list_of_models=[model1, model2],
+                        identifier='textbook_ensemble')
+    ensemble.base_model.reactions.PGI.add_metabolites(
+        {ensemble.base_model.metabolites.h_c:1})
+
+    removed = mass_balance.remove_imbalanced_reactions(ensemble)
+    assert removed == ['PGI']
+    assert 'PGI' not in ensemble.base_model.reactions
+    assert [feature.id for feature in ensemble.features] == \
+        ['FUM_lower_bound', 'FUM_upper_bound']
+    for member in ensemble.members:
+        assert set(member.states.keys()) == set(ensemble.features)
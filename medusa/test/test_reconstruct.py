@@ -1,11 +1,15 @@
+import numpy as np
+import os
 import pandas as pd
+import pytest
 
 from cobra.test import create_test_model
 from cobra.io import load_json_model
-from cobra.core import Reaction
+from cobra.core import Metabolite, Model, Reaction
 
 from medusa.core.ensemble import Ensemble
-from medusa.reconstruct import expand
+from medusa.reconstruct import degrade, expand
+from medusa.test import load_universal_modelseed
 
 REACTION_ATTRIBUTES = ['lower_bound', 'upper_bound']
 MISSING_ATTRIBUTE_DEFAULT = {'lower_bound':0,'upper_bound':0}
@@ -147,35 +151,412 @@ def test_iterative_gapfill_from_binary_phenotypes():
             # flux or more
             assert ensemble.base_model.slim_optimize() > lower_bound*0.99
 
+def construct_textbook_gapfill_problem():
+    # remove transporters and central carbon metabolism reactions from the
+    # textbook model and place them in a universal model to gapfill from.
+    model = create_test_model("textbook")
+    removed = ['GLCpts', 'FRUpts2', 'SUCCt2_2', 'MALt2_2', 'PGI', 'ENO',
+                'PYK', 'PPC', 'ME1', 'ME2']
+    universal = Model('universal')
+    universal.add_reactions([model.reactions.get_by_id(rxn).copy()
+                                for rxn in removed])
+    model.remove_reactions([model.reactions.get_by_id(rxn)
+                                for rxn in removed])
 
-def load_universal_modelseed():
-    seed_rxn_table = pd.read_csv('./medusa/test/data/reactions_seed_20180809.tsv',sep='\t')
-    seed_rxn_table['id'] = seed_rxn_table['id'] + '_c'
-    universal = load_json_model('./medusa/test/data/universal_mundy.json')
-    # remove any reactions from the universal that don't have "OK" status
-    # in modelSEED (guards against mass and charge-imbalanced reactions)
-    ok_ids = list(seed_rxn_table.loc[(seed_rxn_table['status'] == 'OK') | (seed_rxn_table['status'] == 'HB')]['id'])
-    remove_rxns = []
-    for reaction in universal.reactions:
-        if reaction.id not in ok_ids:
-            remove_rxns.append(reaction)
-    universal.remove_reactions(remove_rxns)
-    # remove metabolites from the universal that are no longer present in any
-    # reactions.
-    mets_in_reactions = []
-    for reaction in universal.reactions:
-        mets = [met.id for met in reaction.metabolites]
-        mets_in_reactions.extend(mets)
-    mets_in_reactions = set(mets_in_reactions)
-
-    mets_missing_reactions = []
-    for metabolite in universal.metabolites:
-        if metabolite.id not in mets_in_reactions:
-            mets_missing_reactions.append(metabolite)
-    universal.remove_metabolites(mets_missing_reactions)
-
-    universal.repair()
-    return universal
+    # single carbon source conditions on top of a minimal medium
+    base_medium = {'EX_o2_e':1000, 'EX_h2o_e':1000, 'EX_h_e':1000,
+                    'EX_nh4_e':1000, 'EX_pi_e':1000, 'EX_co2_e':1000}
+    phenotype_dict = {}
+    for source in ['EX_glc__D_e', 'EX_fru_e', 'EX_succ_e', 'EX_mal__L_e']:
+        phenotype_dict[source] = base_medium.copy()
+        phenotype_dict[source][source] = 10
+    return model, universal, phenotype_dict
+
+def test_iterative_gapfill_multiprocessing():
+    model, universal, phenotype_dict = construct_textbook_gapfill_problem()
+    conditions = list(phenotype_dict.keys())
+    cycle_order = [conditions, conditions[::-1],
+                    conditions[1:] + conditions[:1]]
+
+    # distributing cycles across processes should not change the solutions
+    # or their order
+    for gapfill in [expand._continuous_iterative_binary_gapfill,
+                    expand._integer_iterative_binary_gapfill]:
+        single = gapfill(model, phenotype_dict, cycle_order,
+                        universal=universal,
+                        output_ensemble_size=len(cycle_order),
+                        num_processes=1)
+        multi = gapfill(model, phenotype_dict, cycle_order,
+                        universal=universal,
+                        output_ensemble_size=len(cycle_order),
+                        num_processes=2)
+        assert len(single) == len(cycle_order)
+        assert [set(s) for s in single] == [set(s) for s in multi]
+
+    # the model passed in should not be modified by gapfilling
+    assert 'PGI' not in model.reactions
+    assert model.medium['EX_glc__D_e'] == 10
+
+    ensemble = expand.iterative_gapfill_from_binary_phenotypes(model,
+                        universal, phenotype_dict, 3, num_processes=2,
+                        inclusion_threshold=1E-10)
+    assert len(ensemble.members) > 0
+
+def test_gapfiller_reuse():
+    model, universal, phenotype_dict = construct_textbook_gapfill_problem()
+    conditions = list(phenotype_dict.keys())
+    for gapfill_type in ['continuous', 'integer']:
+        gapfiller = expand.Gapfiller(model, universal,
+                                    gapfill_type=gapfill_type,
+                                    inclusion_threshold=1E-8)
+        # only reactions missing from the model are candidates
+        assert gapfiller.candidates == set(rxn.id for rxn
+                                            in universal.reactions)
+
+        # the same problem can be filled for many cycles, and each cycle's
+        # solution restores growth in every condition
+        first_cycle = gapfiller.fill_cycle(conditions, phenotype_dict)
+        gapfiller.fill_cycle(conditions[::-1], phenotype_dict)
+        repeat_cycle = gapfiller.fill_cycle(conditions, phenotype_dict)
+        assert set(first_cycle) == set(repeat_cycle)
+        for condition in conditions:
+            assert gapfiller.validate(first_cycle, phenotype_dict[condition])
+
+    # a single condition requires only its own transporter
+    gapfiller.reset()
+    solution = gapfiller.fill(phenotype_dict['EX_succ_e'])
+    assert 'SUCCt2_2' in solution
+    assert 'GLCpts' not in solution
+
+def test_gapfill_skips_satisfied_conditions():
+    model, universal, phenotype_dict = construct_textbook_gapfill_problem()
+    conditions = list(phenotype_dict.keys())
+    # a condition with both glucose and fructose can grow on the reactions
+    # filled for either of them
+    phenotype_dict['glc_fru'] = dict(phenotype_dict['EX_glc__D_e'],
+                                     EX_fru_e=10)
+    cycle_order = [conditions + ['glc_fru'], ['glc_fru'] + conditions]
+    for gapfill in [expand._continuous_iterative_binary_gapfill,
+                    expand._integer_iterative_binary_gapfill]:
+        solutions, summary = gapfill(model, phenotype_dict, cycle_order,
+                                     universal=universal,
+                                     output_ensemble_size=len(cycle_order),
+                                     return_summary=True)
+        # filling glc_fru first also covers glucose or fructose, whichever
+        # transporter it used
+        assert list(summary['skipped']) == [1, 1]
+        assert list(summary['filled']) == [len(conditions)] * 2
+        # skipping a condition does not change the solution
+        expected = gapfill(model, phenotype_dict, [conditions],
+                           universal=universal, output_ensemble_size=1)
+        assert set(solutions[0]) == set(expected[0])
+
+    # the public function passes the summary through
+    for gapfill_type in ['continuous', 'integer']:
+        ensemble, summary = expand.iterative_gapfill_from_binary_phenotypes(
+            model, universal, phenotype_dict, 2, gapfill_type=gapfill_type,
+            inclusion_threshold=1E-10, return_summary=True)
+        assert len(ensemble.members) > 0
+        assert list(summary.columns) == ['filled', 'skipped']
+        assert len(summary) == 2
+        assert (summary['filled'] + summary['skipped'] ==
+                len(phenotype_dict)).all()
+
+def test_reachable_universal():
+    model, universal, phenotype_dict = construct_textbook_gapfill_problem()
+    # a reaction into a metabolite nothing consumes, and a loop of
+    # metabolites that nothing produces, can never carry flux
+    dead_end = Reaction('DEAD_END')
+    dead_end.add_metabolites({model.metabolites.pyr_c: -1,
+                              Metabolite('dead_c', compartment='c'): 1})
+    first = Metabolite('loop1_c', compartment='c')
+    second = Metabolite('loop2_c', compartment='c')
+    loop = Reaction('LOOP')
+    loop.bounds = (-1000, 1000)
+    loop.add_metabolites({first: -1, second: 1,
+                          model.metabolites.atp_c: -1,
+                          model.metabolites.adp_c: 1})
+    # a metabolite produced from the model and exported is fine
+    made = Metabolite('made_c', compartment='c')
+    make = Reaction('MAKE')
+    make.add_metabolites({model.metabolites.pyr_c: -1, made: 1})
+    export = Reaction('EXPORT')
+    export.add_metabolites({made: -1})
+    universal.add_reactions([dead_end, loop, make, export])
+
+    pruned = expand.reachable_universal(model, universal,
+                                        media=phenotype_dict.values())
+    kept = set(rxn.id for rxn in pruned.reactions)
+    assert kept == (set(rxn.id for rxn in universal.reactions) -
+                    set(['DEAD_END', 'LOOP']))
+    # unless the loop's metabolites are provided
+    pruned = expand.reachable_universal(model, universal,
+                                        seed_metabolites=['loop1_c',
+                                                          'loop2_c'])
+    assert 'LOOP' in pruned.reactions
+    assert 'DEAD_END' not in pruned.reactions
+    # or gapfilling may add reactions that consume any metabolite, or also
+    # take up any metabolite
+    pruned = expand.reachable_universal(model, universal,
+                                        demand_reactions=True)
+    assert 'DEAD_END' in pruned.reactions
+    assert 'LOOP' not in pruned.reactions
+    pruned = expand.reachable_universal(model, universal,
+                                        exchange_reactions=True,
+                                        demand_reactions=True)
+    assert len(pruned.reactions) == len(universal.reactions)
+
+    # gapfilling with the pruned universal restores growth in every
+    # condition, although ties between equally good solutions may be broken
+    # differently
+    conditions = list(phenotype_dict.keys())
+    cycle_order = [conditions, conditions[::-1]]
+    pruned = expand.reachable_universal(model, universal,
+                                        media=phenotype_dict.values())
+    for gapfill_type in ['continuous', 'integer']:
+        gapfill = getattr(expand,
+                          '_' + gapfill_type + '_iterative_binary_gapfill')
+        solutions = gapfill(model, phenotype_dict, cycle_order,
+                            universal=pruned,
+                            output_ensemble_size=len(cycle_order))
+        assert len(solutions) == len(cycle_order)
+        gapfiller = expand.Gapfiller(model, universal,
+                                     gapfill_type=gapfill_type)
+        for solution in solutions:
+            for condition in conditions:
+                assert gapfiller.validate(solution, phenotype_dict[condition])
+
+    ensemble = expand.iterative_gapfill_from_binary_phenotypes(model,
+                        universal, phenotype_dict, 2, prune_universal=True)
+    assert len(ensemble.members) > 0
+
+def test_build_ensemble_from_gapfill_solutions():
+    model, universal, phenotype_dict = construct_textbook_gapfill_problem()
+    solutions = [['GLCpts', 'PGI', 'ENO'],
+                 ['ENO', 'GLCpts', 'PGI'], # duplicate of the first solution
+                 ['GLCpts', 'ENO', 'PYK'],
+                 ['ENO', 'FRUpts2']]
+    ensemble = expand._build_ensemble_from_gapfill_solutions(model,
+                                        solutions, universal=universal)
+
+    # duplicate solutions are dropped, keeping the first occurrence
+    assert [member.id for member in ensemble.members] == [
+                model.id + '_gapfilled_' + str(i) for i in [0, 2, 3]]
+
+    # every reaction is added to the base model, but only reactions that
+    # vary across solutions become features
+    for rxn in ['GLCpts', 'PGI', 'ENO', 'PYK', 'FRUpts2']:
+        assert rxn in ensemble.base_model.reactions
+    feature_reactions = set(feature.base_component.id
+                            for feature in ensemble.features)
+    assert feature_reactions == set(['GLCpts', 'PGI', 'PYK', 'FRUpts2'])
+    assert len(ensemble.features) == 8
+
+    # states match the solutions in both the features and the members
+    pgi_upper = ensemble.features.get_by_id('PGI_upper_bound')
+    assert pgi_upper.states[model.id + '_gapfilled_0'] == \
+                universal.reactions.PGI.upper_bound
+    assert pgi_upper.states[model.id + '_gapfilled_2'] == 0
+    for member in ensemble.members:
+        for feature, state in member.states.items():
+            assert feature.states[member.id] == state
+
+    # solutions returned as reaction objects (e.g. from cobra's GapFiller)
+    # are handled the same way
+    as_objects = [[universal.reactions.get_by_id(rxn) for rxn in solution]
+                    for solution in solutions]
+    from_objects = expand._build_ensemble_from_gapfill_solutions(model,
+                                        as_objects, universal=universal)
+    assert len(from_objects.members) == 3
+    assert len(from_objects.features) == 8
+
+def test_degrade_reactions():
+    model = create_test_model("textbook")
+    num_reactions = 5
+
+    ensemble = degrade.degrade_reactions(model, num_reactions,
+                                            num_models=20)
+    assert len(ensemble.members) == 20
+    # the objective is never removed, and only reactions removed from some
+    # but not all members become features
+    assert 'Biomass_Ecoli_core_lower_bound' not in ensemble.features
+    for member in ensemble.members:
+        removed = set(feature.base_component.id for feature, state
+                      in member.states.items() if state == 0 and
+                      getattr(model.reactions.get_by_id(
+                        feature.base_component.id),
+                        feature.component_attribute) != 0)
+        assert len(removed) == num_reactions
+    # the original model is not modified
+    assert len(model.reactions) == len(ensemble.base_model.reactions)
+
+    viable = degrade.degrade_reactions(model, num_reactions, num_models=10,
+                                        viability_threshold=0.1,
+                                        num_processes=2)
+    assert len(viable.members) == 10
+    for member in viable.members:
+        viable.set_state(member)
+        assert viable.base_model.slim_optimize() >= 0.1
+
+    # impossible thresholds are reported rather than retried forever
+    with pytest.raises(RuntimeError):
+        degrade.degrade_reactions(model, num_reactions, num_models=2,
+                                    viability_threshold=1000,
+                                    max_attempts=10)
+
+def test_validate_solutions():
+    model, universal, phenotype_dict = construct_textbook_gapfill_problem()
+    complete = ['GLCpts', 'FRUpts2', 'SUCCt2_2', 'MALt2_2', 'PGI', 'ENO',
+                'PYK', 'PPC', 'ME1', 'ME2']
+    no_transporters = ['PGI', 'ENO', 'PYK', 'PPC', 'ME1', 'ME2']
+    solutions = {'complete':complete, 'no_transporters':no_transporters,
+                 'glucose_only':['GLCpts', 'PGI', 'ENO']}
+    for num_processes in [1, 2]:
+        results = expand.validate_solutions(model, solutions, phenotype_dict,
+                                            universal,
+                                            num_processes=num_processes)
+        assert list(results.index) == list(solutions.keys())
+        assert list(results.columns) == list(phenotype_dict.keys())
+        assert results.loc['complete'].all()
+        assert not results.loc['no_transporters'].any()
+        assert results.loc['glucose_only', 'EX_glc__D_e']
+        assert not results.loc['glucose_only', 'EX_succ_e']
+
+    # the results agree with validating one solution at a time
+    gapfiller = expand.Gapfiller(model, universal)
+    for condition in phenotype_dict.keys():
+        assert gapfiller.validate(solutions['glucose_only'],
+                                  phenotype_dict[condition]) == \
+                results.loc['glucose_only', condition]
+
+
+def test_load_cached_universal(tmpdir):
+    from cobra.io import save_json_model
+    from medusa.test import _load_cached
+
+    universal_file = str(tmpdir.join('universal.json'))
+    save_json_model(create_test_model('textbook'), universal_file)
+    calls = []
+    def build(filename):
+        calls.append(filename)
+        return load_json_model(filename)
+
+    first = _load_cached([universal_file], build, str(tmpdir), 'universal')
+    second = _load_cached([universal_file], build, str(tmpdir), 'universal')
+    assert len(calls) == 1
+    assert [rxn.id for rxn in first.reactions] == \
+        [rxn.id for rxn in second.reactions]
+    assert second.slim_optimize() == pytest.approx(first.slim_optimize())
+
+    # changing an input file invalidates the cache
+    universal = load_json_model(universal_file)
+    universal.remove_reactions([universal.reactions.PGI])
+    save_json_model(universal, universal_file)
+    third = _load_cached([universal_file], build, str(tmpdir), 'universal')
+    assert len(calls) == 2
+    assert 'PGI' not in third.reactions
+
+    # a missing cache directory is created, and a corrupt cache is rebuilt
+    cache_dir = str(tmpdir.join('cache', 'medusa'))
+    _load_cached([universal_file], build, cache_dir, 'universal')
+    cache_files = os.listdir(cache_dir)
+    assert len(cache_files) == 1
+    with open(os.path.join(cache_dir, cache_files[0]), 'wb') as outfile:
+        outfile.write(b'corrupt')
+    fourth = _load_cached([universal_file], build, cache_dir, 'universal')
+    assert len(calls) == 4
+    assert 'PGI' not in fourth.reactions
+
+    # a cache directory that can't be created doesn't stop the build
+    blocked = str(tmpdir.join('blocked'))
+    open(blocked, 'w').close()
+    fifth = _load_cached([universal_file], build,
+                         os.path.join(blocked, 'medusa'), 'universal')
+    assert len(calls) == 5
+    assert 'PGI' not in fifth.reactions
+
+def test_user_cache_dir(monkeypatch):
+    from medusa.test import _user_cache_dir
+    monkeypatch.setenv('XDG_CACHE_HOME', '/tmp/xdg_cache')
+    assert _user_cache_dir() == os.path.join('/tmp/xdg_cache', 'medusa')
+    monkeypatch.delenv('XDG_CACHE_HOME')
+    assert _user_cache_dir() == os.path.join(os.path.expanduser('~'),
+                                             '.cache', 'medusa')
+
+def test_model_tables_round_trip():
+    from pickle import dumps, loads
+    from medusa.test import _model_from_tables, _model_tables
+
+    textbook = create_test_model('textbook')
+    model = _model_from_tables(loads(dumps(_model_tables(textbook))))
+    assert [rxn.id for rxn in model.reactions] == \
+        [rxn.id for rxn in textbook.reactions]
+    assert [met.id for met in model.metabolites] == \
+        [met.id for met in textbook.metabolites]
+    assert sorted(gene.id for gene in model.genes) == \
+        sorted(gene.id for gene in textbook.genes)
+    for rxn in textbook.reactions:
+        rebuilt = model.reactions.get_by_id(rxn.id)
+        assert rebuilt.bounds == rxn.bounds
+        assert rebuilt.gene_reaction_rule == rxn.gene_reaction_rule
+        assert {met.id: coefficient for met, coefficient
+                in rebuilt.metabolites.items()} == \
+            {met.id: coefficient for met, coefficient
+             in rxn.metabolites.items()}
+        assert all(met.model is model for met in rebuilt.metabolites)
+
+    # the solver is built on first use, including for copies
+    copied = model.copy()
+    assert copied.slim_optimize() == \
+        pytest.approx(textbook.slim_optimize())
+    assert model.slim_optimize() == pytest.approx(textbook.slim_optimize())
+    model.remove_reactions([model.reactions.PGI])
+    assert 'PGI' not in model.variables
+    assert 'PGI' in copied.variables
+
+def test_model_tables_load_time():
+    import time
+    from pickle import dumps, loads
+    from medusa.test import _model_from_tables
+
+    # a synthetic universal of the size of the modelSEED universal
+    num_mets = 20000
+    num_rxns = 30000
+    rng = np.random.RandomState(0)
+    rows = rng.randint(0, num_mets, size=(num_rxns, 4))
+    tables = {
+        'id': 'universal',
+        'name': '',
+        'compartments': {'c': 'cytosol'},
+        'metabolites': {
+            'id': ['cpd%05d_c' % i for i in range(num_mets)],
+            'name': ['cpd%05d' % i for i in range(num_mets)],
+            'formula': ['C6H12O6'] * num_mets,
+            'charge': [0] * num_mets,
+            'compartment': ['c'] * num_mets,
+            'notes': [{} for i in range(num_mets)],
+            'annotation': [{} for i in range(num_mets)]},
+        'reactions': {
+            'id': ['rxn%05d_c' % j for j in range(num_rxns)],
+            'name': ['rxn%05d' % j for j in range(num_rxns)],
+            'subsystem': [''] * num_rxns,
+            'lower_bound': [-1000.0] * num_rxns,
+            'upper_bound': [1000.0] * num_rxns,
+            'gene_reaction_rule': [''] * num_rxns,
+            'notes': [{} for j in range(num_rxns)],
+            'annotation': [{} for j in range(num_rxns)]},
+        'rows': rows.ravel().astype(np.int32),
+        'columns': np.repeat(np.arange(num_rxns, dtype=np.int32), 4),
+        'coefficients': np.tile([-1.0, -1.0, 1.0, 1.0], num_rxns),
+        'objective': {},
+        'objective_direction': 'max'}
+    cached = dumps(tables, protocol=4)
+
+    start = time.time()
+    universal = _model_from_tables(loads(cached))
+    elapsed = time.time() - start
+    assert len(universal.reactions) == num_rxns
+    assert elapsed < 1.0
 
 def load_modelseed_model(model_name):
     if model_name == 'Staphylococcus aureus':
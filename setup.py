@@ -18,6 +18,6 @@ setup(
     'Programming Language :: Python :: 3',
     ],
     packages=find_packages(),
-    install_requires=['cobra>=0.13.0'],
+    install_requires=['cobra>=0.13.0', 'scipy'],
     package_data={'':  ['test/data/*']}
 )